@@ -0,0 +1,114 @@
+'''
+DDFacet, a facet-based radio imaging package
+Copyright (C) 2013-2016  Cyril Tasse, l'Observatoire de Paris,
+SKA South Africa, Rhodes University
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+import numpy as np
+
+# default size of a tile, in pixels along each axis
+TILE_SIZE = 128
+
+class ClassTiledPeakIndex(object):
+    """
+    Keeps track of the peak of an image that is modified in small patches (e.g. by the SubStep() of a
+    minor cycle), so that finding the peak does not need a scan over the full image every iteration.
+
+    The image is split into square tiles, and the max (and its position) is kept per tile. On top of
+    this sits a two-level tournament: the max of each row of tiles, and the max over rows. After a patch
+    of the image has changed, update() rescans only the tiles overlapping the patch, and the rows they
+    belong to.
+
+    whereMax() gives the same answer as NpParallel.A_whereMax(A, DoAbs=DoAbs, Mask=Mask), i.e. masked
+    pixels are ignored, and if no pixel value is above zero, (0,0,0) is returned.
+    """
+    def __init__(self, A, DoAbs=1, Mask=None, TileSize=TILE_SIZE):
+        """
+        Args:
+            A: image, of shape [...,NX,NY]. Any leading axes are searched jointly, i.e. the peak over all
+               planes is returned. The array is referenced, not copied, so it is expected to be modified
+               in place, followed by a call to update().
+            DoAbs: if True, search for the max of the absolute value
+            Mask: None, or boolean array of at least NX*NY pixels. Pixels where the mask is set are ignored.
+                  As with A_whereMax(), the first plane of the mask applies to all planes of the image.
+            TileSize: size of tiles
+        """
+        NX, NY = A.shape[-2], A.shape[-1]
+        self._A = A.reshape((-1, NX, NY))
+        if Mask is not None:
+            Mask = np.asarray(Mask).reshape((-1, NX, NY))[0] != 0
+            if not Mask.any():
+                Mask = None
+        self._Mask = Mask
+        self._DoAbs = DoAbs
+        self._TileSize = TileSize
+        self.NX, self.NY = NX, NY
+        ntx = (NX + TileSize - 1)//TileSize
+        nty = (NY + TileSize - 1)//TileSize
+        self._TileMax = np.zeros((ntx, nty), np.float64)
+        self._TileX = np.zeros((ntx, nty), np.int64)
+        self._TileY = np.zeros((ntx, nty), np.int64)
+        self._RowMax = np.zeros(ntx, np.float64)
+        self._RowArg = np.zeros(ntx, np.int64)
+        self.update()
+
+    def _scanTile(self, itx, ity):
+        T = self._TileSize
+        x0, y0 = itx*T, ity*T
+        block = self._A[:, x0:x0+T, y0:y0+T]
+        values = np.abs(block) if self._DoAbs else block
+        if values.shape[0] > 1:
+            values = values.max(axis=0)
+        else:
+            values = values[0]
+        if self._Mask is not None:
+            values = np.where(self._Mask[x0:x0+T, y0:y0+T], 0, values)
+        imax = np.argmax(values)
+        dx, dy = divmod(imax, values.shape[1])
+        self._TileMax[itx, ity] = values[dx, dy]
+        self._TileX[itx, ity] = x0 + dx
+        self._TileY[itx, ity] = y0 + dy
+
+    def update(self, x0=0, x1=None, y0=0, y1=None):
+        """
+        Rescans the tiles overlapping the [x0:x1,y0:y1] region of the image. Call this after the region
+        has been modified. With no arguments, rescans the full image.
+        """
+        x1 = self.NX if x1 is None else x1
+        y1 = self.NY if y1 is None else y1
+        if x1 <= x0 or y1 <= y0:
+            return
+        T = self._TileSize
+        rows = range(max(x0, 0)//T, (min(x1, self.NX) - 1)//T + 1)
+        cols = range(max(y0, 0)//T, (min(y1, self.NY) - 1)//T + 1)
+        for itx in rows:
+            for ity in cols:
+                self._scanTile(itx, ity)
+            ity = np.argmax(self._TileMax[itx])
+            self._RowArg[itx] = ity
+            self._RowMax[itx] = self._TileMax[itx, ity]
+
+    def whereMax(self):
+        """
+        Returns x,y,value of the current peak (see A_whereMax())
+        """
+        itx = np.argmax(self._RowMax)
+        ity = self._RowArg[itx]
+        peak = self._TileMax[itx, ity]
+        if peak <= 0:
+            return 0, 0, self._A.dtype.type(0)
+        return int(self._TileX[itx, ity]), int(self._TileY[itx, ity]), self._A.dtype.type(peak)
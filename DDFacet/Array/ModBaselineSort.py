@@ -0,0 +1,105 @@
+'''
+DDFacet, a facet-based radio imaging package
+Copyright (C) 2013-2016  Cyril Tasse, l'Observatoire de Paris,
+SKA South Africa, Rhodes University
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+import numpy as np
+
+def GiveSortIndex(A0, A1, times):
+    """
+    Computes the index that puts rows into baseline-time order. This gives the same ordering as
+    sorted(zip(A0, A1, times, range(nrows))) (np.lexsort is stable, so ties keep their row order),
+    but without going through Python tuples.
+    Args:
+        A0, A1: antenna index vectors
+        times:  timestamp vector
+    Returns:
+        (sort_index, bl_offsets) tuple. sort_index is an int64 vector of row numbers; bl_offsets
+        is described in GiveBaselineOffsets(), and refers to the sorted rows.
+    """
+    sort_index = np.lexsort((times, A1, A0))
+    return sort_index, GiveBaselineOffsets(A0[sort_index], A1[sort_index])
+
+def GiveReverseIndex(sort_index):
+    """
+    Inverts a sort index: given sort_index (sorted row -> original row), returns the
+    reverse index (original row -> sorted row).
+    """
+    reverse_index = np.empty_like(sort_index)
+    reverse_index[sort_index] = np.arange(sort_index.size, dtype=sort_index.dtype)
+    return reverse_index
+
+def GiveBaselineGroups(A0, A1):
+    """
+    Groups rows (in any order) by baseline, without reordering them in the data. Returns
+    (row_index, bl_offsets), such that row_index[bl_offsets[i]:bl_offsets[i+1]] are the rows of
+    the i-th baseline. Baselines are in (A0,A1) order, and rows within a baseline keep their
+    original order, i.e. each group is the same as np.where((A0==a0)&(A1==a1))[0].
+    """
+    row_index = np.lexsort((A1, A0))
+    return row_index, GiveBaselineOffsets(A0[row_index], A1[row_index])
+
+def GiveBaselineOffsets(A0, A1):
+    """
+    Given antenna vectors of rows that are already in baseline order, returns a vector of
+    nbl+1 row offsets, such that rows bl_offsets[i]:bl_offsets[i+1] belong to the i-th baseline.
+    """
+    nrows = A0.size
+    if not nrows:
+        return np.zeros(1, np.int64)
+    cuts = np.where((A0[1:] != A0[:-1]) | (A1[1:] != A1[:-1]))[0] + 1
+    return np.concatenate(([0], cuts, [nrows])).astype(np.int64)
+
+def GiveBaselineSlice(A0, A1, bl_offsets, a0, a1, na=None):
+    """
+    Returns slice of (sorted) rows belonging to baseline a0:a1, or None if there are none.
+    This is a binary search over the baselines, instead of a full scan over rows.
+    """
+    if bl_offsets.size < 2:
+        return None
+    # since rows are sorted by (A0,A1), this key is monotonic across baselines
+    if na is None:
+        na = max(A0.max(), A1.max()) + 1
+    start = bl_offsets[:-1]
+    keys = A0[start].astype(np.int64)*na + A1[start]
+    key = a0*na + a1
+    ibl = np.searchsorted(keys, key)
+    if ibl >= keys.size or keys[ibl] != key:
+        return None
+    return slice(bl_offsets[ibl], bl_offsets[ibl+1])
+
+def GiveDotUVW(uvw, times, bl_offsets):
+    """
+    Computes d(uvw)/dt per row, for rows in baseline-time order. Within each baseline, the
+    derivative is the forward difference to the next row, with the last row of each baseline
+    taking the value of the previous row (same convention as ClassMS.ComputeDotUVW). Single-row
+    baselines get a zero derivative.
+    """
+    UVW_dt = np.zeros(uvw.shape, np.float64)
+    if uvw.shape[0] < 2:
+        return UVW_dt
+    dtimes = times[1:] - times[:-1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        UVW_dt[:-1] = (uvw[1:] - uvw[:-1]) / dtimes.reshape((-1, 1))
+    # the difference at the last row of each baseline straddles two baselines, so fix it up
+    first = bl_offsets[:-1]
+    last = bl_offsets[1:] - 1
+    multi = last > first
+    UVW_dt[last[multi]] = UVW_dt[last[multi]-1]
+    UVW_dt[last[~multi]] = 0
+    return UVW_dt
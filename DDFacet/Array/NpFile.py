@@ -0,0 +1,205 @@
+'''
+DDFacet, a facet-based radio imaging package
+Copyright (C) 2013-2016  Cyril Tasse, l'Observatoire de Paris,
+SKA South Africa, Rhodes University
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+# Raw on-disk array files for caches. Unlike np.save/np.load, these are read straight into
+# an existing (e.g. shared) array with readinto(), so loading costs no more than the disk I/O.
+# Shape and dtype are not stored: the caller is expected to know them, and a file of the
+# wrong size is treated as invalid.
+#
+# Arrays may also be stored compressed (see SaveCompressed()). The data is split into fixed-size
+# blocks which are (de)compressed independently, in a pool of threads. The codecs release the GIL
+# on large buffers, so this scales with the number of threads.
+
+import io
+import os.path
+import zlib, bz2
+import numpy as np
+from multiprocessing.pool import ThreadPool
+
+# max number of bytes moved per read/write call
+RAW_BLOCK = 1<<26
+# max number of packed bytes handled at a time when (un)packing boolean arrays
+PACKED_BLOCK = 1<<23
+
+def _readinto(f, buf):
+    """Fills uint8 array buf from file f, looping since readinto() may return short counts"""
+    offset = 0
+    while offset < buf.size:
+        nread = f.readinto(buf[offset:offset+RAW_BLOCK])
+        if not nread:
+            raise IOError("%s: unexpected end of file" % f.name)
+        offset += nread
+
+def _flatbytes(arr):
+    if not arr.flags.c_contiguous:
+        raise TypeError("array must be C-contiguous")
+    return arr.reshape(-1).view(np.uint8)
+
+def SaveRaw(path, arr):
+    """Writes contents of array to path as raw bytes"""
+    with open(path, "wb") as f:
+        _flatbytes(arr).tofile(f)
+
+def LoadRawInto(path, arr):
+    """
+    Reads file written by SaveRaw() into array arr (which must be of the same shape and dtype).
+    Returns False if the file size does not match the array, True on success.
+    """
+    buf = _flatbytes(arr)
+    if os.path.getsize(path) != buf.size:
+        return False
+    with io.open(path, "rb", buffering=0) as f:
+        _readinto(f, buf)
+    return True
+
+def SavePackedBool(path, arr):
+    """Writes boolean array to path, packed 8 elements per byte"""
+    flat = _flatbytes(arr)
+    with open(path, "wb") as f:
+        for i0 in xrange(0, flat.size, PACKED_BLOCK*8):
+            np.packbits(flat[i0:i0+PACKED_BLOCK*8]).tofile(f)
+
+def LoadPackedBoolInto(path, arr):
+    """
+    Reads file written by SavePackedBool() into boolean array arr. Unpacking is done in blocks,
+    so only a small temporary buffer is needed.
+    Returns False if the file size does not match the array, True on success.
+    """
+    flat = _flatbytes(arr)
+    nbytes = (flat.size+7)//8
+    if os.path.getsize(path) != nbytes:
+        return False
+    packed = np.empty(min(PACKED_BLOCK, nbytes), np.uint8)
+    with io.open(path, "rb", buffering=0) as f:
+        for i0 in xrange(0, nbytes, PACKED_BLOCK):
+            n = min(PACKED_BLOCK, nbytes-i0)
+            _readinto(f, packed[:n])
+            j0 = i0*8
+            j1 = min(j0+n*8, flat.size)
+            flat[j0:j1] = np.unpackbits(packed[:n])[:j1-j0]
+    return True
+
+# available codecs: name -> (compress, decompress) functions
+CODECS = dict(zlib=(lambda buf: zlib.compress(buf, 1), zlib.decompress),
+              bz2=(bz2.compress, bz2.decompress))
+try:
+    import lz4.block
+    CODECS["lz4"] = (lz4.block.compress, lz4.block.decompress)
+except ImportError:
+    pass
+
+COMPRESSED_MAGIC = "DDFZ0001"
+# uncompressed size of a compression block
+COMPRESSED_BLOCK = 1<<22
+
+class _CorruptFile(Exception):
+    """Raised internally when a compressed file turns out to be truncated or corrupt"""
+    pass
+
+def _compressedHeader(codec, rawsize, nblocks):
+    return np.array([rawsize, COMPRESSED_BLOCK, nblocks], np.int64), codec.ljust(8)[:8]
+
+def SaveCompressed(path, arr, codec="zlib", packbool=False, nthreads=1):
+    """
+    Writes array to path in compressed form. If packbool is True, array must be boolean, and is
+    bit-packed before compression. The file consists of a header, a table of compressed block
+    sizes, and the compressed blocks.
+    """
+    compress = CODECS[codec][0]
+    data = np.packbits(_flatbytes(arr)) if packbool else _flatbytes(arr)
+    nblocks = (data.size + COMPRESSED_BLOCK - 1)//COMPRESSED_BLOCK
+    header, codecname = _compressedHeader(codec, data.size, nblocks)
+    sizes = np.zeros(nblocks, np.int64)
+    blocks = ( data[i*COMPRESSED_BLOCK:(i+1)*COMPRESSED_BLOCK] for i in xrange(nblocks) )
+    pool = ThreadPool(nthreads) if nthreads > 1 else None
+    try:
+        with open(path, "wb") as f:
+            f.write(COMPRESSED_MAGIC)
+            f.write(codecname)
+            header.tofile(f)
+            # placeholder for the size table, filled in once the blocks have been written
+            table_offset = f.tell()
+            sizes.tofile(f)
+            for i, comp in enumerate(pool.imap(compress, blocks) if pool else (compress(b) for b in blocks)):
+                f.write(comp)
+                sizes[i] = len(comp)
+            f.seek(table_offset)
+            sizes.tofile(f)
+    finally:
+        if pool:
+            pool.close()
+
+def LoadCompressedInto(path, arr, packbool=False, nthreads=1):
+    """
+    Reads file written by SaveCompressed() into array arr (which must be of the same shape and dtype).
+    Blocks are read sequentially, and decompressed straight into the array by a pool of threads.
+    Returns False if the file does not match the array, or is truncated or corrupt, True on success.
+    """
+    flat = _flatbytes(arr)
+    rawsize = (flat.size+7)//8 if packbool else flat.size
+    with io.open(path, "rb") as f:
+        if f.read(len(COMPRESSED_MAGIC)) != COMPRESSED_MAGIC:
+            return False
+        decompress = CODECS.get(f.read(8).strip(), (None, None))[1]
+        header = np.frombuffer(f.read(3*8), np.int64)
+        if decompress is None or header.size != 3 or header[0] != rawsize or header[1] != COMPRESSED_BLOCK:
+            return False
+        nblocks = header[2]
+        if nblocks != (rawsize + COMPRESSED_BLOCK - 1)//COMPRESSED_BLOCK:
+            return False
+        sizes = np.frombuffer(f.read(nblocks*8), np.int64)
+        if len(sizes) != nblocks or (sizes < 0).any():
+            return False
+        def _read_block(i):
+            comp = f.read(sizes[i])
+            if len(comp) != sizes[i]:
+                raise _CorruptFile()
+            return i, comp
+        def _decompress_block(args):
+            i, comp = args
+            try:
+                raw = np.frombuffer(decompress(comp), np.uint8)
+            except Exception:
+                raise _CorruptFile()
+            # every block but the last one decompresses to a full COMPRESSED_BLOCK
+            if raw.size != min(COMPRESSED_BLOCK, rawsize - i*COMPRESSED_BLOCK):
+                raise _CorruptFile()
+            if packbool:
+                j0 = i*COMPRESSED_BLOCK*8
+                j1 = min(j0+raw.size*8, flat.size)
+                flat[j0:j1] = np.unpackbits(raw)[:j1-j0]
+            else:
+                flat[i*COMPRESSED_BLOCK:i*COMPRESSED_BLOCK+raw.size] = raw
+        try:
+            if nthreads > 1:
+                # read a batch of blocks at a time, so as not to hold the whole file in memory
+                pool = ThreadPool(nthreads)
+                batch = nthreads*2
+                try:
+                    for i0 in xrange(0, nblocks, batch):
+                        pool.map(_decompress_block, [ _read_block(i) for i in xrange(i0, min(i0+batch, nblocks)) ])
+                finally:
+                    pool.close()
+            else:
+                for i in xrange(nblocks):
+                    _decompress_block(_read_block(i))
+        except _CorruptFile:
+            return False
+    return True
@@ -25,7 +25,128 @@ import numpy as np
 from DDFacet.Other import MyLogger
 import traceback
 log = MyLogger.getLogger("NpShared")
-import os.path
+import os, os.path
+import time
+
+# Shared memory accounting. If a budget is set via SetShmBudget(), segments created via CreateShared() are
+# checked against the budget, and against the free space in /dev/shm (segments are created sparse, so
+# running out of memory would otherwise only show up later, as a SIGBUS when the pages are touched).
+# All segments owned by the run are counted: those under the accounting root (the SharedDict directory
+# of the run, which is common to all processes), and the NpShared segments named after it
+# (i.e. /dev/shm/ddf.PID.*). Each top-level entry under the root (e.g. a DATA chunk dict, the CF dict,
+# the facet grids), and each named segment, counts as an owner for reporting purposes.
+# When a new segment would not fit, the allocation blocks until other processes release enough
+# memory, or until the wait time runs out (by default, it fails immediately), at which point
+# ShmBudgetError is raised. With no budget, no checks are made at all.
+
+SHM_DIR = "/dev/shm"
+
+_shm_budget = 0
+_shm_root = None
+_shm_wait = 0
+# usage is cached for a short while, since scanning the root for every allocation would be too costly
+# when allocating many small segments. Entries are [timestamp, total, resident]
+_SHM_USAGE_TTL = 1
+_shm_usage_cache = [0, 0, 0]
+
+class ShmBudgetError(MemoryError):
+    """Raised when a shared memory segment cannot be allocated within the budget"""
+    pass
+
+def SetShmBudget(budget_gb, root, wait=0):
+    """Sets shared memory budget (in GB, 0 for no budget), the accounting root directory, and the max
+    time (in seconds) that an allocation will wait for memory to become available"""
+    global _shm_budget, _shm_root, _shm_wait
+    _shm_budget = int(budget_gb*2**30)
+    _shm_root = root
+    _shm_wait = wait
+
+def ShmUsage(by_owner=False):
+    """
+    Returns total size (in bytes) of segments owned by the run (see above), and the portion of that which
+    is actually resident (i.e. not sparse). If by_owner is True, returns a dict of {owner: size} instead.
+    """
+    usage = {}
+    resident = 0
+    if _shm_root:
+        segments = []
+        if os.path.isdir(_shm_root):
+            for dirpath, _, filenames in os.walk(_shm_root):
+                owner = os.path.relpath(dirpath, _shm_root).split(os.sep)[0]
+                segments += [ (os.path.join(dirpath, name), name if owner == "." else owner) for name in filenames ]
+        # NpShared segments named after the root live next to it
+        prefix = os.path.basename(_shm_root) + "."
+        shm_dir = os.path.dirname(_shm_root)
+        try:
+            segments += [ (os.path.join(shm_dir, name), name[len(prefix):])
+                          for name in os.listdir(shm_dir) if name.startswith(prefix) ]
+        except OSError:
+            pass
+        for path, key in segments:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if not os.path.isfile(path):
+                continue
+            usage[key] = usage.get(key, 0) + st.st_size
+            resident += min(st.st_blocks*512, st.st_size)
+    if by_owner:
+        return usage
+    return sum(usage.values()), resident
+
+def ShmReport():
+    """Returns string summarizing shared memory usage by owner"""
+    usage = ShmUsage(by_owner=True)
+    return ", ".join([ "%s %.2f GB" % (owner, size/2.**30)
+                       for owner, size in sorted(usage.items(), key=lambda x: -x[1]) ]) or "nothing allocated"
+
+def ShmAvailable(refresh=False):
+    """
+    Returns number of bytes that may still be allocated, given the free space in /dev/shm and the budget.
+    With no budget, this is simply the free space.
+    """
+    if not _shm_budget:
+        st = os.statvfs(SHM_DIR)
+        return st.f_bavail*st.f_frsize
+    if refresh or time.time() - _shm_usage_cache[0] > _SHM_USAGE_TTL:
+        _shm_usage_cache[:] = [time.time()] + list(ShmUsage())
+    _, total, resident = _shm_usage_cache
+    st = os.statvfs(SHM_DIR)
+    # space already committed to our sparse segments is not available, even if not yet resident
+    available = st.f_bavail*st.f_frsize - (total - resident)
+    return min(available, _shm_budget - total)
+
+def WaitForShm(nbytes, wait=None):
+    """
+    Waits until nbytes of shared memory are available (see ShmAvailable()), for up to wait seconds
+    (default is as per SetShmBudget()). Returns True if memory is available, False on timeout.
+    """
+    wait = _shm_wait if wait is None else wait
+    t0 = time.time()
+    while ShmAvailable(refresh=True) < nbytes:
+        if time.time() - t0 >= wait:
+            return False
+        time.sleep(0.1)
+    return True
+
+def _checkShm(Name, shape, dtype):
+    """Checks that a segment of the given shape and dtype fits in the budget, blocking if needed"""
+    if not _shm_budget:
+        return
+    nbytes = int(np.prod(shape))*np.dtype(dtype).itemsize
+    if ShmAvailable() >= nbytes:
+        # account for the new segment until the next refresh
+        _shm_usage_cache[1] += nbytes
+        return
+    if _shm_wait:
+        print>>log, ModColor.Str("waiting for %.2f GB of shared memory to become available for %s" % (nbytes/2.**30, Name))
+        print>>log, "  current usage: %s" % ShmReport()
+    if not WaitForShm(nbytes):
+        raise ShmBudgetError("can't allocate %.2f GB of shared memory for %s: only %.2f GB available. "
+                             "Current usage: %s. Consider raising --Parallel-ShmBudget, or reducing "
+                             "--Data-ChunkHours or --Parallel-ReadAhead." % (nbytes/2.**30, Name, ShmAvailable()/2.**30, ShmReport()))
+    _shm_usage_cache[1] += nbytes
 
 
 def zeros(Name, *args, **kwargs):
@@ -68,6 +189,7 @@ def SizeShm():
 
 
 def CreateShared(Name, shape, dtype):
+    _checkShm(Name, shape, dtype)
     try:
         a = SharedArray.create(Name, shape, dtype=dtype)
     except OSError:
@@ -1,4 +1,5 @@
 import sys, os, os.path, cPickle, re
+import time
 import NpShared
 import numpy as np
 import traceback
@@ -16,6 +17,53 @@ def _to_shm (path):
 
 _allowed_key_types = dict(int=int, str=str, bool=bool)
 
+# Per-process cache of attached shared arrays: path -> ((inode, size), array). Attaching (i.e. mmap-ing) a
+# segment is relatively costly, and worker processes access the same arrays job after job, via freshly
+# instantiated SharedDicts. A cached handle is reused for as long as the file it was attached from is still
+# in place. Handles of deleted segments are dropped by pruneHandleCache(), so as not to pin their memory.
+_array_handles = {}
+_HANDLE_PRUNE_INTERVAL = 1
+_last_handle_prune = [0]
+
+def _file_id(path):
+    st = os.stat(path)
+    return st.st_ino, st.st_size
+
+def _attach_array(path):
+    """Attaches shared array at path, reusing cached handle if possible"""
+    fid = _file_id(path)
+    entry = _array_handles.get(path)
+    if entry is not None and entry[0] == fid:
+        return entry[1]
+    array = NpShared.GiveArray(_to_shm(path))
+    if array is not None:
+        _array_handles[path] = fid, array
+    return array
+
+def _cache_array_handle(path, array):
+    """Adds handle of newly created array to the cache"""
+    _array_handles[path] = _file_id(path), array
+
+def _drop_array_handles(path):
+    """Drops cached handles of arrays at path, or under path"""
+    prefix = path + "/"
+    for key in [ key for key in _array_handles if key == path or key.startswith(prefix) ]:
+        del _array_handles[key]
+
+def pruneHandleCache(force=False):
+    """Drops cached handles of arrays that have been deleted or replaced since. Unless force is True, this
+    is done at most once every _HANDLE_PRUNE_INTERVAL seconds, so it is cheap to call before every job."""
+    if not force and time.time() - _last_handle_prune[0] < _HANDLE_PRUNE_INTERVAL:
+        return
+    _last_handle_prune[0] = time.time()
+    for path, (fid, _) in _array_handles.items():
+        try:
+            if _file_id(path) == fid:
+                continue
+        except OSError:
+            pass
+        del _array_handles[path]
+
 def attach(name, load=True, readwrite=True):
     return SharedDict(name, reset=False, load=load, readwrite=readwrite)
 
@@ -59,11 +107,11 @@ class SharedDict (dict):
             except:
                 print "Error loading item %s" % self.path
                 traceback.print_exc()
-                return SharedDict.ItemLoadError(path, sys.exc_info())
+                return SharedDict.ItemLoadError(self.path, sys.exc_info())
 
     class SharedArrayProxy (ItemProxy):
         def load_impl(self):
-            return NpShared.GiveArray(_to_shm(self.path))
+            return _attach_array(self.path)
 
     class SubdictProxy(ItemProxy):
         def load_impl(self):
@@ -87,6 +135,8 @@ class SharedDict (dict):
         self._delete_items = False
         self._readwrite = readwrite
         self._load = load
+        # True once our subdirectory has been scanned for items (see _list())
+        self._listed = False
         if path.startswith(SharedDict.basepath):
             self.path = path
         else:
@@ -123,9 +173,11 @@ class SharedDict (dict):
         if not self._readwrite:
             raise RuntimeError("SharedDict %s attached as read-only" % self.path)
         dict.clear(self)
+        _drop_array_handles(self.path)
         if os.path.exists(self.path):
             os.system("rm -fr %s" % self.path)
         os.mkdir(self.path)
+        self._listed = True
 
     def clear(self):
         if self._delete_items:
@@ -134,6 +186,7 @@ class SharedDict (dict):
             self.delete()
         else:
             dict.clear(self)
+            self._listed = True
 
     def save(self, filename):
         os.system("tar cf %s -C %s ." % (filename, self.path))
@@ -144,11 +197,42 @@ class SharedDict (dict):
         self.reload()
 
     def reload(self):
-        """(Re)initializes dict with items from path"""
+        """
+        (Re)initializes dict with items from path. Items are attached lazily: each key is looked up on disk
+        when first accessed (see _attach_key()), and the subdirectory is only scanned when the full set
+        of keys is needed (see _list()). Arrays are only mapped in when their values are requested.
+        """
         if not self._load:
             raise RuntimeError("SharedDict %s attached without load permissions" % self.path)
         dict.clear(self)
-        # scan our subdirectory for items
+        self._listed = False
+
+    def _attach_key(self, item):
+        """Attaches item from disk, if not attached already. Returns True if item is in the dict."""
+        if dict.__contains__(self, item):
+            return True
+        if self._listed or not self._load:
+            return False
+        # numpy scalars compare equal to the corresponding Python keys, so look them up as such
+        if isinstance(item, np.bool_):
+            item = bool(item)
+        elif isinstance(item, np.integer):
+            item = int(item)
+        if type(item).__name__ not in _allowed_key_types:
+            return False
+        name = self._key_to_name(item)
+        for valuetype, proxyclass in SharedDict._proxy_class_map.iteritems():
+            filepath = os.path.join(self.path, name + valuetype)
+            if os.path.exists(filepath):
+                dict.__setitem__(self, item, proxyclass(filepath))
+                return True
+        return False
+
+    def _list(self):
+        """Scans our subdirectory for items that have not been attached yet"""
+        if self._listed or not self._load:
+            return
+        self._listed = True
         for name in os.listdir(self.path):
             filepath = os.path.join(self.path, name)
             # each filename is composed as "key_type:name:value_type", e.g. "str:Data:a", where value_type
@@ -163,6 +247,8 @@ class SharedDict (dict):
                 print "Unknown shared dict key type "+keytype
                 continue
             key = typefunc(key)
+            if dict.__contains__(self, key):
+                continue
             try:
                 proxyclass = SharedDict._proxy_class_map[valuetype]
                 dict.__setitem__(self, key, proxyclass(filepath))
@@ -174,7 +260,30 @@ class SharedDict (dict):
     def _key_to_name (self, item):
         return "%s:%s:" % (type(item).__name__, str(item))
 
+    def keys(self):
+        self._list()
+        return dict.keys(self)
+
+    def iterkeys(self):
+        self._list()
+        return dict.iterkeys(self)
+
+    def __iter__(self):
+        self._list()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        self._list()
+        return dict.__len__(self)
+
+    def __contains__(self, item):
+        return self._attach_key(item)
+
+    def has_key(self, item):
+        return self._attach_key(item)
+
     def get(self, item, default_value=None):
+        self._attach_key(item)
         value = dict.get(self, item, default_value)
         if isinstance(value, SharedDict.ItemProxy):
             value = value.load()
@@ -182,6 +291,7 @@ class SharedDict (dict):
         return value
 
     def __getitem__(self, item):
+        self._attach_key(item)
         value = dict.__getitem__(self, item)
         if isinstance(value, SharedDict.ItemProxy):
             value = value.load()
@@ -203,6 +313,7 @@ class SharedDict (dict):
     def __delitem__(self, item):
         if not self._readwrite:
             raise RuntimeError("SharedDict %s attached as read-only" % self.path)
+        self._attach_key(item)
         if self._delete_items:
             return self.delete_item(item)
         else:
@@ -211,9 +322,12 @@ class SharedDict (dict):
     def delete_item (self, item):
         if not self._readwrite:
             raise RuntimeError("SharedDict %s attached as read-only" % self.path)
+        self._attach_key(item)
         dict.__delitem__(self, item)
         name = self._key_to_name(item)
         path = os.path.join(self.path, name)
+        _drop_array_handles(path+"a")
+        _drop_array_handles(path+"d")
         for suffix in "ap":
             if os.path.exists(path+suffix):
                 os.unlink(path+suffix)
@@ -229,7 +343,9 @@ class SharedDict (dict):
         name = self._key_to_name(item)
         path = os.path.join(self.path, name)
         # remove previous item from SHM, if it's in the local dict
-        if dict.__contains__(self,item):
+        if self._attach_key(item):
+            _drop_array_handles(path+"a")
+            _drop_array_handles(path+"d")
             for suffix in "ap":
                 if os.path.exists(path+suffix):
                     os.unlink(path+suffix)
@@ -244,6 +360,7 @@ class SharedDict (dict):
         # for arrays, copy to a shared array
         if isinstance(value, np.ndarray):
             value = NpShared.ToShared(_to_shm(path+'a'), value)
+            _cache_array_handle(path+'a', value)
         # for regular dicts, copy across
         elif isinstance(value, (dict, SharedDict, collections.OrderedDict)):
             dict1 = self.addSubdict(item)
@@ -271,6 +388,7 @@ class SharedDict (dict):
         name = self._key_to_name(item) + 'a'
         filepath = os.path.join(self.path, name)
         array = NpShared.CreateShared(_to_shm(filepath), shape, dtype)
+        _cache_array_handle(filepath, array)
         dict.__setitem__(self, item, array)
         return array
 
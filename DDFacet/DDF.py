@@ -39,6 +39,7 @@ import numexpr
 import numpy as np
 from DDFacet.Other import logo
 from DDFacet.Array import NpParallel
+from DDFacet.Array import NpShared, shared_dict
 from DDFacet.Imager import ClassDeconvMachine
 from DDFacet.Parset import ReadCFG
 from DDFacet.Other import MyPickle
@@ -194,6 +195,10 @@ def main(OP=None, messages=[]):
     # get rid of old shm arrays from previous runs
     Multiprocessing.cleanupStaleShm()
 
+    # set up shared memory accounting
+    NpShared.SetShmBudget(DicoConfig["Parallel"]["ShmBudget"], shared_dict.SharedDict.basepath,
+                          wait=DicoConfig["Parallel"]["ShmWait"])
+
     # initialize random seed from config if set, or else from system time
     if DicoConfig["Misc"]["RandomSeed"] is not None:
         print>>log, "random seed=%d (explicit)" % DicoConfig["Misc"]["RandomSeed"]
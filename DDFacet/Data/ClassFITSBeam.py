@@ -31,7 +31,6 @@ import pyrap.tables
 import numpy as np
 
 
-dm = pyrap.measures.measures()
 dq = pyrap.quanta
 
 # This a list of the Stokes enums (as defined in casacore header measures/Stokes.h)
@@ -54,6 +53,10 @@ class ClassFITSBeam (object):
         self.time_inc = opts["DtBeamMin"]
         self.nchan = opts["NBand"]
 
+        # measures object of our own: setting up the frame and computing the PA is not atomic, and the
+        # beam may be evaluated by several threads (each with its own ClassFITSBeam, see ClassJones.ClassBeamEvaluator)
+        self.dm = dm = pyrap.measures.measures()
+
         # make masure for zenith
         self.zenith = dm.direction('AZEL','0deg','90deg')
         # make position measure from antenna 0
@@ -155,6 +158,7 @@ class ClassFITSBeam (object):
         if not quiet:
             print>>log,"  DtBeamMin=%.2f min results in %d samples"%(self.time_inc, len(beam_times))
         if self.pa_inc:
+            dm = self.dm
             pas = [ 
                 # put antenna0 position as reference frame. NB: in the future may want to do it per antenna
                 dm.do_frame(self.pos0) and 
@@ -187,6 +191,7 @@ class ClassFITSBeam (object):
         Output: a complex array of shape [Ndir,Nant,Nfreq,2,2] giving the Jones matrix per antenna, direction and frequency
         """
 
+        dm = self.dm
         # put antenna0 position as reference frame. NB: in the future may want to do it per antenna
         dm.do_frame(self.pos0);
         # put time into reference frame
@@ -197,10 +202,7 @@ class ClassFITSBeam (object):
 
         # compute l,m per direction
         ndir = len(ra)
-        l0 = numpy.zeros(ndir,float)
-        m0 = numpy.zeros(ndir,float)
-        for i,(r1,d1) in enumerate(zip(ra,dec)):
-          l0[i], m0[i] = self.ms.radec2lm_scalar(r1,d1)
+        l0, m0 = self.ms.radec2lm_scalar(numpy.asarray(ra,float), numpy.asarray(dec,float))
         # print>>log,ra*180/np.pi,dec*180/np.pi
         # print>>log,l0*180/np.pi,m0*180/np.pi
         # rotate each by parallactic angle
@@ -216,17 +218,18 @@ class ClassFITSBeam (object):
         # get interpolated values. Output shape will be [ndir,nfreq]
         beamjones = [ self.vbs[i].interpolate(l,m,freq=self.freqs,freqaxis=1) for i in range(4) ]
 
-        # now make output matrix
-        jones = numpy.zeros((ndir,self.ms.na,len(self.freqs),2,2),dtype=numpy.complex64)
+        # assemble per-direction Jones matrices, of shape [ndir,nfreq,2,2]. A 1D result (no frequency
+        # dependence) is broadcast across frequencies
+        jones1 = numpy.zeros((ndir,len(self.freqs),4),dtype=numpy.complex64)
+        for ijones,bj in enumerate(beamjones):
+            jones1[:,:,ijones] = bj.reshape((ndir,-1))
 
-        # populate it with values
+        # now make output matrix
         # NB: here we copy the same Jones to every antenna. In principle we could compute
         # a parangle per antenna. When we have pointing error, it's also going to be per
         # antenna
-        for iant in xrange(self.ms.na):
-            for ijones,(ix,iy) in enumerate(((0,0),(0,1),(1,0),(1,1))):
-                bj = beamjones[ijones]
-                jones[:,iant,:,ix,iy] = beamjones[ijones].reshape((len(bj),1)) if bj.ndim == 1 else bj
+        jones = numpy.empty((ndir,self.ms.na,len(self.freqs),2,2),dtype=numpy.complex64)
+        jones[...] = jones1.reshape((ndir,1,len(self.freqs),2,2))
         return jones
 
 
@@ -23,9 +23,17 @@ from DDFacet.Other import MyLogger
 log = MyLogger.getLogger("ClassJones")
 from DDFacet.Other import reformat
 from DDFacet.Array import NpShared
+from DDFacet.Array import shared_dict
 import os
+import fcntl
+import hashlib
+import itertools
+import Queue
+import psutil
+from multiprocessing.pool import ThreadPool
 from DDFacet.Array import ModLinAlg
 from DDFacet.Other.progressbar import ProgressBar
+from DDFacet.Other.AsyncProcessPool import APP
 import ClassLOFARBeam
 import ClassFITSBeam
 # import ClassSmoothJones is not used anywhere, should be able to remove it
@@ -33,10 +41,12 @@ import ClassFITSBeam
 
 class ClassJones():
 
-    def __init__(self, GD, MS, FacetMachine=None):
+    def __init__(self, GD, MS, FacetMachine=None, BeamEvaluator=None):
         self.GD = GD
         self.FacetMachine = FacetMachine
         self.MS = MS
+        # if set, beam is evaluated in parallel by this ClassBeamEvaluator
+        self.BeamEvaluator = BeamEvaluator
         self.HasKillMSSols = False
         self.BeamTimes_kMS = np.array([], np.float32)
 
@@ -44,129 +54,103 @@ class ClassJones():
         # self.JonesNormSolsFile_Beam="%s/JonesNorm_Beam.npz"%ThisMSName
 
     def InitDDESols(self, DATA, quiet=False):
+        """
+        Populates the killMS and/or Beam entries of a chunk's DATA dict. Jones matrices live in observation-level
+        stores (see GiveJonesStore()) shared by all chunks of the MS: the chunk only carries its TimeMapping
+        into the store, and the store's name.
+        """
         GD = self.GD
         SolsFile = GD["DDESolutions"]["DDSols"]
         self.ApplyCal = False
         if SolsFile != "":
             self.ApplyCal = True
-            self.JonesNormSolsFile_killMS, valid = self.MS.cache.checkCache(
-                "JonesNorm_killMS.npz",
-                dict(VisData=GD["Data"], 
-                     DDESolutions=GD["DDESolutions"], 
+            store = self.GiveJonesStore("killMS",
+                dict(MS=self.MS.getCacheKey("TIME"),
+                     DDESolutions=GD["DDESolutions"],
                      DataSelection=self.GD["Selection"],
                      ImagerMainFacet=self.GD["Image"],
-                     Facets=self.GD["Facets"],
-                     PhaseCenterRADEC=self.GD["Image"]["PhaseCenterRADEC"]))
-            if valid:
-                print>>log, "  using cached Jones matrices from %s" % self.JonesNormSolsFile_killMS
-                DicoSols, TimeMapping, DicoClusterDirs = self.DiskToSols(self.JonesNormSolsFile_killMS)
-            else:
-                DicoSols, TimeMapping, DicoClusterDirs = self.MakeSols("killMS", DATA, quiet=quiet)
-                self.MS.cache.saveCache("JonesNorm_killMS.npz")
-
-            DATA["killMS"] =  dict(Jones=DicoSols, TimeMapping=TimeMapping, Dirs=DicoClusterDirs)
-            self.DicoClusterDirs_kMS=DicoClusterDirs
-
+                     Facets=self.GD["Facets"]), quiet=quiet)
+            DATA["killMS"] = dict(Store=store.path, TimeMapping=self.GiveTimeMapping(store["Jones"], DATA["times"]))
+            self.DicoClusterDirs_kMS = store["Dirs"]
+            self.BeamTimes_kMS = store["Jones"]["BeamTimes"]
             self.HasKillMSSols = True
 
-
         ApplyBeam=(GD["Beam"]["Model"] is not None)
         if ApplyBeam:
             self.ApplyCal = True
-            self.JonesNormSolsFile_Beam, valid = self.MS.cache.checkCache("JonesNorm_Beam.npz", 
-                                                                          dict(VisData=GD["Data"], 
-                                                                               Beam=GD["Beam"], 
-                                                                               Facets=self.GD["Facets"],
-                                                                               DataSelection=self.GD["Selection"],
-                                                                               DDESolutions=GD["DDESolutions"],
-                                                                               ImagerMainFacet=self.GD["Image"]))
-            if valid:
-                print>>log, "  using cached Jones matrices from %s" % self.JonesNormSolsFile_Beam
-                DicoSols, TimeMapping, DicoClusterDirs = self.DiskToSols(self.JonesNormSolsFile_Beam)
-            else:
-                DicoSols, TimeMapping, DicoClusterDirs = self.MakeSols("Beam", DATA, quiet=quiet)
-                self.MS.cache.saveCache("JonesNorm_Beam.npz")
-            DATA["Beam"] =  dict(Jones=DicoSols, TimeMapping=TimeMapping, Dirs=DicoClusterDirs)
-
-    # def ToShared(self, StrType, DicoSols, TimeMapping, DicoClusterDirs):
-    #     print>>log, "  Putting %s Jones in shm" % StrType
-    #     NpShared.DelAll("%sDicoClusterDirs_%s" % (self.IdSharedMem, StrType))
-    #     NpShared.DelAll("%sJonesFile_%s" % (self.IdSharedMem, StrType))
-    #     NpShared.DelAll("%sMapJones_%s" % (self.IdSharedMem, StrType))
-    #     NpShared.DicoToShared(
-    #         "%sDicoClusterDirs_%s" %
-    #         (self.IdSharedMem, StrType), DicoClusterDirs)
-    #     NpShared.DicoToShared(
-    #         "%sJonesFile_%s" %
-    #         (self.IdSharedMem, StrType), DicoSols)
-    #     NpShared.ToShared(
-    #         "%sMapJones_%s" %
-    #         (self.IdSharedMem, StrType), TimeMapping)
-
-    def SolsToDisk(self, OutName, DicoSols, DicoClusterDirs, TimeMapping):
-
-        print>>log, "  Saving %s" % OutName
-        l = DicoClusterDirs["l"]
-        m = DicoClusterDirs["m"]
-        I = DicoClusterDirs["I"]
-        ra = DicoClusterDirs["ra"]
-        dec = DicoClusterDirs["dec"]
-        Cluster = DicoClusterDirs["Cluster"]
-        t0 = DicoSols["t0"]
-        t1 = DicoSols["t1"]
-        tm = DicoSols["tm"]
-        Jones = DicoSols["Jones"]
-        TimeMapping = TimeMapping
-        VisToJonesChanMapping = DicoSols["VisToJonesChanMapping"]
-
-        # np.savez(self.JonesNorm_killMS,l=l,m=m,I=I,Cluster=Cluster,t0=t0,t1=t1,tm=tm,Jones=Jones,TimeMapping=TimeMapping)
-
-        np.savez(file(OutName, "w"),
-                 l=l, m=m, I=I, Cluster=Cluster,
-                 t0=t0, t1=t1, tm=tm,
-                 ra=ra,dec=dec,
-                 Jones=Jones,
-                 TimeMapping=TimeMapping,
-                 VisToJonesChanMapping=VisToJonesChanMapping)
-
-    def DiskToSols(self, InName):
-        # SolsFile_killMS=np.load(self.JonesNorm_killMS)
-        # print>>log, "  Loading %s"%InName
-        # print "!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!",InName
-        SolsFile = np.load(InName)
-        print>>log, "  %s loaded" % InName
+            store = self.GiveJonesStore("Beam",
+                dict(MS=self.MS.getCacheKey("TIME"),
+                     Beam=GD["Beam"],
+                     Facets=self.GD["Facets"],
+                     DataSelection=self.GD["Selection"],
+                     DDESolutions=GD["DDESolutions"],
+                     ImagerMainFacet=self.GD["Image"]), quiet=quiet)
+            DATA["Beam"] = dict(Store=store.path, TimeMapping=self.GiveTimeMapping(store["Jones"], DATA["times"]))
+
+    def GiveJonesStore(self, StrType, hashkeys, quiet=False):
+        """
+        Returns observation-level store of Jones matrices of the given type ("killMS" or "Beam") for this MS,
+        as a read-only SharedDict with "Jones" and "Dirs" subdicts. The store covers all solution (or beam)
+        time samples of the MS, so it is made once per run, and shared by all chunks. It is loaded from the
+        MS-level cache if valid, else computed and cached. A file lock ensures that I/O processes loading
+        chunks of the same MS concurrently do not make the store twice.
+        """
+        name = "JonesStore:%s:%s" % (StrType, hashlib.md5(self.MS.maincache.dirname).hexdigest()[:16])
+        path = os.path.join(shared_dict.SharedDict.basepath, name)
+        with open(path + ".lock", "w") as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            if not os.path.exists(path):
+                cachepath, valid = self.MS.maincache.checkCache("Jones%s" % StrType, hashkeys, directory=True)
+                if valid:
+                    print>>log, "  using cached %s Jones matrices from %s" % (StrType, cachepath)
+                    DicoSols, DicoClusterDirs = self.DiskToSols(cachepath)
+                else:
+                    DicoSols, DicoClusterDirs = self.MakeSols(StrType, quiet=quiet)
+                    self.SolsToDisk(cachepath, DicoSols, DicoClusterDirs)
+                    self.MS.maincache.saveCache("Jones%s" % StrType)
+                # make store under a temporary name, so that it only appears once complete
+                store = shared_dict.create(name + ".tmp")
+                store["Jones"] = DicoSols
+                store["Dirs"] = DicoClusterDirs
+                os.rename(store.path, path)
+        return shared_dict.attach(name, readwrite=False)
+
+    def SolsToDisk(self, OutDir, DicoSols, DicoClusterDirs):
+        """Saves Jones store to cache directory. Jones matrices go into their own .npy file, so they can be memory-mapped"""
+        print>>log, "  Saving %s" % OutDir
+        np.save(os.path.join(OutDir, "Jones.npy"), DicoSols["Jones"])
+        np.savez(file(os.path.join(OutDir, "Sols.npz"), "w"),
+                 l=DicoClusterDirs["l"], m=DicoClusterDirs["m"], I=DicoClusterDirs["I"],
+                 Cluster=DicoClusterDirs["Cluster"],
+                 ra=DicoClusterDirs["ra"], dec=DicoClusterDirs["dec"],
+                 t0=DicoSols["t0"], t1=DicoSols["t1"], tm=DicoSols["tm"],
+                 BeamTimes=DicoSols["BeamTimes"],
+                 VisToJonesChanMapping=DicoSols["VisToJonesChanMapping"])
+
+    def DiskToSols(self, InDir):
+        """Loads Jones store saved by SolsToDisk(). The Jones matrices are memory-mapped rather than read in"""
+        SolsFile = np.load(os.path.join(InDir, "Sols.npz"))
+        print>>log, "  %s loaded" % InDir
 
         DicoClusterDirs = {}
-        DicoClusterDirs["l"] = SolsFile["l"]
-        DicoClusterDirs["m"] = SolsFile["m"]
-        DicoClusterDirs["ra"] = SolsFile["ra"]
-        DicoClusterDirs["dec"] = SolsFile["dec"]
-        DicoClusterDirs["I"] = SolsFile["I"]
-        DicoClusterDirs["Cluster"] = SolsFile["Cluster"]
+        for key in "l", "m", "ra", "dec", "I", "Cluster":
+            DicoClusterDirs[key] = SolsFile[key]
         DicoSols = {}
-        DicoSols["t0"] = SolsFile["t0"]
-        DicoSols["t1"] = SolsFile["t1"]
-        DicoSols["tm"] = SolsFile["tm"]
-        DicoSols["Jones"] = SolsFile["Jones"]
-        DicoSols["VisToJonesChanMapping"] = SolsFile["VisToJonesChanMapping"]
-        TimeMapping = SolsFile["TimeMapping"]
-        return DicoSols, TimeMapping, DicoClusterDirs
+        for key in "t0", "t1", "tm", "BeamTimes", "VisToJonesChanMapping":
+            DicoSols[key] = SolsFile[key]
+        DicoSols["Jones"] = np.load(os.path.join(InDir, "Jones.npy"), mmap_mode="r")
+        return DicoSols, DicoClusterDirs
 
-    def MakeSols(self, StrType, DATA, quiet=False):
+    def MakeSols(self, StrType, quiet=False):
+        """Computes Jones matrices of the given type over the full MS. Returns DicoSols, DicoClusterDirs"""
 
         print>>log, "Build solution Dico for %s" % StrType
 
         if StrType == "killMS":
             DicoClusterDirs_killMS, DicoSols = self.GiveKillMSSols()
             DicoClusterDirs = DicoClusterDirs_killMS
-            print>>log, "  Build VisTime-to-Solution mapping"
-            TimeMapping = self.GiveTimeMapping(DicoSols, DATA["times"])
             DicoClusterDirs["l"],DicoClusterDirs["m"]=self.MS.radec2lm_scalar(DicoClusterDirs["ra"],DicoClusterDirs["dec"])
-            self.SolsToDisk(
-                self.JonesNormSolsFile_killMS,
-                DicoSols,
-                DicoClusterDirs_killMS,
-                TimeMapping)
+            DicoSols["BeamTimes"] = self.BeamTimes_kMS
         BeamJones = None
         if StrType == "Beam":
 
@@ -227,18 +211,14 @@ class ClassJones():
                 DicoClusterDirs["I"] = np.array([1.], np.float32)
                 DicoClusterDirs["Cluster"] = np.array([0], np.int32)
 
-            DicoClusterDirs_Beam = DicoClusterDirs
-            DicoSols = self.GiveBeam(DATA["uniq_times"], quiet=quiet)
-            print>>log, "  Build VisTime-to-Beam mapping"
-            TimeMapping = self.GiveTimeMapping(DicoSols, DATA["times"])
+            # beam is sampled over the full time range of the MS
+            t = self.MS.GiveMainTable()
+            uniq_times = np.unique(t.getcol("TIME"))
+            t.close()
+            DicoSols = self.GiveBeam(uniq_times, quiet=quiet)
+            DicoSols["BeamTimes"] = np.array([], np.float64)
             DicoClusterDirs["l"],DicoClusterDirs["m"]=self.MS.radec2lm_scalar(DicoClusterDirs["ra"],DicoClusterDirs["dec"])
 
-            self.SolsToDisk(
-                self.JonesNormSolsFile_Beam,
-                DicoSols,
-                DicoClusterDirs_Beam,
-                TimeMapping)
-
         # if (BeamJones is not None)&(KillMSSols is not None):
         #     print>>log,"  Merging killMS and Beam Jones matrices"
         #     DicoSols=self.MergeJones(KillMSSols,BeamJones)
@@ -254,7 +234,7 @@ class ClassJones():
 
         # ThisMSName=reformat.reformat(os.path.abspath(self.CurrentMS.MSName),LastSlash=False)
         # TimeMapName="%s/Mapping.DDESolsTime.npy"%ThisMSName
-        return DicoSols, TimeMapping, DicoClusterDirs
+        return DicoSols, DicoClusterDirs
 
     def GiveTimeMapping(self, DicoSols, times):
         """Builds mapping from MS rows to Jones solutions.
@@ -265,21 +245,15 @@ class ClassJones():
             Vector of indices, one per each row in DATA, giving the time index of the Jones matrix
             corresponding to that row.
         """
-        print>>log, "  Build Time Mapping"
-        DicoJonesMatrices = DicoSols
+        t0 = DicoSols["t0"]
+        t1 = DicoSols["t1"]
+        # intervals are in increasing time order, so find the last one starting at or before each time. Rows not
+        # within any interval map to 0. No assumption is made on the sortedness of times.
+        it = np.searchsorted(t0, times, side="right") - 1
+        valid = (it >= 0)
+        valid[valid] &= times[valid] < t1[it[valid]]
         ind = np.zeros((times.size,), np.int32)
-        nt, na, nd, _, _, _ = DicoJonesMatrices["Jones"].shape
-        ii = 0
-        for it in xrange(nt):
-            t0 = DicoJonesMatrices["t0"][it]
-            t1 = DicoJonesMatrices["t1"][it]
-            ## new code: no assumption of sortedness
-            ind[(times >= t0) & (times < t1)] = it
-            ## old code: assumed times was sorted
-            # indMStime = np.where((times >= t0) & (times < t1))[0]
-            # indMStime = np.ones((indMStime.size,), np.int32)*it
-            # ind[ii:ii+indMStime.size] = indMStime[:]
-            # ii += indMStime.size
+        ind[valid] = it[valid]
         return ind
 
     def GiveKillMSSols(self):
@@ -583,37 +557,22 @@ class ClassJones():
             print>>log,"VisToJonesChanMapping: %s"%DicoBeam["VisToJonesChanMapping"]
 
 
-        DicoBeam["Jones"]=np.zeros((Tm.size,NDir,self.MS.na,FreqDomains.shape[0],2,2),dtype=np.complex64)
-        DicoBeam["t0"]=np.zeros((Tm.size,),np.float64)
-        DicoBeam["t1"]=np.zeros((Tm.size,),np.float64)
-        DicoBeam["tm"]=np.zeros((Tm.size,),np.float64)
-        
-        
-        rac,decc=self.MS.OriginalRadec
-        pBAR= ProgressBar(Title="  Init E-Jones ")#, HeaderSize=10,TitleSize=13)
-        if not progressBar: pBAR.disable()
-        pBAR.render(0, Tm.size)
-        for itime in range(Tm.size):
-            DicoBeam["t0"][itime]=T0s[itime]
-            DicoBeam["t1"][itime]=T1s[itime]
-            DicoBeam["tm"][itime]=Tm[itime]
-            ThisTime=Tm[itime]
-            Beam=self.GiveInstrumentBeam(ThisTime,RA,DEC)
-            #
-            if self.GD["Beam"]["CenterNorm"]==1:
-                Beam0=self.GiveInstrumentBeam(ThisTime,np.array([rac]),np.array([decc]))
-                Beam0inv= ModLinAlg.BatchInverse(Beam0)
-                nd,_,_,_,_=Beam.shape
-                Ones=np.ones((nd, 1, 1, 1, 1),np.float32)
-                Beam0inv=Beam0inv*Ones
-                Beam= ModLinAlg.BatchDot(Beam0inv, Beam)
-                
- 
-            DicoBeam["Jones"][itime]=Beam
-            NDone=itime+1
-            pBAR.render(NDone,Tm.size)
+        DicoBeam["t0"]=T0s
+        DicoBeam["t1"]=T1s
+        DicoBeam["tm"]=Tm
 
-            DicoBeam["Jones"][itime] = Beam
+        if self.BeamEvaluator is not None:
+            DicoBeam["Jones"]=self.BeamEvaluator.evaluate(self.MS, Tm, RA, DEC, FreqDomains.shape[0],
+                                                           progress=progressBar and "Init E-Jones")
+        else:
+            DicoBeam["Jones"]=np.zeros((Tm.size,NDir,self.MS.na,FreqDomains.shape[0],2,2),dtype=np.complex64)
+            pBAR= ProgressBar(Title="  Init E-Jones ")#, HeaderSize=10,TitleSize=13)
+            if not progressBar: pBAR.disable()
+            pBAR.render(0, Tm.size)
+            for itime in range(Tm.size):
+                DicoBeam["Jones"][itime]=self.GiveBeamAtTime(Tm[itime],RA,DEC)
+                NDone=itime+1
+                pBAR.render(NDone,Tm.size)
 
         nt, nd, na, nch, _, _ = DicoBeam["Jones"].shape
 
@@ -625,6 +584,19 @@ class ClassJones():
 
         return DicoBeam
 
+    def GiveBeamAtTime(self, ThisTime, RA, DEC):
+        """Evaluates beam at a single time, normalizing by the beam at the phase centre if CenterNorm is set"""
+        Beam=self.GiveInstrumentBeam(ThisTime,RA,DEC)
+        if self.GD["Beam"]["CenterNorm"]==1:
+            rac,decc=self.MS.OriginalRadec
+            Beam0=self.GiveInstrumentBeam(ThisTime,np.array([rac]),np.array([decc]))
+            Beam0inv= ModLinAlg.BatchInverse(Beam0)
+            nd,_,_,_,_=Beam.shape
+            Ones=np.ones((nd, 1, 1, 1, 1),np.float32)
+            Beam0inv=Beam0inv*Ones
+            Beam= ModLinAlg.BatchDot(Beam0inv, Beam)
+        return Beam
+
     def MergeJones(self, DicoJ0, DicoJ1):
         T0 = DicoJ0["t0"][0]
         DicoOut = {}
@@ -680,3 +652,96 @@ class ClassJones():
             DicoOut["Jones"][itime] = ModLinAlg.BatchDot(G0, G1)
 
         return DicoOut
+
+
+class ClassBeamEvaluator():
+    """
+    Evaluates E-Jones in parallel, by splitting the beam time samples into blocks that are evaluated by a pool of
+    threads in the calling process (normally the I/O worker loading the chunk). This is done locally rather than
+    via the compute workers, so that loading a chunk never has to queue up behind the gridding and degridding jobs.
+    Beam machines are not thread-safe, so one is set up per thread and MS (in the calling thread), and each block
+    borrows one for its exclusive use. The number of threads is set by --Beam-NThreads: by default, the CPUs not
+    taken up by the compute workers are shared out between the I/O processes.
+    """
+    def __init__(self, VS):
+        self.VS = VS
+        # iMS -> queue of ClassJones objects with initialized beam machines, not currently in use
+        self._jones_machines = {}
+        # iMS -> number of beam machines made for that MS
+        self._num_machines = {}
+        self._pool = None
+        self._pid = os.getpid()
+
+    def _numThreads(self):
+        nthreads = self.VS.GD["Beam"]["NThreads"]
+        if not nthreads:
+            nthreads = (psutil.cpu_count() - APP.ncpu) // APP.num_io_processes
+        return max(nthreads, 1)
+
+    def _initJonesMachines(self, iMS, nmachines):
+        """Makes sure there are nmachines beam machines for MS #iMS"""
+        # the pool and the machines belong to the process that created them, so start afresh in forked workers
+        if self._pid != os.getpid():
+            self._pool = None
+            self._jones_machines = {}
+            self._num_machines = {}
+            self._pid = os.getpid()
+        machines = self._jones_machines.setdefault(iMS, Queue.Queue())
+        nmade = self._num_machines.get(iMS, 0)
+        if nmade < nmachines:
+            MyLogger.setSilent(["ClassJones", "ClassLOFARBeam", "ClassFITSBeam"])
+            try:
+                for i in xrange(nmade, nmachines):
+                    JonesMachine = ClassJones(self.VS.GD, self.VS.ListMS[iMS])
+                    JonesMachine.InitBeamMachine()
+                    machines.put(JonesMachine)
+                    self._num_machines[iMS] = i + 1
+            finally:
+                MyLogger.setLoud(["ClassJones", "ClassLOFARBeam", "ClassFITSBeam"])
+        return machines
+
+    def _evaluateBeam_thread(self, args):
+        machines, Jones, itime0, Tm, RA, DEC = args
+        JonesMachine = machines.get()
+        try:
+            for itime, ThisTime in enumerate(Tm):
+                Jones[itime0+itime] = JonesMachine.GiveBeamAtTime(ThisTime, RA, DEC)
+        finally:
+            machines.put(JonesMachine)
+        return Tm.size
+
+    def evaluate(self, MS, Tm, RA, DEC, NChanJones, progress=None):
+        """
+        Evaluates beam of MS (one of VS.ListMS) at times Tm in directions RA, DEC.
+        Returns Jones array of shape [Tm.size,NDir,NAnt,NChanJones,2,2].
+        """
+        iMS = [ ms is MS for ms in self.VS.ListMS ].index(True)
+        Jones = np.zeros((Tm.size, RA.size, MS.na, NChanJones, 2, 2), np.complex64)
+        nthreads = self._numThreads()
+        machines = self._initJonesMachines(iMS, nthreads)
+        if nthreads > 1 and self._pool is None:
+            self._pool = ThreadPool(nthreads)
+        # a few blocks per thread, so that slow time samples do not hold up the rest
+        nblocks = min(Tm.size, nthreads*4)
+        edges = np.int64(np.linspace(0, Tm.size, nblocks+1))
+        blocks = [ (machines, Jones, i0, Tm[i0:i1], RA, DEC) for i0, i1 in zip(edges[:-1], edges[1:]) if i1 > i0 ]
+        pBAR = ProgressBar(Title="  %s " % (progress or "Init E-Jones"))
+        if not progress:
+            pBAR.disable()
+        pBAR.render(0, Tm.size)
+        ndone = 0
+        results = self._pool.imap_unordered(self._evaluateBeam_thread, blocks) if nthreads > 1 else \
+                  itertools.imap(self._evaluateBeam_thread, blocks)
+        for n in results:
+            ndone += n
+            pBAR.render(ndone, Tm.size)
+        return Jones
+
+
+def GiveJonesMatrices(DicoJones):
+    """
+    Given the killMS or Beam entry of a chunk's DATA dict (see ClassJones.InitDDESols()), returns dict of
+    Jones matrices, directions and TimeMapping, as expected by the gridders
+    """
+    store = shared_dict.attach(DicoJones["Store"], readwrite=False)
+    return dict(Jones=store["Jones"], Dirs=store["Dirs"], TimeMapping=DicoJones["TimeMapping"])
@@ -19,6 +19,8 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 '''
 
 import os, re, glob
+import traceback
+import multiprocessing
 import pyrap.measures as pm
 import pyrap.quanta as qa
 from pyrap.tables import table
@@ -34,6 +36,7 @@ log = MyLogger.getLogger("ClassMS")
 from DDFacet.Other import ClassTimeIt
 from DDFacet.Other.CacheManager import CacheManager
 from DDFacet.Array import NpShared
+from DDFacet.Array import ModBaselineSort
 import sidereal
 
 import datetime
@@ -165,13 +168,15 @@ class ClassMS():
         # once.
         self._reset_cache = ResetCache
         self._chunk_caches = {}
-        self.maincache = CacheManager(MSname+".F%d.D%d.ddfcache"%(self.Field, self.DDID), reset=ResetCache, cachedir=self.GD["Cache"]["Dir"], nfswarn=True)
+        codec = self.GD["Cache"]["VisDataCodec"]
+        self.maincache = CacheManager(MSname+".F%d.D%d.ddfcache"%(self.Field, self.DDID), reset=ResetCache, cachedir=self.GD["Cache"]["Dir"], nfswarn=True,
+                                      codec=codec if codec != "none" else None,
+                                      nthreads=self.GD["Parallel"]["NCPU"] or multiprocessing.cpu_count())
 
         self.ReadMSInfo(DoPrint=DoPrint)
         self.LFlaggedStations=[]
         self.DicoSelectOptions = DicoSelectOptions
         self._datapath = self._flagpath = None
-        self._start_time = time.time()
 
         try:
             self.LoadLOFAR_ANTENNA_FIELD()
@@ -527,10 +532,11 @@ class ClassMS():
     def getChunkCache (self, row0, row1):
         return self._chunk_caches[row0, row1]
 
-    def GiveChunk (self, DATA, chunk, use_cache=None, read_data=True, sort_by_baseline=False):
+    def GiveChunk (self, DATA, chunk, use_cache=None, read_data=True, sort_by_baseline=False, residual_path=None):
         row0, row1 = self._chunk_r0r1[chunk]
         self.cache = self.getChunkCache(row0, row1)
-        return self.ReadData(DATA, row0, row1, use_cache=use_cache, read_data=read_data, sort_by_baseline=sort_by_baseline)
+        return self.ReadData(DATA, row0, row1, use_cache=use_cache, read_data=read_data, sort_by_baseline=sort_by_baseline,
+                             residual_path=residual_path)
 
     def GiveNextChunk(self, use_cache=None, read_data=True, sort_by_baseline=False):
         # release data/flag arrays, if holding them, and mark cache as valid
@@ -556,7 +562,7 @@ class ClassMS():
     def ReadData(self,DATA,row0,row1,
                  ReadWeight=False,
                  use_cache=False, read_data=True,
-                 sort_by_baseline=True):
+                 sort_by_baseline=True, residual_path=None):
         """
         Args:
             row0:
@@ -567,6 +573,9 @@ class ClassMS():
             flagbuf: a buffer to read flags into. If None, a new array is created.
             read_data: if False, visibilities will not be read, only flags and other data
             sort_by_baseline: if True, sorts rows in baseline-time order
+            residual_path: if set, residual visibilities saved by a previous major cycle (see
+                ClassVisServer.startResidualSaveInBackground()) are read from this cache element instead of
+                the data. DATA["IsResidual"] tells whether this succeeded.
         Returns:
             DATA dictionary containing all read elements
         """
@@ -591,13 +600,10 @@ class ClassMS():
         if use_cache:
             # In force-cache mode, cache has no keys, so use it if it exists (i.e. if we have visibilities
             # cached from previous run)
-            # In auto cache mode, cache key is the start time of the process. The cache is thus reset when first
-            # touched, so we read the MS on the first major cycle, and cache subsequently.
-            cache_key = dict(time=self._start_time)
-
-            # @o-smirnov: why not that?
-            # cache_key = dict(data=self.GD["Data"])
-            metadata_path, metadata_valid = self.cache.checkCache("A0A1UVWT.npz", cache_key, ignore_key=(use_cache=="force"))
+            # In auto cache mode, cache keys are formed from fingerprints of the columns read, plus the relevant
+            # selection options. The cache thus remains valid across runs for as long as the MS is unchanged.
+            metadata_key = self._getMetadataCacheKey(sort_by_baseline)
+            metadata_path, metadata_valid = self.cache.checkCache("A0A1UVWT.npz", metadata_key, ignore_key=(use_cache=="force"))
         else:
             metadata_valid = False
         # if cache is valid, we're all good
@@ -609,6 +615,13 @@ class ClassMS():
                 sort_index = None
             if not dot_uvw.size:
                 dot_uvw = None
+            # older caches do not have the baseline offsets, so recompute them from the sorted antennas
+            if sort_index is None:
+                bl_offsets = None
+            elif "BL_OFFSETS" in npz.files:
+                bl_offsets = npz["BL_OFFSETS"]
+            else:
+                bl_offsets = ModBaselineSort.GiveBaselineOffsets(A0, A1)
         else:
             table_all = table_all or self.GiveMainTable()
             # SPW=table_all.getcol('DATA_DESC_ID',row0,nRowRead)
@@ -622,15 +635,14 @@ class ClassMS():
             if sort_by_baseline:
                 # make sort index
                 print>>log,"sorting by baseline-time"
-                sortby = sorted(zip(A0, A1, time_all, range(nRowRead)))
-                sort_index = np.array([ s[3] for s in sortby ])
-                print>>log,"applying sort index to metadata rows"
+                sort_index, bl_offsets = ModBaselineSort.GiveSortIndex(A0, A1, time_all)
+                print>>log,"applying sort index to metadata rows (%d baselines)" % (bl_offsets.size-1)
                 A0 = A0[sort_index]
                 A1 = A1[sort_index]
                 uvw = uvw[sort_index]
                 time_all = time_all[sort_index]
             else:
-                sort_index = None
+                sort_index = bl_offsets = None
             time_uniq = np.array(sorted(set(time_all)))
             dot_uvw = None
 
@@ -642,29 +654,40 @@ class ClassMS():
             DATA["weights"] = weights
 
         #self.RotateType=["uvw","vis"]
+        # reverse of sort_index, computed on demand when reading sorted columns
+        reverse_index = None
 
         DATA["uvw"]   = uvw
         visdata = DATA.addSharedArray("data", shape=datashape, dtype=np.complex64)
-        if read_data:
+        DATA["IsResidual"] = False
+        if read_data and residual_path:
+            print>> log, "reading cached residual visibilities from %s" % residual_path
+            DATA["IsResidual"] = os.path.exists(residual_path) and self.cache.loadArrayInto(residual_path, visdata)
+            if not DATA["IsResidual"]:
+                print>> log, ModColor.Str("cached residuals %s are not valid for this chunk, ignoring" % residual_path)
+        if read_data and not DATA["IsResidual"]:
             # check cache for visibilities
             if use_cache:
-                datapath, datavalid = self.cache.checkCache("Data.npy", dict(time=self._start_time), ignore_key=(use_cache=="force"))
+                data_element = self.cache.getArrayElementName("Data")
+                datapath, datavalid = self.cache.checkCache(data_element, self._getDataCacheKey(metadata_key),
+                                                            ignore_key=(use_cache=="force"))
             else:
                 datavalid = False
-            # read from cache if available, else from MS
+            # read from cache if available, else from MS. The cache is read (or decompressed) directly
+            # into the shared array
             if datavalid:
                 print>> log, "reading cached visibilities from %s" % datapath
-                visdata[...] = np.load(datapath)
+                datavalid = self.cache.loadArrayInto(datapath, visdata)
+                if not datavalid:
+                    print>> log, ModColor.Str("cached visibilities %s do not match this chunk, ignoring" % datapath)
                 #self.RotateType=["uvw"]
-            else:
+            if not datavalid:
                 print>> log, "reading MS visibilities from column %s" % self.ColName
                 table_all = table_all or self.GiveMainTable()
                 if sort_index is not None:
-                    visdata1 = np.ndarray(shape=datashape, dtype=np.complex64)
-                    table_all.getcolslicenp(self.ColName, visdata1, self.cs_tlc, self.cs_brc, self.cs_inc, row0, nRowRead)
-                    print>>log,"sorting visibilities"
-                    visdata[...] = visdata1[sort_index]
-                    del visdata1
+                    reverse_index = ModBaselineSort.GiveReverseIndex(sort_index)
+                    print>>log,"reading visibilities in baseline-time order"
+                    self._getSortedColumn(table_all, self.ColName, visdata, row0, nRowRead, reverse_index)
                 else:
                     table_all.getcolslicenp(self.ColName, visdata, self.cs_tlc, self.cs_brc, self.cs_inc, row0, nRowRead)
                 if self._reverse_channel_order:
@@ -675,35 +698,51 @@ class ClassMS():
 
                 if use_cache:
                     print>> log, "caching visibilities to %s" % datapath
-                    np.save(datapath, visdata)
-                    self.cache.saveCache("Data.npy")
+                    self.cache.saveArray(datapath, visdata)
+                    self.cache.saveCache(data_element)
         # create flag array (if flagbuf is not None, array uses memory of buffer)
         flags = DATA.addSharedArray("flags", shape=datashape, dtype=np.bool)
         # check cache for flags
         if use_cache:
-            flagpath, flagvalid = self.cache.checkCache("Flags.npy", dict(time=self._start_time), ignore_key=(use_cache=="force"))
+            flag_element = self.cache.getArrayElementName("Flags", packbool=True)
+            # flags are cached after UpdateFlags(), so depend on the data and the selection options as well
+            flag_key = self._getDataCacheKey(metadata_key)
+            flag_key.update(Flags=self.getCacheKey("FLAG")["Columns"], Selection=self.DicoSelectOptions)
+            flagpath, flagvalid = self.cache.checkCache(flag_element, flag_key, ignore_key=(use_cache=="force"))
         else:
             flagvalid = False
-        # read from cache if available, else from MS
+        # read from cache if available, else from MS. Flags are cached bit-packed
         if flagvalid:
             print>> log, "reading cached flags from %s" % flagpath
-            flags[...] = np.load(flagpath)
-        else:
+            flagvalid = self.cache.loadArrayInto(flagpath, flags, packbool=True)
+            if not flagvalid:
+                print>> log, ModColor.Str("cached flags %s do not match this chunk, ignoring" % flagpath)
+        if not flagvalid:
+            # the imaging weights pass may have already read the FLAG column for us (see ReadUVWFlags())
+            rawflagvalid = False
+            if use_cache:
+                rawflag_element = self.cache.getArrayElementName("RawFlags", packbool=True)
+                rawflagpath, rawflagvalid = self.cache.checkCache(rawflag_element, self._getRawFlagCacheKey(metadata_key),
+                                                                  ignore_key=(use_cache=="force"))
+            if rawflagvalid:
+                print>> log, "reading MS flags stored by the weights pass from %s" % rawflagpath
+                rawflagvalid = self.cache.loadArrayInto(rawflagpath, flags, packbool=True)
+        if not flagvalid and not rawflagvalid:
             print>> log, "reading MS flags from column FLAG"
             table_all = table_all or self.GiveMainTable()
             if sort_index is not None:
-                flags1 = table_all.getcolslice("FLAG", self.cs_tlc, self.cs_brc, self.cs_inc, row0, nRowRead)
-                print>> log, "sorting flags"
-                flags[...] = flags1[sort_index]
-                del flags1
-
+                if reverse_index is None:
+                    reverse_index = ModBaselineSort.GiveReverseIndex(sort_index)
+                print>> log, "reading flags in baseline-time order"
+                self._getSortedColumn(table_all, "FLAG", flags, row0, nRowRead, reverse_index)
             else:
                 table_all.getcolslicenp("FLAG", flags, self.cs_tlc, self.cs_brc, self.cs_inc, row0, nRowRead)
+        if not flagvalid:
             self.UpdateFlags(flags, uvw, visdata, A0, A1, time_all)
             if use_cache:
                 print>> log, "caching flags to %s" % flagpath
-                np.save(flagpath, flags)
-                self.cache.saveCache("Flags.npy")
+                self.cache.saveArray(flagpath, flags, packbool=True)
+                self.cache.saveCache(flag_element)
         if table_all:
             table_all.close()
 
@@ -711,9 +750,13 @@ class ClassMS():
         #table_all.close()
         #del(table_all)
         DecorrMode=self.GD["RIME"]["DecorrMode"]
+        # set if the cached metadata lacks DOT_UVW (e.g. as filled in by ReadUVWFlags() for a run
+        # without decorrelation), so that it is rewritten below
+        dot_uvw_computed = False
         if 'F' in DecorrMode or "T" in DecorrMode:
             if dot_uvw is None:
-                dot_uvw = self.ComputeDotUVW(A0, A1, time_all, uvw)
+                dot_uvw = self.ComputeDotUVW(A0, A1, time_all, uvw, bl_offsets=bl_offsets)
+                dot_uvw_computed = True
             DATA["uvw_dt"] = dot_uvw
             # if 'UVWDT' not in ColNames:
             #     print>>log,"Adding dot-uvw info to main table: %s"%self.MSName
@@ -728,6 +771,8 @@ class ClassMS():
         DATA["lm_PhaseCenter"] = self.lm_PhaseCenter
 
         DATA["sort_index"] = sort_index
+        # row offsets of each baseline in sorted order (None if not sorting), see ModBaselineSort
+        DATA["bl_offsets"] = bl_offsets
 
         DATA["times"] = time_all
         DATA["uniq_times"] = time_uniq   # vector of unique timestamps
@@ -748,11 +793,9 @@ class ClassMS():
             self.Rotate(DATA,RotateType=["uvw"])
 
         # save cache
-        if use_cache and not metadata_valid:
-            np.savez(metadata_path,A0=A0,A1=A1,UVW=uvw,TIME=time_all,TIME_UNIQ=time_uniq,
-                     SORT_INDEX=sort_index if sort_index is not None else np.array([]),
-                     DOT_UVW=dot_uvw if dot_uvw is not None else np.array([]))
-            self.cache.saveCache("A0A1UVWT.npz")
+        if use_cache and (not metadata_valid or
+                          (dot_uvw_computed and use_cache != "force" and self.ToRADEC is None)):
+            self._saveMetadataCache(self.cache, metadata_path, A0, A1, uvw, time_all, time_uniq, sort_index, bl_offsets, dot_uvw)
 
 
         # if self.AverageSteps is not None:
@@ -762,6 +805,129 @@ class ClassMS():
         return DATA
             
 
+    def _getMetadataCacheKey(self, sort_by_baseline):
+        """Returns cache key for the A0A1UVWT.npz chunk cache element"""
+        metadata_key = self.getCacheKey("ANTENNA1", "ANTENNA2", "TIME", "UVW")
+        metadata_key.update(Sort=sort_by_baseline, ToRADEC=self.ToRADEC)
+        return metadata_key
+
+    def _getRawFlagCacheKey(self, metadata_key):
+        """Returns cache key for flags as read from the FLAG column (i.e. before UpdateFlags()), given the cache key of the metadata"""
+        key = metadata_key.copy()
+        key.update(Flags=self.getCacheKey("FLAG")["Columns"],
+                   ChanSelection=(self.cs_tlc, self.cs_brc, self.cs_inc))
+        return key
+
+    @staticmethod
+    def _saveMetadataCache(cache, path, A0, A1, uvw, time_all, time_uniq, sort_index, bl_offsets, dot_uvw):
+        """
+        Saves metadata to the A0A1UVWT.npz element of the given chunk cache. The file is written under a temporary
+        name and renamed, since the weights pass and ReadData() may both be filling in the same chunk cache.
+        """
+        savez = np.savez_compressed if cache.codec else np.savez
+        tmppath = "%s.%d.tmp.npz" % (path[:-4], os.getpid())
+        savez(tmppath,A0=A0,A1=A1,UVW=uvw,TIME=time_all,TIME_UNIQ=time_uniq,
+              SORT_INDEX=sort_index if sort_index is not None else np.array([]),
+              BL_OFFSETS=bl_offsets if bl_offsets is not None else np.array([]),
+              DOT_UVW=dot_uvw if dot_uvw is not None else np.array([]))
+        os.rename(tmppath, path)
+        cache.saveCache("A0A1UVWT.npz")
+
+    def ReadUVWFlags(self, row0, row1, use_cache=False, sort_by_baseline=True):
+        """
+        Reads the UVW and FLAG columns of rows row0:row1, in MS order, for the imaging weights pass
+        (see ClassVisServer._loadWeights_handler()). If use_cache is set, the metadata and the flags (as read,
+        before UpdateFlags()) are also stored in the chunk cache, in the form ReadData() expects, so that the
+        ReadData() of the chunk does not need to read UVW and FLAG again.
+        Returns:
+            tuple of (table, uvw, flags), where flags has shape (nrow,nchan,ncorr). The table is left open,
+            so that the caller can go on to read the weights.
+        """
+        nrows = row1 - row0
+        table_all = self.GiveMainTable()
+        uvw = table_all.getcol("UVW", row0, nrows)
+        flags = np.empty((nrows, len(self.ChanFreq), len(self.CorrelationIds)), np.bool)
+        table_all.getcolslicenp("FLAG", flags, self.cs_tlc, self.cs_brc, self.cs_inc, row0, nrows)
+        # in force-cache mode, the caches are used as they are and are not to be refilled. With a phase
+        # shift, ReadData() caches rotated UVWs, which we can't provide here.
+        if use_cache and use_cache != "force" and self.ToRADEC is None:
+            try:
+                self._fillChunkCache(table_all, row0, row1, uvw, flags, sort_by_baseline)
+            except:
+                print>> log, traceback.format_exc()
+                print>> log, ModColor.Str("failed to save metadata and flags to chunk cache, ignoring")
+        return table_all, uvw, flags
+
+    def _fillChunkCache(self, table_all, row0, row1, uvw, flags, sort_by_baseline):
+        """Helper for ReadUVWFlags(): stores metadata and raw flags in the chunk cache (if not already there)"""
+        cache = self.getChunkCache(row0, row1)
+        nrows = row1 - row0
+        metadata_key = self._getMetadataCacheKey(sort_by_baseline)
+        metadata_path, metadata_valid = cache.checkCache("A0A1UVWT.npz", metadata_key)
+        rawflag_element = cache.getArrayElementName("RawFlags", packbool=True)
+        rawflag_path, rawflag_valid = cache.checkCache(rawflag_element, self._getRawFlagCacheKey(metadata_key))
+        if metadata_valid:
+            if rawflag_valid:
+                return
+            sort_index = np.load(metadata_path)["SORT_INDEX"]
+            if not sort_index.size:
+                sort_index = None
+        else:
+            A0 = table_all.getcol('ANTENNA1', row0, nrows)
+            A1 = table_all.getcol('ANTENNA2', row0, nrows)
+            time_all = table_all.getcol('TIME', row0, nrows)
+            if sort_by_baseline:
+                sort_index, bl_offsets = ModBaselineSort.GiveSortIndex(A0, A1, time_all)
+                A0, A1, time_all = A0[sort_index], A1[sort_index], time_all[sort_index]
+                sorted_uvw = uvw[sort_index]
+            else:
+                sort_index = bl_offsets = None
+                sorted_uvw = uvw
+            # ReadData() will need DOT_UVW for decorrelation, so compute it here as well
+            DecorrMode = self.GD["RIME"]["DecorrMode"]
+            if 'F' in DecorrMode or "T" in DecorrMode:
+                dot_uvw = self.ComputeDotUVW(A0, A1, time_all, sorted_uvw, bl_offsets=bl_offsets)
+            else:
+                dot_uvw = None
+            self._saveMetadataCache(cache, metadata_path, A0, A1, sorted_uvw, time_all, np.unique(time_all),
+                                    sort_index, bl_offsets, dot_uvw)
+        if not rawflag_valid:
+            tmppath = "%s.%d.tmp" % (rawflag_path, os.getpid())
+            cache.saveArray(tmppath, flags[sort_index] if sort_index is not None else flags, packbool=True)
+            os.rename(tmppath, rawflag_path)
+            cache.saveCache(rawflag_element)
+
+    def _getDataCacheKey(self, metadata_key):
+        """Returns cache key for visibilities read from the data column, given the cache key of the metadata"""
+        key = metadata_key.copy()
+        key.update(Data=self.getCacheKey(self.ColName)["Columns"],
+                   ChanSelection=(self.cs_tlc, self.cs_brc, self.cs_inc))
+        return key
+
+    def _sortTileRows(self, rowshape, dtype, nrow):
+        """Returns number of rows per tile for blockwise sorted column reads/writes (see --Data-SortTileMB)"""
+        tile_mb = self.GD["Data"]["SortTileMB"]
+        if not tile_mb:
+            return max(nrow, 1)
+        rowsize = np.dtype(dtype).itemsize*int(np.prod(rowshape))
+        return max(int(tile_mb*2**20)//rowsize, 1)
+
+    def _getSortedColumn(self, table, colname, out, row0, nrow, reverse_index):
+        """
+        Reads column slice of rows row0:row0+nrow into array out, permuting rows into sorted order.
+        Rows are read in tiles of bounded size and scattered straight into out, so no full-size
+        temporary array is needed.
+        Args:
+            reverse_index: index mapping MS row (relative to row0) to sorted row
+        """
+        tile_rows = self._sortTileRows(out.shape[1:], out.dtype, nrow)
+        buf = np.empty((min(tile_rows, nrow),)+out.shape[1:], out.dtype)
+        for r0 in xrange(0, nrow, tile_rows):
+            n = min(tile_rows, nrow-r0)
+            tile = buf[:n]
+            table.getcolslicenp(colname, tile, self.cs_tlc, self.cs_brc, self.cs_inc, row0+r0, n)
+            out[reverse_index[r0:r0+n]] = tile
+
     def GiveAverageTimeFreq(self,DicoData,StepTime=None,StepFreq=None):
         DicoDataOut={}
         DicoDataOut["A0"]=DicoData["A0"]
@@ -895,11 +1061,41 @@ class ClassMS():
         self.nbl=(na*(na-1))/2+na
         
 
+    def _readColumnFingerprints(self):
+        """
+        Fingerprints the columns of the main table, for use in cache keys. The fingerprint of a column is
+        given by the sizes and mtimes of the files of its data manager, so it is cheap to compute, and
+        changes whenever the column is written to.
+        """
+        t = table(self.MSName, ack=False)
+        self._table_nrows = t.nrows()
+        self._column_fingerprints = {}
+        for colname in t.colnames():
+            try:
+                seqnr = t.getdminfo(colname)["SEQNR"]
+            except Exception:
+                continue
+            files = [ path for path in glob.glob("%s/table.f%d*" % (self.MSName, seqnr))
+                      if re.match(r"table\.f%d(\D|$)" % seqnr, os.path.basename(path)) ]
+            self._column_fingerprints[colname] = CacheManager.getFileFingerprint(*sorted(files))
+        t.close()
+
+    def getCacheKey(self, *colnames):
+        """
+        Returns cache key identifying this MS selection, and the contents of the given columns.
+        Missing columns have a fingerprint of None.
+        """
+        return dict(MS=self.MSName, TaQL=self.TaQL, TableRows=self._table_nrows,
+                    Columns=dict([ (colname, self._column_fingerprints.get(colname)) for colname in colnames ]))
+
     def ReadMSInfo(self,DoPrint=True):
         T= ClassTimeIt.ClassTimeIt()
         T.enableIncr()
         T.disable()
 
+        # fingerprint columns for cache keys
+        self._readColumnFingerprints()
+
         # open main table
         table_all = self.GiveMainTable()
         self.empty = not table_all.nrows()
@@ -974,9 +1170,11 @@ class ClassMS():
         for row0, row1 in self._chunk_r0r1:
             # note that we don't need to reset the chunk cache -- the top-level MS cache would already have been reset,
             # being the parent directory
-            self._chunk_caches[row0, row1] = CacheManager(
+            self._chunk_caches[row0, row1] = cache = CacheManager(
                 os.path.join(self.maincache.dirname, "R%d:%d" % (row0, row1)),
-                reset=False)
+                reset=False, codec=self.maincache.codec, nthreads=self.maincache.nthreads, root=self.maincache.root)
+            # leases are taken out again by whichever process goes on to use the chunk (see ClassVisServer)
+            cache.release()
 
         #SPW=table_all.getcol('DATA_DESC_ID')
         # if self.SelectSPW is not None:
@@ -1249,24 +1447,28 @@ class ClassMS():
             vis = vis[:,::-1,:]
         print>>log, "writing column %s rows %d:%d"%(colname,row0,row1)
         t = self.GiveMainTable(readonly=False, ack=False)
-        # if sorting rows, rearrange vis array back into MS order
-        # if not sorting, then using slice(None) for row has no effect
+        # if sorting rows, rearrange vis array back into MS order, one tile of MS rows at a time,
+        # so that no full-size reordered copy of the array is made
         if sort_index is not None:
-            reverse_index = np.empty(self.nRowRead,dtype=int)
-            reverse_index[sort_index] = np.arange(0,nrow,dtype=int)
-        else:
-            reverse_index = slice(None)
-        if self.ChanSlice and self.ChanSlice != slice(None):
-            # if getcol fails, maybe because this is a new col which hasn't been filled
-            # in this case read DATA instead
-            try:
-                vis0 = t.getcol(colname, row0, nrow)
-            except RuntimeError:
-                vis0 = t.getcol("DATA", row0, snrow)
-            vis0[reverse_index, self.ChanSlice, :] = vis
-            t.putcol(colname, vis0, row0, now)
+            reverse_index = ModBaselineSort.GiveReverseIndex(sort_index)
+            tile_rows = self._sortTileRows(vis.shape[1:], vis.dtype, nrow)
         else:
-            t.putcol(colname, vis[reverse_index,:,:], row0, nrow)
+            reverse_index = None
+            tile_rows = max(nrow, 1)
+        for r0 in xrange(0, nrow, tile_rows):
+            n = min(tile_rows, nrow-r0)
+            rows = reverse_index[r0:r0+n] if reverse_index is not None else slice(r0, r0+n)
+            if self.ChanSlice and self.ChanSlice != slice(None):
+                # if getcol fails, maybe because this is a new col which hasn't been filled
+                # in this case read DATA instead
+                try:
+                    vis0 = t.getcol(colname, row0+r0, n)
+                except RuntimeError:
+                    vis0 = t.getcol("DATA", row0+r0, n)
+                vis0[:, self.ChanSlice, :] = vis[rows]
+                t.putcol(colname, vis0, row0+r0, n)
+            else:
+                t.putcol(colname, vis[rows], row0+r0, n)
         t.close()
 
     def SaveVis(self,vis=None,Col="CORRECTED_DATA",spw=0,DoPrint=True):
@@ -1487,7 +1689,10 @@ class ClassMS():
         #self.PutNewCol("CORRECTED_DATA")
         #self.PutNewCol("MODEL_DATA")
 
-    def ComputeDotUVW (self, A0, A1, times, UVW):
+    def ComputeDotUVW (self, A0, A1, times, UVW, bl_offsets=None):
+        # rows already in baseline-time order: use the baseline offsets computed by the sort
+        if bl_offsets is not None:
+            return ModBaselineSort.GiveDotUVW(UVW, times, bl_offsets)
         na = self.na
         UVW_dt = np.zeros(UVW.shape, np.float64)
         pBAR = ProgressBar(Title=" Calc dUVW/dt ")
@@ -20,9 +20,9 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
 import numpy as np
 import math
-import itertools
 from DDFacet.Other import MyLogger
 from DDFacet.Array import NpShared
+from DDFacet.Array import ModBaselineSort
 log = MyLogger.getLogger("ClassSmearMapping")
 
 from DDFacet.Other import Multiprocessing, ClassTimeIt
@@ -31,64 +31,120 @@ from DDFacet.Other.AsyncProcessPool import APP
 
 bda_dicts = {}
 
+# baselines are batched into roughly this many jobs per CPU, of roughly equal row counts
+JOBS_PER_CPU = 4
+
 class SmearMappingMachine (object):
     def __init__ (self, name=None, mode=2):
         self.name = name or "SMM.%x"%id(self)
         APP.registerJobHandlers(self)
         self._job_counter = APP.createJobCounter(self.name)
-        self._data = self._blockdict = self._sizedict = None
+        self._outdict = None
+        self._pending = set()
+        self._njobs = self._nbatches = 0
 
-    def _smearmapping_worker(self, DATA, blockdict, sizedict, a0, a1, dPhi, l, channel_mapping, mode):
+    def _smearmapping_worker(self, DATA, groups, outdict, ibatch, bl0, bl1, specs, mode, row_ranges):
+        """Computes all requested mappings for baselines bl0:bl1 (in the order given by groups["bl_offsets"])"""
         t = ClassTimeIt.ClassTimeIt()
         t.disable()
-        if mode == 1:
-            BlocksRowsListBL, BlocksSizesBL, _ = GiveBlocksRowsListBL_old(a0, a1, DATA, dPhi, l, channel_mapping)
-        elif mode == 2:
-            BlocksRowsListBL, BlocksSizesBL, _ = GiveBlocksRowsListBL(a0, a1, DATA, dPhi, l, channel_mapping)
-        else:
-            raise ValueError("unknown BDAMode setting %d"%mode)
-
+        A0, A1 = DATA["A0"], DATA["A1"]
+        bl_offsets = groups["bl_offsets"]
+        row_index = groups.get("row_index")
+        # per-spec lists of block sizes and block lists, and per-spec caches of channel cuts
+        sizes = [ [] for spec in specs ]
+        blocks = [ [] for spec in specs ]
+        chan_cuts = [ {} for spec in specs ]
+        for ibl in xrange(bl0, bl1):
+            r0, r1 = bl_offsets[ibl], bl_offsets[ibl+1]
+            rows = np.arange(r0, r1) if row_index is None else row_index[r0:r1]
+            a0, a1 = A0[rows[0]], A1[rows[0]]
+            if a0 == a1:
+                continue
+            uvw = DATA["uvw"][rows]
+            for ispec, (field, dPhi, l, channel_mapping) in enumerate(specs):
+                if mode == 1:
+                    BlocksRowsListBL, BlocksSizesBL, _ = GiveBlocksRowsListBL_old(a0, a1, DATA, dPhi, l, channel_mapping, ind=rows)
+                    BlocksSizesBL, BlocksRowsListBL = np.array(BlocksSizesBL, np.int32), np.array(BlocksRowsListBL, np.int32)
+                else:
+                    BlocksSizesBL, BlocksRowsListBL = GiveBlocksRowsBL(rows, uvw, DATA["dfreqs"], DATA["freqs"],
+                                                                       dPhi, l, channel_mapping, chan_cuts[ispec],
+                                                                       row_ranges=row_ranges)
+                sizes[ispec].append(BlocksSizesBL)
+                blocks[ispec].append(BlocksRowsListBL)
         t.timeit('compute')
-        if BlocksRowsListBL is not None:
-            key = "%d:%d" % (a0,a1)
-            sizedict[key]  = np.array(BlocksSizesBL)
-            blockdict[key] = np.array(BlocksRowsListBL)
-            t.timeit('store')
-
-    def computeSmearMappingInBackground (self, base_job_id, MS, DATA, radiusDeg, Decorr, channel_mapping, mode):
-        l = radiusDeg * np.pi / 180
-        dPhi = np.sqrt(6. * (1. - Decorr))
+        for ispec, (field, _, _, _) in enumerate(specs):
+            if sizes[ispec]:
+                outdict["%s:sizes:%d" % (field, ibatch)] = np.concatenate(sizes[ispec])
+                outdict["%s:blocks:%d" % (field, ibatch)] = np.concatenate(blocks[ispec])
+        t.timeit('store')
+
+    def computeSmearMappingInBackground (self, base_job_id, MS, DATA, mappings, mode, row_ranges=False):
+        """
+        Starts computing BDA mappings in the background. Rows are grouped by baseline once (or the
+        grouping of a baseline-sorted chunk is reused), and each job computes all requested mappings
+        for a batch of baselines.
+
+        Args:
+            mappings: list of (field, radiusDeg, Decorr, channel_mapping) tuples, one per mapping
+                      (e.g. "BDA.Grid", "BDA.Degrid"). Each mapping is then retrieved with
+                      collectSmearMapping(DATA, field).
+            mode:     BDAMode setting
+            row_ranges: if True, contiguous blocks of rows are stored as row ranges (see GiveBlocksRowsBL()).
+                      Only supported in mode 2.
+        """
+        if mode not in (1, 2):
+            raise ValueError("unknown BDAMode setting %d"%mode)
+        specs = [ (field, np.sqrt(6. * (1. - Decorr)), radiusDeg * np.pi / 180, channel_mapping)
+                  for field, radiusDeg, Decorr, channel_mapping in mappings ]
+        self._pending = set([ spec[0] for spec in specs ])
+        self._njobs = self._nbatches = 0
+        if not specs:
+            return
         # create new empty shared dicts for results
         self._outdict = shared_dict.create("%s:%s:tmp" %(DATA.path, self.name))
-        blockdict = self._outdict.addSubdict("blocks")
-        sizedict  = self._outdict.addSubdict("sizes")
-        self._nbl = 0
-        for a0 in xrange(MS.na):
-            for a1 in xrange(MS.na):
-                if a0 != a1:
-                    self._nbl += 1
-                    APP.runJob("%s:%s:%d:%d" % (base_job_id, self.name, a0, a1), self._smearmapping_worker,
-                               counter=self._job_counter, collect_result=False,
-                               args=(DATA.readonly(), blockdict.writeonly(), sizedict.writeonly(), a0, a1, dPhi, l,
-                                     channel_mapping, mode))
-
-
+        groups = self._outdict.addSubdict("groups")
+        results = self._outdict.addSubdict("results")
+        bl_offsets = DATA.get("bl_offsets")
+        if bl_offsets is None or not bl_offsets.size:
+            row_index, bl_offsets = ModBaselineSort.GiveBaselineGroups(DATA["A0"], DATA["A1"])
+            groups["row_index"] = row_index
+        groups["bl_offsets"] = bl_offsets
+        # batch up baselines into jobs of roughly equal row counts
+        nbl = bl_offsets.size - 1
+        rows_per_job = max(bl_offsets[-1] // (APP.ncpu * JOBS_PER_CPU), 1)
+        jobs = []
+        costs = []
+        bl0 = 0
+        for bl1 in xrange(1, nbl+1):
+            if bl_offsets[bl1] - bl_offsets[bl0] >= rows_per_job or bl1 == nbl:
+                ibatch = len(jobs)
+                jobs.append(("%s:%s:%d" % (base_job_id, self.name, ibatch),
+                             (DATA.readonly(), groups.readonly(), results.writeonly(), ibatch, bl0, bl1, specs, mode,
+                              row_ranges)))
+                costs.append(bl_offsets[bl1] - bl_offsets[bl0])
+                bl0 = bl1
+        self._njobs = self._nbatches = len(jobs)
+        APP.runJobs(jobs, self._smearmapping_worker, counter=self._job_counter, costs=costs, collect_result=False)
 
     def collectSmearMapping (self, DATA, field):
-        APP.awaitJobCounter(self._job_counter, progress="Mapping %s"%self.name, total=self._nbl, timeout=1)
+        """
+        Waits for the mappings started by computeSmearMappingInBackground() to complete, and
+        populates DATA[field] with the given mapping. Returns mapping, compression factor tuple.
+        """
+        if field not in self._pending:
+            raise RuntimeError("BDA mapping %s was not computed. This is a bug." % field)
+        if self._njobs:
+            APP.awaitJobCounter(self._job_counter, progress="Mapping %s"%self.name, total=self._njobs, timeout=1)
+            self._njobs = 0
         self._outdict.reload()
-        blockdict = self._outdict["blocks"]
-        sizedict  = self._outdict["sizes"]
-        # process worker results
-        # for each map (each array returned from worker), BlockSizes[MapName] will
-        # contain a list of BlocksSizesBL entries returned from that worker
-        NTotBlocks = 0
-        NTotRows = 0
+        results = self._outdict["results"]
+        # results are per batch of baselines, batches are in baseline order
+        keys = [ i for i in xrange(self._nbatches) if "%s:sizes:%d" % (field, i) in results ]
+        sizes = [ results["%s:sizes:%d" % (field, i)] for i in keys ]
+        blocks = [ results["%s:blocks:%d" % (field, i)] for i in keys ]
 
-        for key in sizedict.iterkeys():
-            bsz = sizedict[key]
-            NTotBlocks += len(bsz)
-            NTotRows += bsz.sum()
+        NTotBlocks = sum([ bsz.size for bsz in sizes ])
+        NTotRows = sum([ blk.size for blk in blocks ])
 
         mapping = DATA.addSharedArray(field, (2 + NTotBlocks + NTotRows,), np.int32)
 
@@ -98,32 +154,25 @@ class SmearMappingMachine (object):
         FinalMappingSizes = mapping[2:2+NTotBlocks]
         FinalMapping = mapping[2+NTotBlocks:]
 
-
         iii = 0
         jjj = 0
-
-        # now go through each per-baseline mapping, sorted by baseline
-        for key in sizedict.iterkeys():
-            BlocksSizesBL = sizedict[key]
-            BlocksRowsListBL = blockdict[key]
-
-            FinalMapping[iii:iii+BlocksRowsListBL.size] = BlocksRowsListBL[:]
+        for BlocksSizesBL, BlocksRowsListBL in zip(sizes, blocks):
+            FinalMapping[iii:iii+BlocksRowsListBL.size] = BlocksRowsListBL
             iii += BlocksRowsListBL.size
-
-            # print "IdWorker,AppendId",IdWorker,AppendId,BlocksSizesBL
-            # MM=np.concatenate((MM,BlocksSizesBL))
-            FinalMappingSizes[jjj:jjj+BlocksSizesBL.size] = BlocksSizesBL[:]
+            FinalMappingSizes[jjj:jjj+BlocksSizesBL.size] = BlocksSizesBL
             jjj += BlocksSizesBL.size
 
-        NVis = np.where(DATA["A0"] != DATA["A1"])[0].size * DATA["freqs"].size
+        NVis = np.count_nonzero(DATA["A0"] != DATA["A1"]) * DATA["freqs"].size
         #print>>log, "  Number of blocks:         %i"%NTotBlocks
         #print>>log, "  Number of 4-Visibilities: %i"%NVis
         fact = (100.*(NVis-NTotBlocks)/float(NVis))
 
-        # clear temp shared arrays/dicts
-        del sizedict
-        del blockdict
-        self._outdict.delete()
+        # clear temp shared arrays/dicts once all mappings are collected
+        del sizes, blocks, results
+        self._pending.discard(field)
+        if not self._pending:
+            self._outdict.delete()
+            self._outdict = None
 
         return mapping, fact
 
@@ -338,150 +387,178 @@ class ClassSmearMapping():
         return OutputMapping, fact
 
 
-def GiveBlocksRowsListBL(a0, a1, DATA, dPhi, l, GridChanMapping):
-
+def GiveBaselineRows(a0, a1, DATA):
+    """Returns index of rows belonging to baseline a0:a1. If the chunk was sorted by baseline, looks
+    up the per-baseline row offsets computed by the sort, else falls back to scanning the antenna columns."""
     A0 = DATA["A0"]
     A1 = DATA["A1"]
-    row_index = np.where((A0 == a0) & (A1 == a1))[0]
+    bl_offsets = DATA.get("bl_offsets")
+    if bl_offsets is None:
+        return np.where((A0 == a0) & (A1 == a1))[0]
+    slc = ModBaselineSort.GiveBaselineSlice(A0, A1, bl_offsets, a0, a1, na=DATA.get("na"))
+    if slc is None:
+        return np.array([], np.int64)
+    return np.arange(slc.start, slc.stop)
+
+def GiveChannelCuts(sizeChanBlock, GridChanMapping):
+    """
+    Splits the band into channel blocks of (at most) sizeChanBlock channels, also cutting wherever the
+    grid channel changes. Returns (ch0, ch1) vectors of block boundaries.
+    """
+    GridChanMapping = np.asarray(GridChanMapping)
+    NChan = GridChanMapping.size
+    # (chanblock_number,grid_number) pairs per channel, with a (-1,-1) pair at the end to form up the cuts
+    chanpairs = np.zeros((NChan+1, 2), np.int32)
+    chanpairs[:-1, 0] = np.arange(NChan, dtype=np.int32) // sizeChanBlock
+    chanpairs[:-1, 1] = GridChanMapping
+    chanpairs[-1, :] = -1
+    # cut wherever either one of the pair changes, this always includes 0 and NChan
+    cuts = np.where((chanpairs != np.roll(chanpairs, 1, axis=0)).any(axis=1))[0].astype(np.int32)
+    return cuts[:-1], cuts[1:]
+
+def GiveBlocksRowsBL(row_index, uvw, dFreq, freqs, dPhi, l, GridChanMapping, chan_cuts=None, row_ranges=False):
+    """
+    Computes the BDA blocks of one baseline.
+
+    Args:
+        row_index:  rows of the baseline, in time order
+        uvw:        uvw of these rows
+        dFreq:      channel width
+        freqs:      channel frequencies
+        dPhi:       max phase change allowed within a block
+        l:          radius of FoV (radians)
+        GridChanMapping: grid channel of each channel
+        chan_cuts:  if not None, a dict used to cache the channel cuts (see GiveChannelCuts()) per channel block size.
+                    Can be shared across all baselines using the same GridChanMapping.
+        row_ranges: if True, blocks made up of a contiguous range of rows are stored as [ch0,ch1,row0], with
+                    a size of -nrows (see below).
+
+    Returns:
+        (BlocksSizesBL, BlocksRowsListBL) tuple of int32 vectors. For each time block, for each channel block in that
+        time block, BlocksRowsListBL contains [ch0,ch1,rows...], and BlocksSizesBL contains the length of that list.
+        If row_ranges is set, contiguous blocks are stored as [ch0,ch1,row0] instead, with BlocksSizesBL giving
+        -nrows. The gridders accept both forms.
+    """
     nrows = row_index.size
-    if not nrows:
-        return None, None, None
     C = 3e8
-
-    uvw = DATA["uvw"][row_index]
-    dFreq = DATA["dfreqs"]   # channel width
-    freqs = DATA["freqs"]
     NChan = freqs.size
     nu0 = np.max(freqs)
+    if chan_cuts is None:
+        chan_cuts = {}
 
     # critical delta-uv interval for smearing
     Duv = C*(dPhi)/(np.pi*nu0)
 
-    ### old code -- computed delta-uv or delta-uvw and compared this to Duv
-    # # find delta-uv at each row: will have size of (Nrow,2)
-    # UVSLICE = slice(0,3)  # 0,2 for delta-uv-distance, or 0,3 for delta-uvw distance
-    # duv = uvw[:,UVSLICE].copy()
-    # duv[:-1,UVSLICE] = uvw[1:,UVSLICE] - uvw[:-1,UVSLICE]
-    # # last delta copied from previous row
-    # duv[-1,:] = duv[-2,:]
-    # # convert to delta-phase: Cyril's old approximation of u*l+v*l+(w*l)
-    # delta_phase = np.sqrt((duv**2).sum(1))*(l*np.pi*nu0/C)     # delta-phase at facet edge (approximate)
-
-    ### better idea maybe: multiply uvw by l,m,n-1 at facet edge
-    ### (Cyril's old code just took delta-uvw times l, which probably overweighted w!)
-
     # take l,m,n-1 at facet edge, compute ul,vm,w(n-1) vector
     lmn = np.array([l, l, math.sqrt(1-2*l*l)-1])
     uvwlmn = uvw * lmn[np.newaxis,:]
 
-    duvw = uvwlmn.copy()
-    duvw[:-1,:] = uvwlmn[1:,:] - uvwlmn[:-1,:]
-    # last delta copied from previous row
-    duvw[-1,:] = duvw[-2,:]
+    # delta to next row, with the last delta copied from the previous row
+    duvw = np.zeros_like(uvwlmn)
+    if nrows > 1:
+        duvw[:-1,:] = uvwlmn[1:,:] - uvwlmn[:-1,:]
+        duvw[-1,:] = duvw[-2,:]
     # max delta phase is just the length of the delta-vector
     delta_phase = np.sqrt((duvw**2).sum(1))*(np.pi*nu0/C)
 
-    ## same here: instead of uvw distance, multiply uvw by lmn on facet edge
-    # # uvw-distance at each row (size Nrow-1)
-    # uv = np.sqrt((uvw**2).sum(1))
-    # dnu = (C / np.pi) * dPhi / (uv * l)  # delta-nu for each row
     uv = np.sqrt((uvwlmn**2).sum(1))
-    dnu = (C / np.pi) * dPhi / uv  # delta-nu for each row
+    with np.errstate(divide='ignore'):
+        dnu = (C / np.pi) * dPhi / uv  # delta-nu for each row
     fracsizeChanBlock = dnu / dFreq  # max size of averaging block, in fractional channels, for each row
 
-    if True:  # fast-style, maybe not as precise
-        # accumulate delta-phase, and divide by dPhi. Take the floor of that -- that gives us an integer, the time block number
-        # for each row
-        if Duv:
-            rowblock = np.zeros(nrows+1)
-            rowblock[:nrows] = np.int32(delta_phase.cumsum() / dPhi)
-            rowblock[nrows] = -1
-            # rowblock is now an nrows+1 vector of block numbers per each row, with an -1 at the end, e.g. [ 1 1 1 2 2 2 3 -1]
-            # np.roll(rowblock,1) "rolls" this vector to the right, resulting in:                          [-1 1 1 1 2 2 2  3]
-            # now, every position in the array where roll!=rowblock is a starting position for a block.
-            # conveniently (and by construction, thanks to the -1 at the end), this always includes the 0 and the nrows position.
-            blockcut = np.where(np.roll(rowblock,1) != rowblock)[0]
-            nblocks = len(blockcut)
-            # make list of rows slices for each time block. The where() statement above gives us a list of rows at
-            # which the block index has changed, i.e. [0 N1 N2 Nrows]. Convert this into slice objects representing
-            # [0,N1), [N1,N2), ..., [Nx,Nrows)
-            block_slices = [ slice(blockcut[i],blockcut[i+1]) for i in xrange(nblocks-1) ]
-        else:
-            block_slices = [ slice(i,i+1) for i in xrange(nrows) ]
-    else:   # slow-style, more like Cyril used to do it
-        block_slices = []
-        dphtot = row0 = 0
-        # row0 is start of current block; delta_phase[i] is distance of row i+1 wrt row i
-        for row, dph in enumerate(delta_phase):
-            dphtot += dph
-            if dphtot > dPhi:  # if more than critical, then block is [row0,row+1)
-                block_slices.append(slice(row0, row+1))
-                dphtot = 0
-                row0 = row+1
-        # add last block
-        block_slices.append(slice(row0,nrows))
+    # accumulate delta-phase, and divide by dPhi. Take the floor of that -- that gives us an integer, the time block
+    # number for each row. Every row where the block number changes starts a new time block.
+    if Duv:
+        rowblock = np.int32(delta_phase.cumsum() / dPhi)
+        tb_start = np.concatenate(([0], np.where(rowblock[1:] != rowblock[:-1])[0] + 1))
+    else:
+        tb_start = np.arange(nrows)
+    tb_len = np.diff(np.append(tb_start, nrows))
+    ntb = tb_start.size
 
     # now find the minimum (fractional) channel block size for each time block. If this is <1, set to 1
-    fracsizeChanBlockMin = np.array([ max(fracsizeChanBlock[slc].min(), 1) for slc in block_slices ])
-
+    fracsizeChanBlockMin = np.maximum(np.minimum.reduceat(fracsizeChanBlock, tb_start), 1)
     # convert that into an integer number of channel blocks for each time block
     numChanBlocks = np.ceil(NChan/fracsizeChanBlockMin)
-
     # convert back into integer channel size (this will be smaller than the fractional size, and will tile the
     # channel space more evenly)
     sizeChanBlock = np.int32(np.ceil(NChan/numChanBlocks))  # per each time block
 
-    # now, we only have a small set of possible sizeChanBlock values across all time blocks, and the split into channel
-    # blocks needs to be computed separately for each such channelization
-    uniqueChannelBlockSizes = np.array(list(set(sizeChanBlock)))
-    num_bs = uniqueChannelBlockSizes.size
-    # reverse mapping: from unique block size, to channelization number
-    channelization_num = dict([ (sz,i) for i,sz in enumerate(uniqueChannelBlockSizes) ])
-
-    # now make a mapping: for each possible block size, we have a list of integer (chanblock_number,grid_number) pairs, one per channel.
-    # we make chanpairs: a (Nblocksize,Nchan+1,2) array to hold these. We include +1 at the end to form up cuts (below),
-    # so the last pair is always (-1,-1)
-    chanrange = np.arange(0,NChan,dtype=np.int32)
-    chanpairs = np.zeros( (num_bs, NChan+1, 2), np.int32)
-    chanpairs[:,:-1,0] = chanrange[np.newaxis,:] / uniqueChannelBlockSizes[:,np.newaxis]
-    chanpairs[:,:-1,1] = GridChanMapping[np.newaxis,:]
-    chanpairs[:,-1 ,:] = -1
-
-    # now roll the chanpairs array (along the channel axis) to see where either one of (chanblock_number,grid_number) changes
-    # hence, roll channels first, then compare, then collapse "pair" axis)
-    # changes will be a (NBlocksize, NChan+1) array with True at every "cut block" position, including always at 0 and NChan
-    changes = (chanpairs != np.roll(chanpairs,1,axis=1)).any(axis=2)
-
-    # list of lists: for each blocksize, lists channels where to cut for that blocksize
-    changes_where = [ np.where(changes[bs,:])[0] for bs in xrange(num_bs) ]
-
-    # list of lists: for each blocksize, lists (ch0,ch1) pairs indicating the blocks
-    channel_cuts = [ [ (chwh[i], chwh[i+1]) for i in xrange(len(chwh)-1) ] for chwh in changes_where ]
+    # there is only a small set of distinct channel block sizes, so look up the channel cuts per distinct size, and
+    # lay them out back-to-back in ch0/ch1 vectors, with cb_offset[i] being the offset of the i-th size
+    block_sizes, tb_chanization = np.unique(sizeChanBlock, return_inverse=True)
+    for sz in block_sizes:
+        if sz not in chan_cuts:
+            chan_cuts[sz] = GiveChannelCuts(sz, GridChanMapping)
+    ch0 = np.concatenate([ chan_cuts[sz][0] for sz in block_sizes ])
+    ch1 = np.concatenate([ chan_cuts[sz][1] for sz in block_sizes ])
+    ncb = np.array([ chan_cuts[sz][0].size for sz in block_sizes ])
+    cb_offset = np.cumsum(ncb) - ncb
 
     # ok, now to form up the list in grand Cyril format: for each time block, for each channel block in that
-    # time block, we need to make a list of [ch0,ch1,rows]
+    # time block, we need to make a list of [ch0,ch1,rows]. First, the time block and channel cut of each output block
+    tb_nblocks = ncb[tb_chanization]
+    block_tb = np.repeat(np.arange(ntb), tb_nblocks)
+    block_cut = cb_offset[tb_chanization[block_tb]] + np.arange(block_tb.size) - \
+                np.repeat(np.cumsum(tb_nblocks) - tb_nblocks, tb_nblocks)
+    block_nrows = tb_len[block_tb]
+    if row_ranges:
+        # a time block is a row range if all its row steps are 1, i.e. if it contains no breaks
+        nbreaks = np.concatenate(([0], np.cumsum(np.diff(row_index) != 1)))
+        tb_range = nbreaks[tb_start + tb_len - 1] == nbreaks[tb_start]
+        block_range = tb_range[block_tb]
+    else:
+        block_range = np.zeros(block_tb.size, bool)
+    # row ranges store only their first row
+    block_nstored = np.where(block_range, 1, block_nrows)
+    block_len = block_nstored + 2
+    BlocksSizesBL = np.where(block_range, -block_nrows, block_len).astype(np.int32)
+    block_offset = np.cumsum(block_len) - block_len
+
+    # then fill in the mega-list
+    BlocksRowsListBL = np.empty(block_len.sum(), np.int32)
+    BlocksRowsListBL[block_offset] = ch0[block_cut]
+    BlocksRowsListBL[block_offset+1] = ch1[block_cut]
+    # k is the number of each (stored) row within its block
+    row_block = np.repeat(np.arange(block_tb.size), block_nstored)
+    k = np.arange(row_block.size) - np.repeat(np.cumsum(block_nstored) - block_nstored, block_nstored)
+    BlocksRowsListBL[block_offset[row_block] + 2 + k] = row_index[tb_start[block_tb[row_block]] + k]
+
+    return BlocksSizesBL, BlocksRowsListBL
 
-    blocklists = [ [ch0, ch1] + list(row_index[block_slices[iblock]]) for iblock, sz in enumerate(sizeChanBlock)
-                                                                      for ch0, ch1 in channel_cuts[channelization_num[sz]] ]
-
-#    print>> log, "baseline %d:%d blocklists %s" % (a0, a1, " ".join([",".join(map(str,bl)) for bl in blocklists]))
-
-    # list of blocklist sizes, per block
-    BlocksSizesBL = [ len(bl) for bl in blocklists ]
-    # total number of blocks
-    NBlocksTotBL = len(BlocksSizesBL)
-    # and concatenate all blocks into a single mega-list
-    BlocksRowsListBL = list(itertools.chain(*blocklists))
-
-    return BlocksRowsListBL, BlocksSizesBL, NBlocksTotBL
+def GiveBlocksRowsListBL(a0, a1, DATA, dPhi, l, GridChanMapping):
+    """Computes BDA blocks of baseline a0:a1. Returns BlocksRowsListBL, BlocksSizesBL, NBlocksTotBL (see GiveBlocksRowsBL())"""
+    row_index = GiveBaselineRows(a0, a1, DATA)
+    if not row_index.size:
+        return None, None, None
+    BlocksSizesBL, BlocksRowsListBL = GiveBlocksRowsBL(row_index, DATA["uvw"][row_index], DATA["dfreqs"], DATA["freqs"],
+                                                       dPhi, l, GridChanMapping)
+    return BlocksRowsListBL, BlocksSizesBL, BlocksSizesBL.size
+
+def GiveBlockRanges(mapping, nparts):
+    """
+    Splits the blocks of a final BDA mapping (as assembled by SmearMappingMachine.collectSmearMapping()) into up to
+    nparts contiguous ranges holding about equal numbers of rows. Returns list of (block0, block1) tuples, empty
+    ranges are omitted.
+    """
+    nblocks = int(mapping[0]) + (int(mapping[1])<<32)
+    if not nblocks:
+        return []
+    # positive sizes are row lists, including the two channel words; negative sizes are row ranges of -size rows
+    sizes = mapping[2:2+nblocks].astype(np.int64)
+    cumrows = np.cumsum(np.where(sizes < 0, -sizes, sizes-2))
+    if not cumrows[-1]:
+        return [(0, nblocks)]
+    cuts = np.searchsorted(cumrows, cumrows[-1]*np.arange(1, nparts)/float(nparts)) + 1
+    edges = [0] + np.minimum(cuts, nblocks).tolist() + [nblocks]
+    return [ (b0, b1) for b0, b1 in zip(edges[:-1], edges[1:]) if b1 > b0 ]
 
 #BlocksRowsListBL, BlocksSizesBL, _ = GiveBlocksRowsListBL(a0, a1, DATA, dPhi, l, channel_mapping)
 
 #def GiveBlocksRowsListBL_old(a0, a1, DATA, InfoSmearMapping, GridChanMapping):
-def GiveBlocksRowsListBL_old(a0, a1, DATA, dPhi, l, channel_mapping):
-    A0 = DATA["A0"]
-    A1 = DATA["A1"]
-    ind = np.where((A0 == a0) & (A1 == a1))[0]
+def GiveBlocksRowsListBL_old(a0, a1, DATA, dPhi, l, channel_mapping, ind=None):
+    if ind is None:
+        ind = GiveBaselineRows(a0, a1, DATA)
     #if(ind.size <= 1):
     #    return
     nrows = ind.size
@@ -19,7 +19,9 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 '''
 
 import numpy as np
-import math, os, cPickle
+import math, os, cPickle, time
+import collections
+import traceback
 
 
 import ClassMS
@@ -31,7 +33,9 @@ MyLogger.setSilent(["NpShared"])
 import ClassSmearMapping
 import ClassJones
 from DDFacet.Array import shared_dict
+from DDFacet.Array import NpShared
 from DDFacet.Other.AsyncProcessPool import APP
+from DDFacet.Other.CacheManager import CacheManager
 import DDFacet.cbuild.Gridder._pyGridderSmearPols as _pyGridderSmearPols
 import copy
 
@@ -89,16 +93,39 @@ class ClassVisServer():
             self._use_data_cache = None
         self.DATA = None
         self._saved_data = None  # vis data saved here for single-chunk mode
+        # queue of chunks scheduled for loading in the background: (name, label, iMS, iChunk, started) tuples
+        self._chunk_queue = collections.deque()
+        self._chunks_exhausted = False
+        self._read_ahead = max(self.GD["Parallel"]["ReadAhead"], 1)
+        self._read_ahead_maxmem = self.GD["Parallel"]["ReadAheadMaxMem"]*2.**30
+        self._io_stall_time = 0
+        self._num_chunks_scheduled = 0
+        # chunk cache of the chunk last loaded by this process (each I/O worker has its own), see _handler_LoadVisChunk()
+        self._loaded_chunk_cache = None
         self.obs_detail = None
+        CacheManager.setMaxSize(self.GD["Cache"]["MaxSize"])
         self.Init()
 
+        # threaded beam evaluation for the chunk loaders (needs ListMS, so is set up after Init())
+        self._beam_evaluator = ClassJones.ClassBeamEvaluator(self) if APP is not None else None
+
         # if True, then skip weights calculation (but do load max-w!)
         self._ignore_vis_weights = False
 
-        # smear mapping machines
-        self._smm_grid = ClassSmearMapping.SmearMappingMachine("BDA.Grid")
-        self._smm_degrid = ClassSmearMapping.SmearMappingMachine("BDA.Degrid")
+        # smear mapping machine (computes both the gridding and degridding mappings)
+        self._smm = ClassSmearMapping.SmearMappingMachine("BDA")
         self._put_vis_column_job_id = self._put_vis_column_label = None
+        # previous chunk, kept while it is still being gridded (see collectLoadedChunk())
+        self._previous_DATA = None
+        # residual visibilities cached between major cycles (see startResidualSaveInBackground()).
+        # (iMS,iChunk) -> version (major cycle) of the residuals stored for that chunk
+        self._residual_versions = {}
+        # version of residuals that loaded chunks should use, or None to read the original data
+        self._residual_load_version = None
+        # pending residual save jobs: (job_id, label, iMS, iChunk, version) tuples
+        self._residual_save_jobs = []
+        # in single-chunk mode, residuals are kept in memory, next to _saved_data
+        self._saved_residual = None
 
 
 
@@ -169,7 +196,6 @@ class ClassVisServer():
         # main cache is initialized from main cache of first MS
         if ".txt" in self.GD["Data"]["MS"]:
             # main cache is initialized from main cache of the MSList
-            from DDFacet.Other.CacheManager import CacheManager
             self.maincache = self.cache = CacheManager("%s.ddfcache"%self.GD["Data"]["MS"], cachedir=self.GD["Cache"]["Dir"], reset=self.GD["Cache"]["Reset"])
         else:
             # main cache is initialized from main cache of first MS
@@ -370,9 +396,19 @@ class ClassVisServer():
         AverageBeamMachine.CalcMeanBeam()
 
     def ReInitChunkCount(self):
+        self.releasePreviousChunk()
         if self.nTotalChunks > 1 and self.DATA is not None:
             self.DATA.delete()
             self.DATA = None
+        # discard any chunks that were read ahead but never collected
+        while self._chunk_queue:
+            name, label, _, _, started = self._chunk_queue.popleft()
+            if started:
+                print>>log, "discarding read-ahead chunk %s" % label
+                APP.awaitJobResults(name)
+                shared_dict.attach(name).delete()
+        self._chunks_exhausted = False
+        self._io_stall_time = 0
         self.iCurrentMS = 0
         self.iCurrentChunk = -1
 
@@ -394,9 +430,131 @@ class ClassVisServer():
             APP.awaitJobResults(self._put_vis_column_job_id, progress="Writing %s" % self._put_vis_column_label)
             self._put_vis_column_job_id = None
 
+    def _residualPath(self, iMS, iChunk):
+        """Returns path of the cached residual visibilities of the given chunk"""
+        ms = self.ListMS[iMS]
+        cache = ms.getChunkCache(*ms.getChunkRow0Row1()[iChunk])
+        return cache.getElementPath(cache.getArrayElementName("ResidualVis"))
+
+    def _useResidual(self, iMS, iChunk):
+        """Returns True if the given chunk is to be loaded from cached residuals"""
+        return self._residual_load_version is not None and \
+               self._residual_versions.get((iMS, iChunk)) == self._residual_load_version
+
+    def setResidualLoadVersion(self, version):
+        """
+        Tells the server to load chunks from the residual visibilities saved by startResidualSaveInBackground()
+        with the given version, where available (chunks with no such residuals are read from the data as usual).
+        Call with None to always read the data. Takes effect for chunks scheduled after the next ReInitChunkCount().
+        """
+        self._residual_load_version = version
+
+    def startResidualSaveInBackground(self, DATA, version):
+        """
+        Saves the visibilities of the chunk (which must be residuals by now, i.e. the model must have been
+        degridded) under the given version, so that the next major cycle may load them via
+        setResidualLoadVersion(), and only degrid the change in the model. In single-chunk mode
+        residuals are simply kept in memory, otherwise they're written to the chunk cache (compressed
+        with --Cache-VisDataCodec, if set) by an I/O job.
+        """
+        iMS, iChunk = DATA["iMS"], DATA["iChunk"]
+        if self.nTotalChunks == 1:
+            if self._saved_residual is None:
+                self._saved_residual = DATA["data"].copy()
+            else:
+                np.copyto(self._saved_residual, DATA["data"])
+            self._residual_versions[iMS, iChunk] = version
+            return
+        # make sure the old version is not used if the save fails
+        self._residual_versions.pop((iMS, iChunk), None)
+        job_id = "SaveResidual:%d:%d" % (iMS, iChunk)
+        APP.runJob(job_id, self._handler_SaveResidual, args=(DATA.readonly(), self._residualPath(iMS, iChunk)), io=0)
+        self._residual_save_jobs.append((job_id, DATA["label"], iMS, iChunk, version))
+
+    def _handler_SaveResidual(self, DATA, path):
+        """Saves residuals of chunk to path. Returns True on success. On failure, removes any partial file"""
+        ms = self.ListMS[DATA["iMS"]]
+        try:
+            ms.getChunkCache(*ms.getChunkRow0Row1()[DATA["iChunk"]]).saveArray(path, DATA["data"])
+            return True
+        except Exception:
+            print>>log, traceback.format_exc()
+            print>>log, ModColor.Str("WARNING: failed to cache residuals to %s, chunk will be re-read from the MS" % path)
+            try:
+                if os.path.exists(path):
+                    os.unlink(path)
+            except OSError:
+                pass
+            return False
+
+    def collectResidualSaveResults(self):
+        """Waits for residual save jobs started by startResidualSaveInBackground() to complete"""
+        for job_id, label, iMS, iChunk, version in self._residual_save_jobs:
+            if APP.awaitJobResults(job_id, progress="Caching residuals %s" % label):
+                self._residual_versions[iMS, iChunk] = version
+        self._residual_save_jobs = []
+
+    def releaseResidualCache(self):
+        """Removes all cached residual visibilities"""
+        self.collectResidualSaveResults()
+        if self.nTotalChunks > 1:
+            for iMS, iChunk in self._residual_versions.keys():
+                path = self._residualPath(iMS, iChunk)
+                if os.path.exists(path):
+                    os.unlink(path)
+        self._residual_versions = {}
+        self._residual_load_version = None
+        self._saved_residual = None
+
+    def _estimateChunkSize(self, iMS, iChunk):
+        """Returns rough estimate of the shared memory (in bytes) taken up by a loaded chunk:
+        visibilities, flags and weights"""
+        ms = self.ListMS[iMS]
+        row0, row1 = ms.getChunkRow0Row1()[iChunk]
+        nchan, ncorr = len(ms.ChanFreq), len(ms.CorrelationNames)
+        return (row1-row0)*nchan*(ncorr*(8+1)+4)
+
+    def _readAheadAllowed(self):
+        """Returns True if another chunk may be scheduled for loading, given the read-ahead depth and memory budget"""
+        if self._chunks_exhausted:
+            return False
+        if not self._chunk_queue:
+            return True
+        if len(self._chunk_queue) >= self._read_ahead:
+            return False
+        inflight = [ (iMS, iChunk) for _, _, iMS, iChunk, started in self._chunk_queue if started ]
+        if self.DATA is not None:
+            inflight.append((self.DATA["iMS"], self.DATA["iChunk"]))
+        # assume next chunk is no bigger than the biggest one already in flight
+        size_next = max([ self._estimateChunkSize(iMS, iChunk) for iMS, iChunk in inflight ] or [0])
+        if self._read_ahead_maxmem:
+            size = sum([ self._estimateChunkSize(iMS, iChunk) for iMS, iChunk in inflight ])
+            if size + size_next > self._read_ahead_maxmem:
+                return False
+        # backpressure: don't read ahead if the chunk would not fit into shared memory right now. It will
+        # be scheduled once chunks in flight have been released
+        if NpShared.ShmAvailable() < size_next:
+            print>>log, "not enough shared memory to read ahead, deferring chunk load (%s)" % NpShared.ShmReport()
+            return False
+        return True
+
     def startChunkLoadInBackground(self):
         """
         Called in main process. Increments chunk counter, initiates chunk load in background thread.
+        With --Parallel-ReadAhead>1, keeps scheduling chunks until the read-ahead queue is full.
+        Returns None if we get past the last chunk, else returns the label of the first chunk scheduled.
+        """
+        first_label = None
+        while self._readAheadAllowed():
+            label = self._scheduleNextChunk()
+            if label is None:
+                break
+            first_label = first_label or label
+        return first_label
+
+    def _scheduleNextChunk(self):
+        """
+        Increments chunk counter, and schedules loading of next chunk on an I/O worker.
         Returns None if we get past the last chunk, else returns the chunk label.
         """
         while True:
@@ -408,51 +566,76 @@ class ClassVisServer():
                 self.iCurrentMS += 1
                 # no more MSs -- return None
                 if self.iCurrentMS >= len(self.ListMS):
-                    self._next_chunk_name = None
+                    self._chunks_exhausted = True
                     self.iCurrentMS = 0
                     self.iCurrentChunk = -1
                     return None
                 # go back up to first chunk of next MS
                 self.iCurrentChunk = -1
                 continue
-            self._next_chunk_name = "DATA:%d:%d" % (self.iCurrentMS, self.iCurrentChunk)
-            self._next_chunk_label = "%d.%d" % (self.iCurrentMS + 1, self.iCurrentChunk + 1)
+            name = "DATA:%d:%d" % (self.iCurrentMS, self.iCurrentChunk)
+            label = "%d.%d" % (self.iCurrentMS + 1, self.iCurrentChunk + 1)
             # null chunk? skip to next chunk
             if not self._ignore_vis_weights:
                 self.awaitWeights()
                 if self.VisWeights[self.iCurrentMS][self.iCurrentChunk]["null"]:
-                    print>>log, ModColor.Str("chunk %s is null, skipping"%self._next_chunk_label)
+                    print>>log, ModColor.Str("chunk %s is null, skipping"%label)
                     continue
             # ok, now we're good to load
-            print>>log, "scheduling loading of chunk %s" % self._next_chunk_label
+            print>>log, "scheduling loading of chunk %s" % label
             # in single-chunk mode, DATA may already be loaded, in which case we do nothing
-            if self.nTotalChunks > 1 or self.DATA is None:
-                # tell the IO thread to start loading the chunk
-                APP.runJob(self._next_chunk_name, self._handler_LoadVisChunk,
-                           args=(self._next_chunk_name, self.iCurrentMS, self.iCurrentChunk), 
-                           io=0)
-            return self._next_chunk_label
-
-    def collectLoadedChunk(self, start_next=True):
+            started = self.nTotalChunks > 1 or self.DATA is None
+            if started:
+                residual_path = self._residualPath(self.iCurrentMS, self.iCurrentChunk) \
+                                    if self._useResidual(self.iCurrentMS, self.iCurrentChunk) else None
+                # tell an IO worker to start loading the chunk. Chunks are spread over the IO workers round-robin
+                APP.runJob(name, self._handler_LoadVisChunk,
+                           args=(name, self.iCurrentMS, self.iCurrentChunk, residual_path),
+                           io=self._num_chunks_scheduled % APP.num_io_processes)
+                self._num_chunks_scheduled += 1
+            self._chunk_queue.append((name, label, self.iCurrentMS, self.iCurrentChunk, started))
+            return label
+
+    def collectLoadedChunk(self, start_next=True, keep_previous=False):
+        """
+        Returns the next loaded chunk (or "EndOfObservation"), and schedules loading of the chunk after, if start_next
+        is True. The previous chunk is discarded from shm, unless keep_previous is True, in which case it is kept
+        until releasePreviousChunk() is called (e.g. because gridding jobs on it are still running).
+        """
         # previous data dict can now be discarded from shm
         if self.nTotalChunks > 1 and self.DATA is not None:
-            self.DATA.delete()
+            self.releasePreviousChunk()
+            if keep_previous:
+                self._previous_DATA = self.DATA
+            else:
+                self.DATA.delete()
             self.DATA = None
         # if no next chunk scheduled, we're at end
-        if not self._next_chunk_name:
+        if not self._chunk_queue:
+            if self._io_stall_time:
+                print>>log, "total time stalled waiting for chunk I/O: %.2fs" % self._io_stall_time
+                self._io_stall_time = 0
             return "EndOfObservation"
+        name, label, _, _, started = self._chunk_queue.popleft()
         # in single-chunk mode, only read the MS once, then keep it forever,
         # but re-copy visibility data from original data
-        if self.nTotalChunks == 1 and self.DATA is not None and "data" in self.DATA:
-            np.copyto(self.DATA["data"], self._saved_data)
+        if not started:
+            if "data" in self.DATA:
+                residual = self._useResidual(self.DATA["iMS"], self.DATA["iChunk"]) and self._saved_residual is not None
+                np.copyto(self.DATA["data"], self._saved_residual if residual else self._saved_data)
+                self.DATA["IsResidual"] = residual
         else:
             # await completion of data loading jobs (which, presumably, includes smear mapping)
-            APP.awaitJobResults(self._next_chunk_name, timing="Reading %s"%self._next_chunk_label )
+            t0 = time.time()
+            APP.awaitJobResults(name, timing="Reading %s"%label)
+            stall = time.time() - t0
+            self._io_stall_time += stall
+            print>>log, "chunk %s: stalled %.2fs waiting on I/O (%d more chunk(s) in flight)" % (label, stall, len(self._chunk_queue))
             # reload the data dict -- background thread will now have populated it
-            self.DATA = shared_dict.attach(self._next_chunk_name)
-            self.DATA["label"] = self._next_chunk_label
+            self.DATA = shared_dict.attach(name)
+            self.DATA["label"] = label
             # in single-chunk mode, keep a copy of the data array
-            if self.nTotalChunks == 1 and "data" in self.DATA and self._saved_data is None:
+            if self.nTotalChunks == 1 and "data" in self.DATA and self._saved_data is None and not self.DATA.get("IsResidual"):
                 self._saved_data = self.DATA["data"].copy()
         # schedule next event
         if start_next:
@@ -460,21 +643,31 @@ class ClassVisServer():
         # return the data dict
         return self.DATA
 
+    def releasePreviousChunk(self):
+        """Releases the previous chunk kept by collectLoadedChunk(keep_previous=True), if any"""
+        if self._previous_DATA is not None:
+            self._previous_DATA.delete()
+            self._previous_DATA = None
+
     def releaseLoadedChunk(self):
         """Releases memory associated with any saved data"""
-        self._saved_data = None
+        self.releasePreviousChunk()
+        self._saved_data = self._saved_residual = None
         if self.DATA is not None:
             self.DATA.delete()
             self.DATA = None
 
 
-    def _handler_LoadVisChunk(self, dictname, iMS, iChunk):
+    def _handler_LoadVisChunk(self, dictname, iMS, iChunk, residual_path=None):
         """
         Called in IO thread to load a data chunk
         Args:
-            null_data: if True, then we don't want to read the visibility data at all, but rather just want to make
-                a null buffer of the same shape as the visibility data.
+            residual_path: if set, cached residual visibilities are read from this path instead of the data
+                (see startResidualSaveInBackground())
         """
+        # this process is done with the previous chunk it loaded, so let go of its cache (see CacheManager.release())
+        if self._loaded_chunk_cache is not None:
+            self._loaded_chunk_cache.release()
         DATA = shared_dict.create(dictname)
         DATA["iMS"]    = iMS
         DATA["iChunk"] = iChunk
@@ -483,9 +676,10 @@ class ClassVisServer():
         print>> log, ModColor.Str("loading ms %d of %d, chunk %d of %d" % (iMS+1, self.nMS, iChunk+1, ms.numChunks()), col="green")
 
         ms.GiveChunk(DATA, iChunk, use_cache=self._use_data_cache,
-                     read_data=bool(self.ColName), sort_by_baseline=self.GD["Data"]["Sort"])
+                     read_data=bool(self.ColName), sort_by_baseline=self.GD["Data"]["Sort"],
+                     residual_path=residual_path)
         # update cache to match MSs current chunk cache
-        self.cache = ms.cache
+        self.cache = self._loaded_chunk_cache = ms.cache
 
 
         times = DATA["times"]
@@ -532,10 +726,11 @@ class ClassVisServer():
             ChanMappingGridding=DATA["ChanMapping"],
             ChanMappingDeGridding=DATA["ChanMappingDegrid"])
 
-        JonesMachine = ClassJones.ClassJones(self.GD, ms, self.FacetMachine)
+        JonesMachine = ClassJones.ClassJones(self.GD, ms, self.FacetMachine, BeamEvaluator=self._beam_evaluator)
         JonesMachine.InitDDESols(DATA)
 
-        if data is not None and self.AddNoiseJy is not None:
+        # cached residuals already have the noise added in
+        if data is not None and self.AddNoiseJy is not None and not DATA["IsResidual"]:
             data += (self.AddNoiseJy/np.sqrt(2.))*(np.random.randn(*data.shape)+1j*np.random.randn(*data.shape))
 
         # load results of smear mapping computation
@@ -557,12 +752,12 @@ class ClassVisServer():
     def collectBDA(self, base_job_id, DATA):
         """Called in I/O thread. Waits for BDA computation to complete (if any), then populates dict"""
         if "BDA.Grid" not in DATA:
-            FinalMapping, fact = self._smm_grid.collectSmearMapping(DATA, "BDA.Grid")
+            FinalMapping, fact = self._smm.collectSmearMapping(DATA, "BDA.Grid")
             print>> log, ModColor.Str("  Effective compression [grid]  :   %.2f%%" % fact, col="green")
             np.save(file(self._bda_grid_cachename, 'w'), FinalMapping)
             self.cache.saveCache("BDA.Grid")
         if "BDA.Degrid" not in DATA:
-            FinalMapping, fact = self._smm_degrid.collectSmearMapping(DATA, "BDA.Degrid")
+            FinalMapping, fact = self._smm.collectSmearMapping(DATA, "BDA.Degrid")
             print>> log, ModColor.Str("  Effective compression [degrid]:   %.2f%%" % fact, col="green")
             DATA["BDA.Degrid"] = FinalMapping
             np.save(file(self._bda_degrid_cachename, 'w'), FinalMapping)
@@ -570,14 +765,18 @@ class ClassVisServer():
 
     def computeBDAInBackground(self, base_job_id, ms, DATA, ChanMappingGridding=None, ChanMappingDeGridding=None):
 
-        GD=copy.deepcopy(self.GD)
-        CriticalCacheParms=dict(Data=GD["Data"],
-                                Compression=GD["Comp"],
-                                Freq=GD["Freq"],
-                                DataSelection=GD["Selection"],
-                                Sorting=GD["Data"]["Sort"])
-        del CriticalCacheParms["Data"]["ColName"],CriticalCacheParms["DataSelection"]["FlagAnts"]
-        
+        # the mapping depends on the baseline-time layout of the chunk, the frequency setup, the BDA settings,
+        # and the FoV (i.e. facet geometry)
+        CriticalCacheParms=dict(MS=ms.getCacheKey("ANTENNA1", "ANTENNA2", "TIME", "UVW"),
+                                Sorting=self.GD["Data"]["Sort"],
+                                Compression=CacheManager.selectKeys(self.GD["Comp"], "GridDecorr", "GridFoV",
+                                                                    "DegridDecorr", "DegridFoV", "BDAMode",
+                                                                    "BDARowRanges"),
+                                Freq=self.GD["Freq"],
+                                ChanSelection=CacheManager.selectKeys(self.GD["Selection"], "ChanStart", "ChanEnd", "ChanStep"),
+                                Image=CacheManager.selectKeys(self.GD["Image"], "NPix", "Cell", "PhaseCenterRADEC"),
+                                Facets=self.GD["Facets"])
+        mappings = []
 
         if True: # always True for now, non-BDA gridder is not maintained # if self.GD["Comp"]["CompGridMode"]:
             self._bda_grid_cachename, valid = self.cache.checkCache("BDA.Grid",CriticalCacheParms)
@@ -589,11 +788,8 @@ class ClassVisServer():
                     _, _, nx, ny = self.FacetShape
                 elif self.GD["Comp"]["GridFoV"] == "Full":
                     _, _, nx, ny = self.FullImShape
-                mode = self.GD["Comp"]["BDAMode"]
                 FOV = self.CellSizeRad * nx * (np.sqrt(2.) / 2.) * 180. / np.pi
-                self._smm_grid.computeSmearMappingInBackground(base_job_id, ms, DATA, FOV,
-                                                          (1. - self.GD["Comp"]["GridDecorr"]),
-                                                          ChanMappingGridding, mode)
+                mappings.append(("BDA.Grid", FOV, (1. - self.GD["Comp"]["GridDecorr"]), ChanMappingGridding))
 
         if True: # always True for now, non-BDA gridder is not maintained # if self.GD["Comp"]["CompDeGridMode"]:
             self._bda_degrid_cachename, valid = self.cache.checkCache("BDA.Degrid",CriticalCacheParms)
@@ -606,11 +802,13 @@ class ClassVisServer():
                     _, _, nx, ny = self.FacetShape
                 elif self.GD["Comp"]["DegridFoV"] == "Full":
                     _, _, nx, ny = self.FullImShape
-                mode = self.GD["Comp"]["BDAMode"]
                 FOV = self.CellSizeRad * nx * (np.sqrt(2.) / 2.) * 180. / np.pi
-                self._smm_degrid.computeSmearMappingInBackground(base_job_id, ms, DATA, FOV,
-                                                          (1. - self.GD["Comp"]["DegridDecorr"]),
-                                                          ChanMappingDeGridding, mode)
+                mappings.append(("BDA.Degrid", FOV, (1. - self.GD["Comp"]["DegridDecorr"]), ChanMappingDeGridding))
+
+        # both mappings are computed in a single pass over the baselines
+        if mappings:
+            self._smm.computeSmearMappingInBackground(base_job_id, ms, DATA, mappings, self.GD["Comp"]["BDAMode"],
+                                                      row_ranges=self.GD["Comp"]["BDARowRanges"])
 
     def GetVisWeights(self, iMS, iChunk):
         """
@@ -660,10 +858,23 @@ class ClassVisServer():
         # APP.awaitEvents(self._calcweights_event)
 
     def _CalcWeights_handler(self):
+        try:
+            self._calcWeights()
+        finally:
+            # the weights pass goes over every chunk cache, so let go of them once done (see CacheManager.release())
+            for ms in self.ListMS:
+                for row0, row1 in ms.getChunkRow0Row1():
+                    ms.getChunkCache(row0, row1).release()
+
+    def _calcWeights(self):
         self._weight_dict = shared_dict.create("VisWeights")
-        # check for wmax in cache
-        cache_keys = dict([(section, self.GD[section]) for section
-              in ("Data", "Selection", "Freq", "Image", "Weight")])
+        # check for wmax in cache. Uniform/Briggs weights are computed on a common grid, so every chunk's
+        # weights depend on all the MSs
+        cache_keys = dict(MS=[ ms.getCacheKey("UVW", "FLAG", "WEIGHT", "WEIGHT_SPECTRUM") for ms in self.ListMS ],
+                          Selection=self.GD["Selection"],
+                          Freq=self.GD["Freq"],
+                          Image=CacheManager.selectKeys(self.GD["Image"], "NPix", "Cell", "PhaseCenterRADEC"),
+                          Weight=self.GD["Weight"])
         wmax_path, wmax_valid = self.maincache.checkCache("wmax", cache_keys)
         if wmax_valid:
             self._weight_dict["wmax"] = cPickle.load(open(wmax_path))
@@ -711,6 +922,8 @@ class ClassVisServer():
             raise RuntimeError("data appears to be fully flagged: can't compute imaging weights")
         # in natural mode, leave the weights as is. In other modes, setup grid for calculations
         self._weight_grid = shared_dict.create("VisWeights.Grid")
+        # (cell, npix, npixx, nbands, xymax) of the weighting grid. Unused in natural mode
+        grid_args = (0, 0, 0, 1, 0)
         if self.Weighting != "natural":
             nch, npol, npixIm, _ = self.FullImShape
             FOV = self.CellSizeRad * npixIm
@@ -729,6 +942,7 @@ class ClassVisServer():
             npix = npixx * npixy
             print>> log, "Calculating imaging weights on an [%i,%i]x%i grid with cellsize %g" % (npixx, npixy, nbands, cell)
             grid0 = self._weight_grid.addSharedArray("grid", (nbands, npix), np.float64)
+            grid_args = (cell, npix, npixx, nbands, xymax)
             # now run parallel jobs to accumulate weights
             for ims, ms in enumerate(self.ListMS):
                 for ichunk in xrange(len(ms.getChunkRow0Row1())):
@@ -736,7 +950,7 @@ class ClassVisServer():
                         APP.runJob("AccumWeights:%d:%d" % (ims, ichunk), self._accumulateWeights_handler,
                                    args=(self._weight_grid.readonly(),
                                          self._weight_dict[ims][ichunk].readwrite(),
-                                         ims, ichunk, ms.ChanFreq, cell, npix, npixx, nbands, xymax),
+                                         ims, ichunk, ms.ChanFreq) + grid_args,
                                    counter=self._weightjob_counter, collect_result=False)
             # wait for results
             APP.awaitJobCounter(self._weightjob_counter, progress="Accumulate weights")
@@ -753,7 +967,8 @@ class ClassVisServer():
             for ichunk in xrange(len(ms.getChunkRow0Row1())):
                 APP.runJob("FinalizeWeights:%d:%d" % (ims, ichunk), self._finalizeWeights_handler,
                            args=(self._weight_grid.readonly(),
-                                 self._weight_dict[ims][ichunk].readwrite()),
+                                 self._weight_dict[ims][ichunk].readwrite(),
+                                 ims, ms.ChanFreq) + grid_args,
                            counter=self._weightjob_counter, collect_result=False)
         APP.awaitJobCounter(self._weightjob_counter, progress="Finalize weights")
         # delete stuff
@@ -781,13 +996,10 @@ class ClassVisServer():
         if not nrows:
 #            print>> log, "  0 rows: empty chunk"
             return
-        tab = ms.GiveMainTable()
-#        print>>log,"  %d.%d reading %s UVW" % (ims+1, ichunk+1, ms.MSName)
-        uvw = tab.getcol("UVW", row0, nrows)
-        flags = np.empty((nrows, len(ms.ChanFreq), len(ms.CorrelationIds)), np.bool)
-        # print>>log,(ms.cs_tlc,ms.cs_brc,ms.cs_inc,flags.shape)
-#        print>>log,"  reading FLAG"
-        tab.getcolslicenp("FLAG", flags, ms.cs_tlc, ms.cs_brc, ms.cs_inc, row0, nrows)
+        # this also stores UVW and FLAG in the chunk cache, so that the first read of the chunk need not read them again
+        tab, uvw, flags = ms.ReadUVWFlags(row0, row1, use_cache=self._use_data_cache,
+                                          sort_by_baseline=self.GD["Data"]["Sort"])
+        ms.getChunkCache(row0, row1).release()
         if ms._reverse_channel_order:
             flags = flags[:,::-1,:]
         # if any polarization is flagged, flag all 4 correlations. Shape of flags becomes nrow,nchan
@@ -852,45 +1064,33 @@ class ClassVisServer():
         else:
             msw["bandmap"] = self.DicoMSChanMapping[ims]
 
+    def _weightsGridArgs(self, wg, msw, ims, freqs, cell, npix, npixx, nbands, xymax):
+        """Returns argument tuple for the _pyGridderSmearPols weights grid functions"""
+        # in per-band weighting mode, each channel refers to its band's grid
+        bandmap = self.DicoMSChanMapping[ims] if nbands > 1 else np.zeros(len(freqs))
+        return (wg["grid"].reshape((wg["grid"].size,)), msw["weight"], np.ascontiguousarray(msw["uv"], np.float64),
+                np.ascontiguousarray(freqs, np.float64), np.ascontiguousarray(bandmap, np.int64),
+                float(cell), int(xymax), int(npixx), int(npix))
+
     def _accumulateWeights_handler (self, wg, msw, ims, ichunk, freqs, cell, npix, npixx, nbands, xymax):
-        weights = msw["weight"]
-        uv = msw["uv"]
-        # flip sign of negative v values -- we'll only grid the top half of the plane
-        uv[uv[:, 1] < 0] *= -1
-        # convert u/v to lambda, and then to pixel offset
-        uv = uv[..., np.newaxis] * freqs[np.newaxis, np.newaxis, :] / _cc
-        uv = np.floor(uv / cell).astype(int)
-        # u is offset, v isn't since it's the top half
-        x = uv[:, 0, :]
-        y = uv[:, 1, :]
-        x += xymax  # offset, since X grid starts at -xymax
-        # convert to index array -- this gives the number of the uv-bin on the grid
-        index = msw.addSharedArray("index", (uv.shape[0], len(freqs)), np.int64)
-        #index = np.zeros((uv.shape[0], len(freqs)), np.int64)
-        index[...] = y * npixx + x
-        # if we're in per-band weighting mode, then adjust the index to refer to each band's grid
-        if nbands > 1:
-            index += self.DicoMSChanMapping[ims][np.newaxis, :] * npix
-        # zero weight refers to zero cell (otherwise it may end up outside the grid, since grid is
-        # only big enough to accommodate the *unflagged* uv-points)
-        index[weights == 0] = 0
-        # uv no longer needed
-        uv = None
-        msw.delete_item("uv")
+        # the uv-bin of each visibility is computed on the fly (and again in _finalizeWeights_handler()),
+        # so no per-visibility index array is ever stored. Zero weights are skipped, so flagged points can't
+        # end up outside the grid (which is only big enough to accommodate the *unflagged* uv-points)
+        _pyGridderSmearPols.pyAccumulateWeightsOntoGridUV(*self._weightsGridArgs(wg, msw, ims, freqs, cell,
+                                                                                npix, npixx, nbands, xymax))
         msw.delete_item("flags")
-        # print>>log,weights,index
-        _pyGridderSmearPols.pyAccumulateWeightsOntoGrid(wg["grid"], weights.ravel(), index.ravel())
 
-    def _finalizeWeights_handler(self, wg, msw):
+    def _finalizeWeights_handler(self, wg, msw, ims, freqs, cell, npix, npixx, nbands, xymax):
         if "weight" in msw:
             weight = msw["weight"]
             if self.Weighting != "natural":
-                grid = wg["grid"].reshape((wg["grid"].size,))
-                weight /= grid[msw["index"]]
+                _pyGridderSmearPols.pyApplyWeightsGridUV(*self._weightsGridArgs(wg, msw, ims, freqs, cell,
+                                                                               npix, npixx, nbands, xymax))
             np.save(msw["cachepath"], weight)
             msw.delete_item("weight")
-            if "index" in msw:
-                msw.delete_item("index")
+            for key in "uv", "flags":
+                if key in msw:
+                    msw.delete_item(key)
             msw["null"] = False
         else:
             msw["null"] = True
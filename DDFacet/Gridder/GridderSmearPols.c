@@ -75,6 +75,8 @@ static PyMethodDef _pyGridderSmearPols_testMethods[] = {
 	{"pySetSemaphores", pySetSemaphores, METH_VARARGS},
 	{"pyDeleteSemaphore", pyDeleteSemaphore, METH_VARARGS},
 	{"pyAccumulateWeightsOntoGrid", pyAccumulateWeightsOntoGrid, METH_VARARGS},
+	{"pyAccumulateWeightsOntoGridUV", pyAccumulateWeightsOntoGridUV, METH_VARARGS},
+	{"pyApplyWeightsGridUV", pyApplyWeightsGridUV, METH_VARARGS},
 	{NULL, NULL}     /* Sentinel - marks the end of this structure */
 };
 
@@ -121,6 +123,122 @@ static PyObject *pyAccumulateWeightsOntoGrid(PyObject *self, PyObject *args)
 
 }
 
+/* Geometry of the imaging weights grid (see ClassVisServer._CalcWeights_handler()): nbands grids
+   of npix cells each, covering [-xymax,xymax] in u and [0,xymax] in v, with npixx cells per v-row */
+typedef struct {
+    PyArrayObject *grid, *weights, *uv, *freqs, *bandmap;
+    double cell;
+    long int xymax, npixx, npix;
+} WeightsGridArgs;
+
+static int ParseWeightsGridArgs(PyObject *args, WeightsGridArgs *wg)
+{
+    if (!PyArg_ParseTuple(args, "O!O!O!O!O!dlll",
+            &PyArray_Type,  &wg->grid,
+            &PyArray_Type,  &wg->weights,
+            &PyArray_Type,  &wg->uv,
+            &PyArray_Type,  &wg->freqs,
+            &PyArray_Type,  &wg->bandmap,
+            &wg->cell, &wg->xymax, &wg->npixx, &wg->npix
+            ))
+        return 0;
+    return 1;
+}
+
+/* Returns the grid cell of (u,v) (in metres) at the given frequency. This must match the uv-bins that
+   the weights were accumulated onto, so the arithmetic follows the original numpy code step by step */
+static size_t GiveWeightsGridCell(double u, double v, double freq, const WeightsGridArgs *wg)
+{
+    const double cc = 299792458.;
+    /* only the top half of the plane is gridded */
+    if( v<0 )
+    {
+        u = -u;
+        v = -v;
+    }
+    long int x = (long int)floor(u*freq/cc/wg->cell) + wg->xymax;
+    long int y = (long int)floor(v*freq/cc/wg->cell);
+    return (size_t)(y*wg->npixx + x);
+}
+
+/* Accumulates weights [nrow,nchan] onto the grid, computing the uv-bin of each visibility on the fly
+   from uv [nrow,2] (in metres), freqs [nchan] and bandmap [nchan] (band of each channel) */
+static PyObject *pyAccumulateWeightsOntoGridUV(PyObject *self, PyObject *args)
+{
+    WeightsGridArgs wg;
+    if( !ParseWeightsGridArgs(args, &wg) )
+        return NULL;
+
+    double * pgrid      = p_float64(wg.grid);
+    float * pweights    = p_float32(wg.weights);
+    double * puv        = p_float64(wg.uv);
+    double * pfreqs     = p_float64(wg.freqs);
+    long int * pbandmap = p_int64(wg.bandmap);
+    size_t nrow = wg.weights->dimensions[0];
+    size_t nchan = wg.weights->dimensions[1];
+    size_t irow, ich;
+
+    for( irow=0; irow<nrow; irow++ )
+    {
+        float *pw = pweights + irow*nchan;
+        for( ich=0; ich<nchan; ich++ )
+        {
+            float w = pw[ich];
+            if( w!=0 )
+            {
+                size_t igrid = GiveWeightsGridCell(puv[2*irow], puv[2*irow+1], pfreqs[ich], &wg) + pbandmap[ich]*wg.npix;
+                sem_t * psem = GiveSemaphoreFromCell(igrid);
+                sem_wait(psem);
+                pgrid[igrid] += w;
+                sem_post(psem);
+            }
+        }
+    }
+
+    Py_INCREF(Py_None);
+    return Py_None;
+}
+
+/* Divides weights [nrow,nchan] (in place) by the grid value at their uv-bin. Takes the same arguments as
+   pyAccumulateWeightsOntoGridUV(). Zero weights are left as they are */
+static PyObject *pyApplyWeightsGridUV(PyObject *self, PyObject *args)
+{
+    WeightsGridArgs wg;
+    if( !ParseWeightsGridArgs(args, &wg) )
+        return NULL;
+
+    double * pgrid      = p_float64(wg.grid);
+    float * pweights    = p_float32(wg.weights);
+    double * puv        = p_float64(wg.uv);
+    double * pfreqs     = p_float64(wg.freqs);
+    long int * pbandmap = p_int64(wg.bandmap);
+    size_t nrow = wg.weights->dimensions[0];
+    size_t nchan = wg.weights->dimensions[1];
+    size_t irow, ich;
+
+    for( irow=0; irow<nrow; irow++ )
+    {
+        float *pw = pweights + irow*nchan;
+        for( ich=0; ich<nchan; ich++ )
+            if( pw[ich]!=0 )
+            {
+                size_t igrid = GiveWeightsGridCell(puv[2*irow], puv[2*irow+1], pfreqs[ich], &wg) + pbandmap[ich]*wg.npix;
+                pw[ich] /= pgrid[igrid];
+            }
+    }
+
+    Py_INCREF(Py_None);
+    return Py_None;
+}
+
+//////////////////////////////////////////////////////////////////////
+/* BDA mapping blocks are stored as [ch0,ch1,rows...], with the block size (number of rows + 2) in the */
+/* size table. A negative size -N denotes a contiguous range of N rows, stored as [ch0,ch1,row0] */
+static inline int BlockNRows(int size){ return size<0 ? -size : size-2; }
+static inline int BlockStride(int size){ return size<0 ? 3 : size; }
+/* inx-th row of a block */
+#define BLOCK_ROW(Row,IsRange,inx) ((IsRange) ? (Row)[0]+(inx) : (Row)[inx])
+
 //////////////////////////////////////////////////////////////////////
 #define READ_4CORR \
   VisMeas[0]=visPtrMeas[0];\
@@ -299,7 +417,7 @@ void griddername(PyArrayObject *grid, \
     for(iBlock=0; iBlock<NTotBlocks; iBlock++){\
       if( sparsificationFlag && !sparsificationFlag[iBlock] )\
             continue;\
-      int NRowThisBlock=NRowBlocks[iBlock]-2;\
+      int NRowThisBlock=BlockNRows(NRowBlocks[iBlock]);\
       if(NRowThisBlock>NMaxRow){\
 	NMaxRow=NRowThisBlock;\
       }\
@@ -354,15 +472,15 @@ void griddername(PyArrayObject *grid, \
     float *ThisSumSqWeightsChan=calloc(1,(nVisChan)*sizeof(float));\
     \
     for(iBlock=0; iBlock<NTotBlocks; iBlock++){\
-      if( sparsificationFlag && !sparsificationFlag[iBlock] )\
-	continue;\
-      \
-      int NRowThisBlock=NRowBlocks[iBlock]-2;\
+      int NRowThisBlock=BlockNRows(NRowBlocks[iBlock]);\
+      int RowIsRange=NRowBlocks[iBlock]<0;\
       int chStart = StartRow[0];\
       int chEnd = StartRow[1];\
       int *Row = StartRow+2;\
-      /* advance pointer to next blocklist*/\
-      StartRow += NRowBlocks[iBlock];\
+      /* advance pointer to next blocklist. This must be done for skipped blocks too */\
+      StartRow += BlockStride(NRowBlocks[iBlock]);\
+      if( sparsificationFlag && !sparsificationFlag[iBlock] )\
+	continue;\
       \
       float Umean=0;\
       float Vmean=0;\
@@ -395,14 +513,14 @@ void griddername(PyArrayObject *grid, \
       resetJonesServerCounter();\
       \
       for (inx=0; inx<NRowThisBlock; inx++) {\
-	size_t irow = Row[inx];\
+	size_t irow = BLOCK_ROW(Row,RowIsRange,inx);\
 	if(irow>nrows){continue;}\
 	double*  __restrict__ uvwPtr   = p_float64(uvw) + irow*3;\
 	WeightVaryJJ=1.;\
 	\
 	float DeCorrFactor=1.;\
 	if(DoDecorr){\
-	  int iRowMeanThisBlock=Row[NRowThisBlock/2];\
+	  int iRowMeanThisBlock=BLOCK_ROW(Row,RowIsRange,NRowThisBlock/2);\
 	  \
 	  double*  __restrict__ uvwPtrMidRow   = p_float64(uvw) + iRowMeanThisBlock*3;\
 	  double*  __restrict__ uvw_dt_PtrMidRow   = uvw_dt_Ptr + iRowMeanThisBlock*3;\
@@ -1456,7 +1574,7 @@ void degriddername(PyArrayObject *grid, \
     \
     int NMaxRow=0;\
     for(iBlock=0; iBlock<NTotBlocks; iBlock++){\
-      int NRowThisBlock=NRowBlocks[iBlock]-2;\
+      int NRowThisBlock=BlockNRows(NRowBlocks[iBlock]);\
       if(NRowThisBlock>NMaxRow){\
 	NMaxRow=NRowThisBlock;\
       }\
@@ -1477,12 +1595,13 @@ void degriddername(PyArrayObject *grid, \
     initJonesServer(LJones,JonesType,WaveLengthMean);\
     \
     for(iBlock=0; iBlock<NTotBlocks; iBlock++){\
-      int NRowThisBlock=NRowBlocks[iBlock]-2;\
+      int NRowThisBlock=BlockNRows(NRowBlocks[iBlock]);\
+      int RowIsRange=NRowBlocks[iBlock]<0;\
       int chStart = StartRow[0];\
       int chEnd = StartRow[1];\
       int *Row = StartRow+2;\
       /* advance pointer to next blocklist */\
-      StartRow += NRowBlocks[iBlock];\
+      StartRow += BlockStride(NRowBlocks[iBlock]);\
       \
       float complex Vis[4]={0};\
       float Umean=0;\
@@ -1494,7 +1613,7 @@ void degriddername(PyArrayObject *grid, \
       float visChanMean=0.;\
       resetJonesServerCounter();\
       for (inx=0; inx<NRowThisBlock; inx++) {\
-	size_t irow = Row[inx];\
+	size_t irow = BLOCK_ROW(Row,RowIsRange,inx);\
 	if(irow>nrows){continue;}\
 	double*  __restrict__ uvwPtr   = p_float64(uvw) + irow*3;\
 	\
@@ -1627,7 +1746,7 @@ void degriddername(PyArrayObject *grid, \
 	  \
 	  float DeCorrFactor=1.;\
 	  if(DoDecorr){\
-	    int iRowMeanThisBlock=Row[NRowThisBlock/2];\
+	    int iRowMeanThisBlock=BLOCK_ROW(Row,RowIsRange,NRowThisBlock/2);\
 	    \
 	    double*  __restrict__ uvwPtrMidRow   = p_float64(uvw) + iRowMeanThisBlock*3;\
 	    double*  __restrict__ uvw_dt_PtrMidRow   = uvw_dt_Ptr + iRowMeanThisBlock*3;\
@@ -1643,7 +1762,7 @@ void degriddername(PyArrayObject *grid, \
 	  }\
 	  \
 	  for (inx=0; inx<NRowThisBlock; inx++) {\
-	      size_t irow = Row[inx];\
+	      size_t irow = BLOCK_ROW(Row,RowIsRange,inx);\
 	      if(irow>nrows){continue;}\
 	      double*  __restrict__ uvwPtr   = p_float64(uvw) + irow*3;\
 	      \
@@ -108,6 +108,8 @@ void MatInv(float complex *A, float complex* B, int H );
 static PyObject *pyGridderPoints(PyObject *self, PyObject *args);
 
 static PyObject *pyAccumulateWeightsOntoGrid(PyObject *self, PyObject *args);
+static PyObject *pyAccumulateWeightsOntoGridUV(PyObject *self, PyObject *args);
+static PyObject *pyApplyWeightsGridUV(PyObject *self, PyObject *args);
 
 
 static PyObject *pyGridderWPol(PyObject *self, PyObject *args);
@@ -467,9 +467,12 @@ class ClassDDEGridMachine():
     @staticmethod
     def verifyCFDict(cf_dict, nw):
         """Checks that cf_dict has all the correct entries"""
-        for key in "SW", "Sphe", "W", "CuCv", "wmax":
+        for key in "SW", "Sphe", "CuCv", "wmax":
             if key not in cf_dict:
                 raise KeyError(key)
+        # w-planes are either in the dict, or in the W-kernel bank
+        if "W" not in cf_dict and "WKey" not in cf_dict:
+            raise KeyError("W")
 
     def InitCF(self, cf_dict, compute_cf, wmax):
         T = ClassTimeIt.ClassTimeIt("InitCF_ClassDDEGridMachine")
@@ -484,7 +487,8 @@ class ClassDDEGridMachine():
                                               lmShift=self.lmShift,
                                               cf_dict=cf_dict,
                                               compute_cf=compute_cf,
-                                              IDFacet=self.IDFacet)
+                                              IDFacet=self.IDFacet,
+                                              wbank_tol=self.GD["CF"]["WKernelTol"])
         T.timeit("2")
         self.ifzfCF = self.WTerm.ifzfCF
 
@@ -850,6 +854,14 @@ class ClassDDEGridMachine():
             if not(Jones.flags.c_contiguous):
                 raise NameError("Jones has to be contiguous")
 
+    def transformModel(self, ModelImage):
+        """Fourier transforms model image into a model grid for degridding"""
+        if self.GD["RIME"]["Precision"]=="S": 
+            Cast=np.complex64
+        elif self.GD["RIME"]["Precision"]=="D": 
+            Cast=np.complex128
+        return np.complex64(self.getFFTWMachine().fft(Cast(ModelImage)))
+
     def get(self, 
             times, 
             uvw, 
@@ -882,11 +894,7 @@ class ClassDDEGridMachine():
         if TranformModelInput == "FT":
             if np.max(np.abs(ModelImage)) == 0:
                 return vis
-            if self.GD["RIME"]["Precision"]=="S": 
-                Cast=np.complex64
-            elif self.GD["RIME"]["Precision"]=="D": 
-                Cast=np.complex128
-            Grid = np.complex64(self.getFFTWMachine().fft(Cast(ModelImage)))
+            Grid = self.transformModel(ModelImage)
 
         if freqs.size > 1:
             df = freqs[1::] - freqs[0:-1]
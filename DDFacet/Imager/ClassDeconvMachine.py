@@ -118,6 +118,8 @@ class ClassImagerDeconv():
         self.PSFFacets = self.GD["Facets"]["PSFFacets"]
         self.HasDeconvolved=False
         self.Parallel = self.GD["Parallel"]["NCPU"] != 1
+        self.PipelineChunks = self.GD["Parallel"]["PipelineChunks"]
+        self.DeltaPredict = self.GD["Cache"]["DeltaPredict"]
         self.ModConstructor = ClassModModelMachine(self.GD)
 
         self.PredictMode = self.GD["RIME"]["ForwardMode"]
@@ -153,8 +155,11 @@ class ClassImagerDeconv():
         AsyncProcessPool.init(ncpu=self.GD["Parallel"]["NCPU"],
                               affinity=self.GD["Parallel"]["Affinity"],
                               parent_affinity=self.GD["Parallel"]["MainProcessAffinity"],
+                              num_io_processes=self.GD["Parallel"]["IOProcesses"],
                               verbose=self.GD["Debug"]["APPVerbose"],
                               pause_on_start=self.GD["Debug"]["PauseWorkers"])
+        if self.GD["Debug"]["JobTrace"] != "off":
+            APP.enableTrace("%s.jobtrace.json" % self.BaseName, self.GD["Debug"]["JobTrace"])
 
         self.VS = ClassVisServer.ClassVisServer(mslist,ColName=self.do_readcol and DC["Data"]["ColName"],
                                                 TChunkSize=DC["Data"]["ChunkHours"],
@@ -295,11 +300,18 @@ class ClassImagerDeconv():
             MainFacetOptions['PolMode'],MainFacetOptions['Mode'],MainFacetOptions['Robust'])
         return MainFacetOptions
 
+    def _createMSCacheKey(self):
+        """Creates cache key identifying the input data (MSs and the columns we read from them)"""
+        colname = self.GD["Data"]["ColName"]
+        return dict(MS=[ms.getCacheKey("ANTENNA1", "ANTENNA2", "TIME", "UVW", "FLAG", colname,
+                                       "WEIGHT", "WEIGHT_SPECTRUM") for ms in self.VS.ListMS],
+                    ColName=colname)
+
     def _createDirtyPSFCacheKey(self, sparsify=0):
         """Creates cache key used for Dirty and PSF caches"""
-        key = dict([("MSNames", [ms.MSName for ms in self.VS.ListMS])] +
-                    [(section, self.GD[section]) for section in
-                     "Data", "Beam", "Selection",
+        key = dict(self._createMSCacheKey().items() +
+                    [(section, copy.deepcopy(self.GD[section])) for section in
+                     "Beam", "Selection",
                      "Freq", "Image", "Comp",
                      "CF", "RIME","Facets","Weight","DDESolutions"]+
                    [("InitDicoModel",self.GD["Predict"]["InitDicoModel"])]
@@ -472,6 +484,29 @@ class ClassImagerDeconv():
         self._fitAndSavePSF(self.FacetMachinePSF)
 
 
+    def _pipelineChunks(self):
+        """
+        Returns True if gridding of each chunk is to overlap with degridding of the next one (see
+        ClassFacetMachine.gridChunkInBackground()). Only makes sense with more than one chunk.
+        """
+        return bool(self.PipelineChunks) and self.VS.nTotalChunks > 1
+
+    def _deltaPredict(self):
+        """
+        Returns True if residual visibilities are to be cached between major cycles, so that only the change
+        in the model needs to be degridded (see ClassVisServer.startResidualSaveInBackground()).
+        """
+        return bool(self.DeltaPredict) and self.PredictMode in ("BDA-degrid", "DeGridder")
+
+    def _collectGridding(self, FacetMachines, keep=0):
+        """
+        Collects results of gridding jobs of the given FacetMachines, leaving the most recent 'keep' passes
+        outstanding, then releases the previous chunk (if kept by the VisServer), as its gridding is now done.
+        """
+        for FacetMachine in FacetMachines:
+            FacetMachine.collectGriddingResults(keep=keep)
+        self.VS.releasePreviousChunk()
+
     def GiveDirty(self, psf=False, sparsify=0, last_cycle=False):
         """
         Generates dirty image (& PSF)
@@ -546,23 +581,30 @@ class ClassImagerDeconv():
                 self.FacetMachinePSF.ReinitDirty()
 
 
+            gridding_machines = []
+            if not dirty_valid:
+                gridding_machines.append(self.FacetMachine)
+            if psf and not psf_valid and self.FacetMachinePSF is not None:
+                gridding_machines.append(self.FacetMachinePSF)
+            pipeline = self._pipelineChunks()
+
             iloop = 0
             while True:
                 # note that collectLoadedChunk() will destroy the current DATA dict, so we must make sure
-                # the gridding jobs of the previous chunk are finished
-                if not dirty_valid:
-                    self.FacetMachine.collectGriddingResults()
-                if psf and not psf_valid and self.FacetMachinePSF is not None:
-                    self.FacetMachinePSF.collectGriddingResults()
+                # the gridding jobs of the previous chunk are finished. In pipelined mode, the previous chunk
+                # is kept instead, and its gridding jobs are collected once this chunk's gridding has been queued
+                if not pipeline:
+                    self._collectGridding(gridding_machines)
 
                 # get loaded chunk from I/O thread, schedule next chunk
                 # self.VS.startChunkLoadInBackground()
-                DATA = self.VS.collectLoadedChunk(start_next=True)
+                DATA = self.VS.collectLoadedChunk(start_next=True, keep_previous=pipeline)
                 if type(DATA) is str:
                     print>>log,ModColor.Str("no more data: %s"%DATA, col="red")
                     break
                 # None weights indicates an all-flagged chunk: go on to the next chunk
                 if DATA["Weights"] is None:
+                    self._collectGridding(gridding_machines)
                     continue
                 print>>log,"sparsify %f"%sparsify
                 self.FacetMachine.applySparsification(DATA, sparsify)
@@ -590,13 +632,10 @@ class ClassImagerDeconv():
                 # Stacks average beam if not computed
                 self.FacetMachine.StackAverageBeam(DATA)
 
-                if not dirty_valid:
-                    # commented out. @cyriltasse to uncomment when fixed
-                    self.FacetMachine.putChunkInBackground(DATA)
-
-
-                if psf and not psf_valid and self.FacetMachinePSF is not None:
-                    self.FacetMachinePSF.putChunkInBackground(DATA)
+                for FacetMachine in gridding_machines:
+                    FacetMachine.putChunkInBackground(DATA, pipelined=pipeline)
+                if pipeline:
+                    self._collectGridding(gridding_machines, keep=1)
                 ## disabled this, doesn't like in-place FFTs
                 # # collect intermediate grids, if asked to
                 # if self._save_intermediate_grids:
@@ -611,6 +650,8 @@ class ClassImagerDeconv():
 
                 iloop += 1
 
+            # wait for gridding to finish, and release the last chunk kept for it
+            self._collectGridding(gridding_machines)
 
             if not dirty_valid:
                 # if Smooth beam enabled, either compute it from the stack, or get it from cache
@@ -906,8 +947,12 @@ class ClassImagerDeconv():
                                 RefFreq=self.VS.RefFreq)
 
         continue_deconv = True
+        # full model images degridded in the previous major cycle, per set of degridding frequencies. In
+        # delta-predict mode, chunks loaded from the residuals of that cycle only need the difference to be degridded
+        degridded_models = {}
 
         for iMajor in range(1, NMajor+1):
+            APP.traceCheckpoint("major cycle %d" % (iMajor-1) if iMajor > 1 else "initialization")
             # good to recreate the workers now, to drop their RAM
             APP.restartWorkers()
             # previous minor loop indicated it has reached bottom? Break out
@@ -959,6 +1004,13 @@ class ClassImagerDeconv():
                 print>> log, "Finished Deconvolving for this major cycle... Going back to visibility space."
             predict_colname = not continue_deconv and self.GD["Predict"]["ColName"]
 
+            # in delta-predict mode, load chunks from the residuals cached by the previous major cycle. Not when
+            # predicting into a column though, since that needs the original data
+            self.VS.setResidualLoadVersion(iMajor-1 if self._deltaPredict() and not predict_colname else None)
+            # residuals only need to be cached if there's another major cycle to follow
+            save_residuals = self._deltaPredict() and continue_deconv
+            current_models = {}
+
             # in the meantime, tell the I/O thread to go reload the first data chunk
             self.VS.ReInitChunkCount()
             self.VS.startChunkLoadInBackground()
@@ -997,23 +1049,32 @@ class ClassImagerDeconv():
             previous_sparsify = sparsify
 
             current_model_freqs = np.array([])
+            current_model_delta = False
             ModelImage = None
             HasWrittenModel=False
+            gridding_machines = [self.FacetMachine]
+            if self.FacetMachinePSF is not None:
+                self.FacetMachinePSF.collectGriddingResults()
+                if do_psf:
+                    gridding_machines.append(self.FacetMachinePSF)
+            pipeline = self._pipelineChunks()
             while True:
                 # note that collectLoadedChunk() will destroy the current DATA dict, so we must make sure
-                # the gridding jobs of the previous chunk are finished
-                self.FacetMachine.collectGriddingResults()
-                if self.FacetMachinePSF is not None:
-                    self.FacetMachinePSF.collectGriddingResults()
+                # the gridding jobs of the previous chunk are finished. In pipelined mode, the previous chunk
+                # is kept instead, and its gridding jobs are collected once this chunk's gridding has been queued
+                if not pipeline:
+                    self._collectGridding(gridding_machines)
                 self.VS.collectPutColumnResults()  # if these were going on
+                self.VS.collectResidualSaveResults()
                 # get loaded chunk from I/O thread, schedule next chunk
                 # note that if we're writing predict data out, DON'T schedule until we're done writing this one
-                DATA = self.VS.collectLoadedChunk(start_next=not predict_colname)
+                DATA = self.VS.collectLoadedChunk(start_next=not predict_colname, keep_previous=pipeline)
                 if type(DATA) is str:
                     print>>log,ModColor.Str("no more data: %s"%DATA, col="red")
                     break
                 # None weights indicates an all-flagged chunk: go on to the next chunk
                 if DATA["Weights"] is None:
+                    self._collectGridding(gridding_machines)
                     continue
                 visdata = DATA["data"]
                 if predict_colname:
@@ -1021,15 +1082,28 @@ class ClassImagerDeconv():
                     np.copyto(predict, visdata)
                 # sparsify the data according to current levels
                 self.FacetMachine.applySparsification(DATA, sparsify)
-                ## redo model image if needed
+                ## redo model image if needed. Chunks loaded from cached residuals get the change in the model
+                ## since the previous major cycle instead
                 model_freqs = DATA["FreqMappingDegrid"]
-                if not np.array_equal(model_freqs, current_model_freqs):
-                    ModelImage = self.FacetMachine.setModelImage(self.DeconvMachine.GiveModelImage(model_freqs))
+                model_delta = DATA.get("IsResidual", False)
+                if not np.array_equal(model_freqs, current_model_freqs) or model_delta != current_model_delta:
+                    FullModelImage = self.DeconvMachine.GiveModelImage(model_freqs)
+                    if save_residuals:
+                        current_models[tuple(model_freqs)] = FullModelImage
+                    if model_delta:
+                        PreviousModelImage = degridded_models.get(tuple(model_freqs))
+                        if PreviousModelImage is None:
+                            raise RuntimeError("no model image from previous major cycle for cached residuals. This is a bug!")
+                        ModelImage = self.FacetMachine.setModelImage(FullModelImage - PreviousModelImage)
+                        print>>log,"degridding change in model since previous major cycle (min,max) = (%f, %f)"%(ModelImage.min(),ModelImage.max())
+                    else:
+                        ModelImage = self.FacetMachine.setModelImage(FullModelImage)
                     # write out model image, if asked to
                     current_model_freqs = model_freqs
-                    print>>log,"model image @%s MHz (min,max) = (%f, %f)"%(str(model_freqs/1e6),ModelImage.min(),ModelImage.max())
+                    current_model_delta = model_delta
+                    print>>log,"model image @%s MHz (min,max) = (%f, %f)"%(str(model_freqs/1e6),FullModelImage.min(),FullModelImage.max())
                     if "o" in self._saveims and not HasWrittenModel:
-                        self.FacetMachine.ToCasaImage(ModelImage, ImageName="%s.model%2.2i" % (self.BaseName, iMajor),
+                        self.FacetMachine.ToCasaImage(FullModelImage, ImageName="%s.model%2.2i" % (self.BaseName, iMajor),
                                                       Fits=True, Freqs=current_model_freqs,
                                                       Stokes=self.VS.StokesConverter.RequiredStokesProducts())
                         HasWrittenModel=True
@@ -1072,13 +1146,20 @@ class ClassImagerDeconv():
                 # Stacks average beam if not computed
                 self.FacetMachine.StackAverageBeam(DATA)
 
-                self.FacetMachine.putChunkInBackground(DATA)
+                self.FacetMachine.putChunkInBackground(DATA, pipelined=pipeline)
                 if do_psf:
-                    self.FacetMachinePSF.putChunkInBackground(DATA)
+                    self.FacetMachinePSF.putChunkInBackground(DATA, pipelined=pipeline)
+                # degridding is done by now, so the chunk holds residuals: cache them for the next major cycle
+                if save_residuals:
+                    self.VS.startResidualSaveInBackground(DATA, iMajor)
+                if pipeline:
+                    self._collectGridding(gridding_machines, keep=1)
 
             # wait for gridding to finish
-            self.FacetMachine.collectGriddingResults()
+            self._collectGridding(gridding_machines)
             self.VS.collectPutColumnResults()  # if these were going on
+            self.VS.collectResidualSaveResults()
+            degridded_models = current_models
             # release model image from memory
             ModelImage = None
             self.FacetMachine.releaseModelImage()
@@ -1118,8 +1199,8 @@ class ClassImagerDeconv():
             if self.GD["Cache"]["LastResidual"] and self.DicoDirty is not None:
                 cachepath, valid = self.VS.maincache.checkCache("LastResidual", 
                                                                 dict(
-                                                                    [("MSNames", [ms.MSName for ms in self.VS.ListMS])] +
-                                                                    [(section, self.GD[section]) for section in "Data", "Beam", "Selection",
+                                                                    self._createMSCacheKey().items() +
+                                                                    [(section, self.GD[section]) for section in "Beam", "Selection",
                                                                      "Freq", "Image", "Comp",
                                                                      "RIME","Weight","Facets",
                                                                      "DDESolutions"]
@@ -1134,14 +1215,15 @@ class ClassImagerDeconv():
                     print>> log, traceback.format_exc()
                     print>> log, ModColor.Str("WARNING: Residual image cache could not be written, see error report above. Proceeding anyway.")
 
+        APP.traceCheckpoint("last major cycle")
         self.FacetMachine.finaliseSmoothBeam()
 
         # dump dirty to cache
         if self.GD["Cache"]["LastResidual"] and self.DicoDirty is not None:
             cachepath, valid = self.VS.maincache.checkCache("LastResidual",
                                                             dict(
-                                                                [("MSNames", [ms.MSName for ms in self.VS.ListMS])] +
-                                                                [(section, self.GD[section]) for section in "Data", "Beam", "Selection",
+                                                                self._createMSCacheKey().items() +
+                                                                [(section, self.GD[section]) for section in "Beam", "Selection",
                                                                  "Freq", "Image", "Comp",
                                                                  "RIME","Weight","Facets",
                                                                  "DDESolutions"]
@@ -1156,6 +1238,7 @@ class ClassImagerDeconv():
                 print>> log, ModColor.Str("WARNING: Residual image cache could not be written, see error report above. Proceeding anyway.")
 
         # delete shared dicts that are no longer needed, since Restore() will need memory
+        self.VS.releaseResidualCache()
         self.VS.releaseLoadedChunk()
         self.FacetMachine.releaseGrids()
         if self.FacetMachinePSF is not None:
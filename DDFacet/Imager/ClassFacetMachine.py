@@ -19,6 +19,7 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 '''
 
 import ClassDDEGridMachine
+import ModCF
 import numpy as np
 import ClassCasaImage
 import pyfftw
@@ -30,11 +31,15 @@ from DDFacet.Other.progressbar import ProgressBar
 import cPickle
 import atexit
 import traceback
+import os
+import shutil
+import fcntl
 from matplotlib.path import Path
 import numpy.random
 from DDFacet.ToolsDir import ModCoord
 from DDFacet.Array import NpShared
 from DDFacet.Array import shared_dict
+from DDFacet.Data import ClassJones
 from DDFacet.ToolsDir import ModFFTW
 from DDFacet.Other import ClassTimeIt
 from DDFacet.Other import Multiprocessing
@@ -45,6 +50,7 @@ from DDFacet.Imager.ClassImToGrid import ClassImToGrid
 from DDFacet.cbuild.Gridder import _pyGridderSmearPols
 #from DDFacet.Array import NpParallel
 from DDFacet.Other import MyLogger
+from DDFacet.Other.CacheManager import CacheManager
 log=MyLogger.getLogger("ClassFacetMachine")
 from DDFacet.Other.AsyncProcessPool import APP
 import numexpr
@@ -54,7 +60,28 @@ from DDFacet.Other import ModColor
 MyLogger.setSilent("MyLogger")
 import cpuinfo
 from DDFacet.ToolsDir import ModFFTW
+from DDFacet.Data import ClassSmearMapping
 import scipy.ndimage
+import psutil
+
+class FacetGridLock(object):
+    """
+    Exclusive lock on the grid of one facet, held across processes. Gridding jobs of consecutive chunks may
+    run concurrently (see gridChunkInBackground()), this keeps jobs on the same facet apart.
+    """
+    def __init__(self, griddict, iFacet):
+        self._path = os.path.join(griddict.path + ":locks", str(iFacet))
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self._path, "w")
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        # closing the file releases the lock
+        self._file.close()
+        self._file = None
 
 class ClassFacetMachine():
     """
@@ -125,8 +152,12 @@ class ClassFacetMachine():
         self.FacetNorm = None
 
         self._facet_grids = self.DATA = None
-        self._grid_job_id = self._fft_job_id = self._degrid_job_id = None
+        self._fft_job_id = self._degrid_job_id = None
+        # outstanding gridding passes, as a list of (job_id, label, iMS) tuples, oldest first
+        self._grid_passes = []
         self._smooth_job_label=None
+        # number of jobs the gridding of each facet is split over (see _gridSplit()), determined on first use
+        self._grid_split = None
 
         # create semaphores if not already created
         if not ClassFacetMachine._degridding_semaphores:
@@ -137,6 +168,10 @@ class ClassFacetMachine():
 
         # this is used to store model images in shared memory, for the degridder
         self._model_dict = None
+        # this is used to store FFTed facet model grids for the degridder, per channel selection. These are
+        # computed once per model image (see _getModelGrids()), and reused by every chunk
+        self._model_grids = None
+        self._model_version = 0
         # this is used to store NormImage in shared memory, for the degridder
         self._norm_dict = None
 
@@ -158,6 +193,7 @@ class ClassFacetMachine():
 
     def releaseGrids(self):
         if self._facet_grids is not None:
+            shutil.rmtree(self._facet_grids.path + ":locks", ignore_errors=True)
             self._facet_grids.delete()
             self._facet_grids = None
         for GM in self.DicoGridMachine.itervalues():
@@ -609,9 +645,12 @@ class ClassFacetMachine():
             print>>log,"max w=%.6g from MS (--CF-wmax=0)"%wmax
         # subprocesses will place W-terms etc. here. Reset this first.
         self._CF = shared_dict.create("CFPSF" if self.DoPSF else "CF")
+        # w-kernels go into the bank shared by all facets (and by the PSF and image facet machines)
+        ModCF.attachWBank()
         # check if w-kernels, spacial weights, etc. are cached
-        cachekey = dict(ImagerCF=self.GD["CF"], 
-                        ImagerMainFacet=self.GD["Image"], 
+        # (the w-kernels depend on the actual wmax, which is determined from the data if not set explicitly)
+        cachekey = dict(ImagerCF=dict(self.GD["CF"], wmax=wmax),
+                        ImagerMainFacet=CacheManager.selectKeys(self.GD["Image"], "NPix", "Cell", "PhaseCenterRADEC"),
                         Facets=self.GD["Facets"], 
                         RIME=self.GD["RIME"])
         cachename = self._cf_cachename = "CF"
@@ -629,18 +668,44 @@ class ClassFacetMachine():
         #workers_res=APP.awaitJobResults("%s.InitCF.*"%self._app_id, progress="Init CFs")
 
 
+    @staticmethod
+    def _saveCFCache(path, facet_dict):
+        """
+        Saves facet CF dict to cache directory path, one uncompressed .npy file per entry, so that they can be
+        memory-mapped on reload. The directory is written under a temporary name and renamed when complete.
+        """
+        tmppath = path + ".tmp"
+        if os.path.exists(tmppath):
+            shutil.rmtree(tmppath)
+        os.mkdir(tmppath)
+        for key in facet_dict.keys():
+            np.save(os.path.join(tmppath, "%s.npy" % key), facet_dict[key])
+        os.rename(tmppath, path)
+
+    @staticmethod
+    def _loadCFCache(path, facet_dict):
+        """Loads facet CF dict saved by _saveCFCache(). Arrays are memory-mapped and copied straight into SHM"""
+        for filename in os.listdir(path):
+            if filename.endswith(".npy"):
+                value = np.load(os.path.join(path, filename), mmap_mode="r")
+                # scalars (wmax, WKey) are stored as 0-d arrays
+                facet_dict[filename[:-4]] = value[()] if value.ndim == 0 else value
+
     def _initcf_worker (self, iFacet, facet_dict, cachepath, cachevalid, wmax):
         """Worker method of InitParal"""
-        path = "%s/%s.npz" % (cachepath, iFacet)
+        path = "%s/%s" % (cachepath, iFacet)
+        # w-kernels are cached per W-kernel bank entry, since facets share them
+        wbank_path = "%s/WBank" % cachepath
+        wbank = shared_dict.attach(ModCF.WBANK_NAME)
         T=ClassTimeIt.ClassTimeIt("_initcf_worker")
         # try to load the cache, and copy it to the shared facet dict
         if cachevalid:
             try:
-                npzfile = np.load(file(path))
-                for key, value in npzfile.iteritems():
-                    facet_dict[key] = value
+                self._loadCFCache(path, facet_dict)
                 # validate dict
                 ClassDDEGridMachine.ClassDDEGridMachine.verifyCFDict(facet_dict, self.GD["CF"]["Nw"])
+                if "WKey" in facet_dict:
+                    ModCF.loadWBankEntry(wbank, str(facet_dict["WKey"]), wbank_path)
                 return "cached",path,iFacet
             except:
                 print>>log,traceback.format_exc()
@@ -682,36 +747,26 @@ class ClassFacetMachine():
         # Initialize a grid machine per iFacet, this will implicitly compute wterm and Sphe
         self._createGridMachine(iFacet, cf_dict=facet_dict, compute_cf=True, wmax=wmax)
 
-        # # save cache
-        # DoPrintErr=False
-        # while True:
-        #     try:
-        #         np.savez(file(path, "w"), **facet_dict)
-        #         if DoPrintErr:
-        #             print>>log,ModColor.Str("  ok could save %s"%path,col="green")
-        #         break
-        #     except:
-        #         import time
-        #         DoPrintErr=True
-        #         print>>log,ModColor.Str("Failed to save %s"%path)
-        #         time.sleep(1.)
+        # save cache. Each worker saves its own facets, so this happens in parallel
+        try:
+            if "WKey" in facet_dict:
+                ModCF.saveWBankEntry(wbank, facet_dict["WKey"], wbank_path)
+            self._saveCFCache(path, facet_dict)
+        except:
+            print>>log,traceback.format_exc()
+            print>>log,ModColor.Str("Failed to save %s, facet will be re-generated next time" % path)
+            return "nosave", path, iFacet
         return "compute",path, iFacet
 
     def awaitInitCompletion (self):
         if not self.IsDDEGridMachineInit:
             workers_res=APP.awaitJobResults("%s.InitCF.*"%self._app_id, progress="Init CFs")
             self._CF.reload()
-            # mark cache as safe
-            for res in workers_res:
-                Type,path,iFacet=res
-                if Type=="compute":
-                    #print iFacet
-                    facet_dict=self._CF[iFacet]
-                    d={}
-                    for key in facet_dict.keys():
-                        d[key]=facet_dict[key]
-                    np.savez(file(path, "w"), **d)
-            self.VS.maincache.saveCache(self._cf_cachename)
+            # workers have saved their facets, so mark cache as safe, unless some of them failed to
+            if all([ isinstance(res, tuple) and res[0] in ("compute", "cached") for res in workers_res ]):
+                self.VS.maincache.saveCache(self._cf_cachename)
+            else:
+                print>>log,ModColor.Str("some CF facets could not be cached, CF cache will not be marked as valid")
             self.IsDDEGridMachineInit = True
 
     def setCasaImage(self, ImageName=None, Shape=None, Freqs=None, Stokes=["I"]):
@@ -768,13 +823,14 @@ class ClassFacetMachine():
         """
         return np.zeros(self.OutImShape, dtype=self.stitchedType)
 
-    def putChunkInBackground(self, DATA):
+    def putChunkInBackground(self, DATA, pipelined=False):
         """
+        Grids chunk in the background. See gridChunkInBackground() for the pipelined argument.
         """
         self.SetLogModeSubModules("Silent")
         if not self.IsDirtyInit:
             self.ReinitDirty()
-        self.gridChunkInBackground(DATA)
+        self.gridChunkInBackground(DATA, pipelined=pipelined)
         self.SetLogModeSubModules("Loud")
 
     def getChunkInBackground(self, DATA):
@@ -794,6 +850,10 @@ class ClassFacetMachine():
         self._model_dict["Image"] = ModelImage
         for iFacet in range(self.NFacets):
             self._model_dict.addSubdict(iFacet)
+        # model has changed, so any model grids are out of date
+        self._releaseModelGrids()
+        self._model_version += 1
+        self._model_grids = shared_dict.create("ModelGrids:%d" % self._model_version)
         return self._model_dict["Image"]
 
     def releaseModelImage(self):
@@ -801,6 +861,43 @@ class ClassFacetMachine():
         if self._model_dict is not None:
             self._model_dict.delete()
             self._model_dict = None
+        self._releaseModelGrids()
+
+    def _releaseModelGrids(self):
+        """Deletes model grids from SHM"""
+        if self._model_grids is not None:
+            self._model_grids.delete()
+            self._model_grids = None
+
+    def _getModelGrids(self, ChanSel):
+        """
+        Returns subdict of FFTed per-facet model grids for the given channel selection. The grids are computed
+        (in parallel) the first time a selection is requested after each setModelImage(), and reused for all
+        subsequent chunks. Facets with an empty model have a grid of None.
+        """
+        key = ",".join(map(str, ChanSel))
+        if key in self._model_grids:
+            return self._model_grids[key]
+        grids = self._model_grids.addSubdict(key)
+        facets = self.DicoImager.keys()
+        job_id = "%s.MakeModelGrid:" % self._app_id
+        APP.runJobs([ ("%sF%d" % (job_id, iFacet),
+                       (iFacet, self._model_dict.readonly(), self._CF[iFacet].readonly(), ChanSel, grids.writeonly()))
+                      for iFacet in facets ],
+                    self._make_model_grid_worker, costs=self._facetJobCosts(facets, fft=True))
+        APP.awaitJobResults(job_id + "*", progress="Make model grids")
+        grids.reload()
+        return grids
+
+    def _make_model_grid_worker(self, iFacet, model_dict, cf_dict, ChanSel, grids):
+        """Makes the FFTed model grid of a facet for degridding, and stores it in the grids dict"""
+        ModelImage = self._set_model_grid_worker(iFacet, model_dict, cf_dict, ChanSel)
+        if not np.any(ModelImage):
+            grids[iFacet] = None
+        else:
+            GridMachine = self._createGridMachine(iFacet, cf_dict=cf_dict)
+            grids[iFacet] = GridMachine.transformModel(ModelImage)
+        return {"iFacet": iFacet}
 
     def _buildFacetSlice_worker(self, iFacet, facet_grids, facetdict, cfdict, sumjonesnorm, sumweights, W):
         # first normalize by spheroidals - these
@@ -1294,6 +1391,8 @@ class ClassFacetMachine():
         # are we creating a new grids dict?
         if self._facet_grids is None:
             self._facet_grids = shared_dict.create("PSFGrid" if self.DoPSF else "Grid")
+            if not os.path.exists(self._facet_grids.path + ":locks"):
+                os.mkdir(self._facet_grids.path + ":locks")
 
         for iFacet in self.DicoGridMachine.keys():
             NX = self.DicoImager[iFacet]["NpixFacetPadded"]
@@ -1326,7 +1425,11 @@ class ClassFacetMachine():
             #DATA["Sparsification.Degrid"] = numpy.random.sample(num_blocks) < 1.0 / factor
             #print>> log, "applying sparsification factor of %f to %d BDA degrid blocks, left with %d" % (factor, num_blocks, DATA["Sparsification.Degrid"].sum())
 
-    def _grid_worker(self, iFacet, DATA, cf_dict, griddict):
+    def _grid_worker(self, iFacet, DATA, cf_dict, griddict, blocks=None):
+        """
+        Grids chunk onto facet. If blocks is a (block0, block1) tuple, only that range of BDA blocks is gridded,
+        into a private grid, which is then added to the facet grid (see _gridSplit()).
+        """
         T = ClassTimeIt.ClassTimeIt()
         T.disable()
 
@@ -1377,18 +1480,40 @@ class ClassFacetMachine():
         if Apply_killMS or Apply_Beam:
             DicoJonesMatrices = {}
         if Apply_killMS:
-            DicoJonesMatrices["DicoJones_killMS"] = DATA["killMS"]
+            DicoJonesMatrices["DicoJones_killMS"] = ClassJones.GiveJonesMatrices(DATA["killMS"])
         if Apply_Beam:
-            DicoJonesMatrices["DicoJones_Beam"] = DATA["Beam"]
-
-        GridMachine.put(times, uvwThis, visThis, flagsThis, A0A1, W,
-                        DoNormWeights=False,
-                        DicoJonesMatrices=DicoJonesMatrices,
-                        freqs=freqs, DoPSF=self.DoPSF,
-                        ChanMapping=ChanMapping,
-                        ResidueGrid=griddict[iFacet],
-                        sparsification=DATA.get("Sparsification.Grid")
-                        )
+            DicoJonesMatrices["DicoJones_Beam"] = ClassJones.GiveJonesMatrices(DATA["Beam"])
+
+        sparsification = DATA.get("Sparsification.Grid")
+        if blocks is None:
+            with FacetGridLock(griddict, iFacet):
+                GridMachine.put(times, uvwThis, visThis, flagsThis, A0A1, W,
+                                DoNormWeights=False,
+                                DicoJonesMatrices=DicoJonesMatrices,
+                                freqs=freqs, DoPSF=self.DoPSF,
+                                ChanMapping=ChanMapping,
+                                ResidueGrid=griddict[iFacet],
+                                sparsification=sparsification
+                                )
+        else:
+            # the sparsification vector doubles as a block selection
+            block0, block1 = blocks
+            mapping = DATA["BDA.Grid"]
+            selection = np.zeros(int(mapping[0]) + (int(mapping[1])<<32), np.bool)
+            selection[block0:block1] = True
+            if sparsification is not None and sparsification.size:
+                selection &= sparsification
+            grid = np.zeros_like(griddict[iFacet])
+            GridMachine.put(times, uvwThis, visThis, flagsThis, A0A1, W,
+                            DoNormWeights=False,
+                            DicoJonesMatrices=DicoJonesMatrices,
+                            freqs=freqs, DoPSF=self.DoPSF,
+                            ChanMapping=ChanMapping,
+                            ResidueGrid=grid,
+                            sparsification=selection
+                            )
+            with FacetGridLock(griddict, iFacet):
+                griddict[iFacet] += grid
         T.timeit("put %s" % iFacet)
 
         T.timeit("Grid")
@@ -1399,25 +1524,74 @@ class ClassFacetMachine():
 
         return {"iFacet": iFacet, "Weights": Sw, "SumJones": SumJones, "SumJonesChan": SumJonesChan}
 
-    def gridChunkInBackground(self, DATA):
+    def _facetJobCosts(self, facets, fft=False):
+        """
+        Returns list of relative costs of per-facet jobs, used by APP.runJobs() to schedule the largest facets first.
+        Gridding and degridding costs scale with the padded facet area, FFT costs with NlogN of that.
+        """
+        npix = np.array([ self.DicoImager[iFacet]["NpixFacetPadded"] for iFacet in facets ], np.float64)
+        costs = npix**2
+        if fft:
+            costs *= np.log2(npix**2)
+        return costs.tolist()
+
+    def _gridSplit(self):
+        """
+        Returns the number of jobs the gridding of each facet is split over. With fewer facets than CPUs, one job
+        per facet would leave most cores idle, so each facet's BDA blocks are split over several jobs, each
+        gridding into a private grid. --Parallel-GridSplit sets the number of jobs explicitly, else it is
+        NCPU/NFacets, as long as the private grids take up no more than half the available RAM.
+        """
+        if self._grid_split is None:
+            nsplit = self.GD["Parallel"]["GridSplit"]
+            nfacets = len(self.DicoImager)
+            if not nsplit:
+                nsplit = max(APP.ncpu // nfacets, 1)
+                if nsplit > 1:
+                    NX = max([ self.DicoImager[iFacet]["NpixFacetPadded"] for iFacet in self.DicoImager.keys() ])
+                    grid_bytes = self.VS.NFreqBands*self.npol*NX*NX*np.dtype(self.CType).itemsize
+                    nsplit = max(min(nsplit, int(psutil.virtual_memory().available/2 // (grid_bytes*nfacets))), 1)
+            self._grid_split = nsplit
+            if nsplit > 1:
+                print>>log, "gridding of each of %d facet(s) will be split over %d jobs" % (nfacets, nsplit)
+        return self._grid_split
+
+    def gridChunkInBackground(self, DATA, pipelined=False):
         """
         Grids a chunk of input visibilities onto many facets. Issues jobs to the compute threads.
         Visibility data is already in the data shared dict.
 
+        Gridding needs the degridding of the chunk (i.e. the model subtraction) to have completed on all facets,
+        so this waits for the degridding jobs. If pipelined is False, it also waits for the gridding jobs of
+        the previous chunk. If True, these may still be running (and the previous chunk's data must then be kept
+        around until collectGriddingResults() has been called on them): the jobs of this chunk are queued behind
+        them, and gridding jobs on the same facet take turns via FacetGridLock.
         """
         # wait for any init to finish
         self.awaitInitCompletion()
         # wait for any previous gridding/degridding jobs to finish, if still active
-        self.collectGriddingResults()
+        if not pipelined:
+            self.collectGriddingResults()
         self.collectDegriddingResults()
         # run new set of jobs
-        self._grid_iMS, self._grid_iChunk = DATA["iMS"], DATA["iChunk"]
-        self._grid_job_label = DATA["label"]
-        self._grid_job_id = "%s.Grid.%s:" % (self._app_id, self._grid_job_label)
-        for iFacet in self.DicoImager.keys():
-            APP.runJob("%sF%d" % (self._grid_job_id, iFacet), self._grid_worker,
-                            args=(iFacet, DATA.readonly(), self._CF[iFacet].readonly(),
-                                  self._facet_grids.readonly()))
+        label = DATA["label"]
+        job_id = "%s.Grid.%s:" % (self._app_id, label)
+        self._grid_passes.append((job_id, label, DATA["iMS"]))
+        facets = self.DicoImager.keys()
+        nsplit = self._gridSplit()
+        block_ranges = ClassSmearMapping.GiveBlockRanges(DATA["BDA.Grid"], nsplit) if nsplit > 1 else []
+        if len(block_ranges) > 1:
+            costs = self._facetJobCosts(facets)
+            APP.runJobs([ ("%sF%d.%d" % (job_id, iFacet, ipart),
+                           (iFacet, DATA.readonly(), self._CF[iFacet].readonly(), self._facet_grids.readonly(), blocks))
+                          for iFacet in facets for ipart, blocks in enumerate(block_ranges) ],
+                        self._grid_worker,
+                        costs=[ cost/len(block_ranges) for cost in costs for _ in block_ranges ])
+        else:
+            APP.runJobs([ ("%sF%d" % (job_id, iFacet),
+                           (iFacet, DATA.readonly(), self._CF[iFacet].readonly(), self._facet_grids.readonly()))
+                          for iFacet in facets ],
+                        self._grid_worker, costs=self._facetJobCosts(facets))
 
     # ##############################################
     # ##### Smooth beam ############################
@@ -1433,9 +1607,9 @@ class ClassFacetMachine():
             return
         # wait for any init to finish
         self.awaitInitCompletion()
-        # wait for any previous gridding/degridding jobs to finish, if still active
-        self.collectGriddingResults()
-        self.collectDegriddingResults()
+        # the stacking jobs only read the chunk's metadata, weights and flags, so they need not wait for any
+        # gridding or degridding, but they do accumulate into the same stacked beam as the previous chunk's
+        self._collectStackBeam()
         # run new set of jobs
         self._smooth_job_label=DATA["label"]
         JobName="StackBeam%sF"%self._smooth_job_label
@@ -1445,6 +1619,15 @@ class ClassFacetMachine():
                        args=(DATA.readonly(), iDir))
 
 
+    def _collectStackBeam(self):
+        """Waits for the jobs started by StackAverageBeam(), if any, to finish"""
+        if self._smooth_job_label is None:
+            return
+        JobName="StackBeam%sF"%self._smooth_job_label
+        APP.awaitJobResults(JobName+"*",
+                            progress=("Stack Beam %s" % self._smooth_job_label))
+        self._smooth_job_label = None
+
     def finaliseSmoothBeam(self):
         # the FacetMachinePSF does not have an AverageBeamMachine
         if not self.AverageBeamMachine: return
@@ -1488,40 +1671,41 @@ class ClassFacetMachine():
     # ##############################################
     # ##############################################
 
-    def collectGriddingResults(self):
+    def collectGriddingResults(self, keep=0):
         """
         If any grid workers are still at work, waits for them to finish and collects the results.
         Otherwise does nothing.
 
+        Args:
+            keep: number of most recent gridding passes to leave outstanding (see gridChunkInBackground())
+
         Post conditions:
             Updates the following normalization weights, as produced by the gridding process:
                 self.DicoImager[iFacet]["SumWeights"]
                 self.DicoImager[iFacet]["SumJones"]
                 self.DicoImager[iFacet]["SumJonesChan"][DATA["iMS"]]
         """
-        # if this is set to None, then results already collected
-        if self._grid_job_id is None:
+        # the stacking jobs of the most recent chunk are left outstanding along with its gridding (the next
+        # StackAverageBeam() call waits for them), so only collect them when collecting everything
+        if not keep:
+            self._collectStackBeam()
+        # if there are no more passes than we're asked to keep, then results already collected
+        if len(self._grid_passes) <= keep:
             return
         # collect results of grid workers
-        results = APP.awaitJobResults(self._grid_job_id+"*",progress=
-                            ("Grid PSF %s" if self.DoPSF else "Grid %s") % self._grid_job_label)
-
-        for DicoResult in results:
-            # if we hit a returned exception, raise it again
-            if isinstance(DicoResult, Exception):
-                raise DicoResult
-            iFacet = DicoResult["iFacet"]
-            self.DicoImager[iFacet]["SumWeights"] += DicoResult["Weights"]
-            self.DicoImager[iFacet]["SumJones"] += DicoResult["SumJones"]
-            self.DicoImager[iFacet]["SumJonesChan"][self._grid_iMS] += DicoResult["SumJonesChan"]
-        self._grid_job_id = None
-
-        if self.AverageBeamMachine is not None and \
-           self.AverageBeamMachine.SmoothBeam is None and\
-           self._smooth_job_label is not None:
-            JobName="StackBeam%sF"%self._smooth_job_label
-            APP.awaitJobResults(JobName+"*",
-                                progress=("Stack Beam %s" % self._smooth_job_label))
+        while len(self._grid_passes) > keep:
+            job_id, label, iMS = self._grid_passes.pop(0)
+            results = APP.awaitJobResults(job_id+"*",progress=
+                                ("Grid PSF %s" if self.DoPSF else "Grid %s") % label)
+
+            for DicoResult in results:
+                # if we hit a returned exception, raise it again
+                if isinstance(DicoResult, Exception):
+                    raise DicoResult
+                iFacet = DicoResult["iFacet"]
+                self.DicoImager[iFacet]["SumWeights"] += DicoResult["Weights"]
+                self.DicoImager[iFacet]["SumJones"] += DicoResult["SumJones"]
+                self.DicoImager[iFacet]["SumJonesChan"][iMS] += DicoResult["SumJonesChan"]
 
         return True
 
@@ -1549,10 +1733,11 @@ class ClassFacetMachine():
         self.collectGriddingResults()
         # run FFT jobs
         self._fft_job_id = "%s.FFT:" % self._app_id
-        for iFacet in self.DicoImager.keys():
-            APP.runJob("%sF%d" % (self._fft_job_id, iFacet), self._fft_worker,
-                            args=(iFacet, self._CF[iFacet].readonly(), self._facet_grids.readonly()),
-                            )
+        facets = self.DicoImager.keys()
+        APP.runJobs([ ("%sF%d" % (self._fft_job_id, iFacet),
+                       (iFacet, self._CF[iFacet].readonly(), self._facet_grids.readonly()))
+                      for iFacet in facets ],
+                    self._fft_worker, costs=self._facetJobCosts(facets, fft=True))
         # APP.awaitJobResults(self._fft_job_id+"*", progress=("FFT PSF" if self.DoPSF else "FFT"))
 
     def collectFourierTransformResults (self):
@@ -1683,8 +1868,11 @@ class ClassFacetMachine():
     # #####################################################"
 
     # DeGrid worker that is called by Multiprocessing.Process
-    def _degrid_worker(self, iFacet, DATA, cf_dict, ChanSel, modeldict):
-        ModelGrid = self._set_model_grid_worker(iFacet, modeldict, cf_dict, ChanSel)
+    def _degrid_worker(self, iFacet, DATA, cf_dict, model_grids):
+        ModelGrid = model_grids[iFacet]
+        # nothing to degrid if facet model is empty
+        if ModelGrid is None:
+            return {"iFacet": iFacet}
 
         # Create a new GridMachine
         GridMachine = self._createGridMachine(iFacet, cf_dict=cf_dict,
@@ -1710,9 +1898,9 @@ class ClassFacetMachine():
         if Apply_killMS or Apply_Beam:
             DicoJonesMatrices = {}
         if Apply_killMS:
-            DicoJonesMatrices["DicoJones_killMS"] = DATA["killMS"]
+            DicoJonesMatrices["DicoJones_killMS"] = ClassJones.GiveJonesMatrices(DATA["killMS"])
         if Apply_Beam:
-            DicoJonesMatrices["DicoJones_Beam"] = DATA["Beam"]
+            DicoJonesMatrices["DicoJones_Beam"] = ClassJones.GiveJonesMatrices(DATA["Beam"])
 
         DecorrMode = self.GD["RIME"]["DecorrMode"]
         if 'F' in DecorrMode or "T" in DecorrMode:
@@ -1729,7 +1917,7 @@ class ClassFacetMachine():
         GridMachine.get(times, uvwThis, visThis, flagsThis, A0A1,
                           ModelGrid, ImToGrid=False,
                           DicoJonesMatrices=DicoJonesMatrices,
-                          freqs=freqs, TranformModelInput="FT",
+                          freqs=freqs,
                           ChanMapping=ChanMapping,
                           sparsification=DATA.get("Sparsification.Degrid")
                         )
@@ -1764,10 +1952,13 @@ class ClassFacetMachine():
         self._degrid_job_label = DATA["label"]
         self._degrid_job_id = "%s.Degrid.%s:" % (self._app_id, self._degrid_job_label)
 
-        for iFacet in self.DicoImager.keys():
-            APP.runJob("%sF%d" % (self._degrid_job_id, iFacet), self._degrid_worker,
-                            args=(iFacet, DATA.readonly(), self._CF[iFacet].readonly(),
-                                  ChanSel, self._model_dict.readonly()))#,serial=True)
+        model_grids = self._getModelGrids(ChanSel)
+
+        facets = self.DicoImager.keys()
+        APP.runJobs([ ("%sF%d" % (self._degrid_job_id, iFacet),
+                       (iFacet, DATA.readonly(), self._CF[iFacet].readonly(), model_grids.readonly()))
+                      for iFacet in facets ],
+                    self._degrid_worker, costs=self._facetJobCosts(facets))#,serial=True)
         #APP.awaitJobResults(self._degrid_job_id + "*", progress="Degrid %s" % self._degrid_job_label)
 
 
@@ -29,6 +29,7 @@ from DDFacet.Other import MyLogger
 from DDFacet.Other import ModColor
 log=MyLogger.getLogger("ClassImageDeconvMachine")
 from DDFacet.Array import NpParallel
+from DDFacet.Array.ClassTiledPeakIndex import ClassTiledPeakIndex
 from DDFacet.Other import ClassTimeIt
 from pyrap.images import image
 from DDFacet.Imager.ClassPSFServer import ClassPSFServer
@@ -70,6 +71,11 @@ class ClassImageDeconvMachine():
         self.MaxMinorIter=MaxMinorIter
         self.NCPU=NCPU
         self.MaskArray = None
+        # peak map of the polarization being cleaned, and its peak index. These are maintained
+        # by SubStep() during the minor cycle
+        self._PeakTask = None
+        self._PeakMap = None
+        self._PeakIndex = None
         self.GD=GD
         self.MultiFreqMode = (self.GD["Freq"]["NBand"] > 1)
         self.NFreqBand = self.GD["Freq"]["NBand"]
@@ -173,6 +179,7 @@ class ClassImageDeconvMachine():
         self.DicoDirty=DicoDirty
         self._Dirty = self.DicoDirty["ImageCube"]
         self._MeanDirty = self.DicoDirty["MeanImage"]
+        self._PeakIndex = None
 
         NPSF=self.PSFServer.NPSF
         _,_,NDirty,_=self._Dirty.shape
@@ -250,6 +257,13 @@ class ClassImageDeconvMachine():
         if self.MultiFreqMode:  #If multiple frequencies are present construct the weighted mean
             W=np.mean(np.float32(self.DicoDirty["WeightChansImages"]),axis=1)  #Get the weights (assuming they stay relatively the same over stokes terms)
             self._MeanDirty[0,:,x0d:x1d,y0d:y1d]-=np.sum(LocalSM[:,:,x0p:x1p,y0p:y1p]*W.reshape((W.size,1,1,1)),axis=0) #Sum over frequency
+        #Update peak map and peak index over the subtracted patch
+        if self._PeakIndex is not None:
+            if self._PeakTask == "Q+iU":
+                indexQ = self.PolarizationDescriptor.index("Q")
+                indexU = self.PolarizationDescriptor.index("U")
+                self._PeakMap[x0d:x1d,y0d:y1d] = np.abs(self.Dirty[indexQ,x0d:x1d,y0d:y1d] + 1.0j * self.Dirty[indexU,x0d:x1d,y0d:y1d]) ** 2
+            self._PeakIndex.update(x0d, x1d, y0d, y1d)
 
     def setChannel(self,ch=0):
         """
@@ -335,8 +349,11 @@ class ClassImageDeconvMachine():
 
             Fluxlimit_RMS = self.RMSFactor*RMS
 
-            #Find position and intensity of first peak
-            x,y,MaxDirty=NpParallel.A_whereMax(PeakMap,NCPU=self.NCPU,DoAbs=DoAbs,Mask=self.MaskArray)
+            #Find position and intensity of first peak. Subsequent peaks are found through a tiled index
+            #of the peak map, which SubStep() updates over the patch it subtracts from
+            self._PeakTask, self._PeakMap = pol_task, PeakMap
+            self._PeakIndex = ClassTiledPeakIndex(PeakMap, DoAbs=DoAbs, Mask=self.MaskArray)
+            x,y,MaxDirty=self._PeakIndex.whereMax()
             if pol_task == "I":
                 pass
             elif pol_task == "Q+iU":
@@ -394,22 +411,8 @@ class ClassImageDeconvMachine():
             try:
                 for i in range(self._niter[pol_task_id]+1,self.MaxMinorIter+1):
                     self._niter[pol_task_id] = i
-                    #grab a new peakmap
-                    PeakMap = None
-                    if pol_task == "I":
-                        indexI = self.PolarizationDescriptor.index("I")
-                        PeakMap = self.Dirty[indexI, :, :]
-                    elif pol_task == "Q+iU":
-                        indexQ = self.PolarizationDescriptor.index("Q")
-                        indexU = self.PolarizationDescriptor.index("U")
-                        PeakMap = np.abs(self.Dirty[indexQ, :, :] + 1.0j * self.Dirty[indexU, :, :]) ** 2
-                    elif pol_task == "V":
-                        indexV = self.PolarizationDescriptor.index("V")
-                        PeakMap = self.Dirty[indexV, :, :]
-                    else:
-                        raise ValueError("Invalid polarization cleaning task: %s. This is a bug" % pol_task)
-
-                    x,y,ThisFlux=NpParallel.A_whereMax(PeakMap,NCPU=self.NCPU,DoAbs=DoAbs,Mask=self.MaskArray)
+                    #peakmap is kept up to date by SubStep()
+                    x,y,ThisFlux=self._PeakIndex.whereMax()
                     if pol_task == "I":
                         pass
                     elif pol_task == "Q+iU":
@@ -536,6 +539,7 @@ class ClassImageDeconvMachine():
                 update_model = True or update_model
             #onwards to the next polarization <--
 
+        self._PeakTask = self._PeakMap = self._PeakIndex = None
         return exit_msg, continue_deconvolution, update_model
 
     def Update(self,DicoDirty,**kwargs):
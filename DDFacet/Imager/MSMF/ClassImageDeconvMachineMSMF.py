@@ -29,6 +29,7 @@ import psutil
 import numexpr
 from pyrap.images import image
 from DDFacet.Array import NpParallel
+from DDFacet.Array.ClassTiledPeakIndex import ClassTiledPeakIndex
 from DDFacet.Other import ClassTimeIt
 from DDFacet.Imager.MSMF import ClassMultiScaleMachine
 from DDFacet.Imager.ClassPSFServer import ClassPSFServer
@@ -72,6 +73,8 @@ class ClassImageDeconvMachine():
         self.NCPU = NCPU
         self.Chi2Thr = 10000
         self._MaskArray = None
+        # peak index of _PeakSearchImage, maintained during the minor cycle (see Deconvolve())
+        self._PeakIndex = None
         self.GD = GD
         self.SubPSF = None
         self.MultiFreqMode = NFreqBands > 1
@@ -317,6 +320,7 @@ class ClassImageDeconvMachine():
         # self._PSF=self.MSMachine._PSF
         self._CubeDirty = MSMachine._Dirty
         self._MeanDirty = MSMachine._MeanDirty
+        self._PeakIndex = None
 
 
         if self._peakMode is "sigma":
@@ -527,6 +531,9 @@ class ClassImageDeconvMachine():
             a, b = self._MeanDirty[:, :, x0d:x1d, y0d:y1d], self._peakWeightImage[:, :, x0d:x1d, y0d:y1d]
             numexpr.evaluate("a*b", out=self._PeakSearchImage[:, :, x0d:x1d, y0d:y1d])
 
+        if self._PeakIndex is not None:
+            self._PeakIndex.update(x0d, x1d, y0d, y1d)
+
                 # pylab.subplot(1,3,3,sharex=ax,sharey=ax)
         # pylab.imshow(self._MeanDirty[0,0,x0d:x1d,y0d:y1d],interpolation="nearest",vmin=vmin,vmax=vmax)#,vmin=vmin,vmax=vmax)
         # pylab.colorbar()
@@ -601,7 +608,10 @@ class ClassImageDeconvMachine():
             print>>log,"  not using a mask"
             CurrentNegMask=None
         
-        x,y,MaxDirty = NpParallel.A_whereMax(self._PeakSearchImage,NCPU=self.NCPU,DoAbs=DoAbs,Mask=CurrentNegMask)
+        # SubStep() only touches a patch of the image, so rather than rescanning the full image for the peak
+        # at each iteration, keep a tiled index of the peak, and let SubStep() update it
+        self._PeakIndex = ClassTiledPeakIndex(self._PeakSearchImage, DoAbs=DoAbs, Mask=CurrentNegMask)
+        x,y,MaxDirty = self._PeakIndex.whereMax()
 
         # ThisFlux is evaluated against stopping criteria. In weighted mode, use the true flux. Else use sigma value.
         ThisFlux = self._MeanDirty[0,0,x,y] if self._peakMode is "weighted" else MaxDirty
@@ -717,8 +727,7 @@ class ClassImageDeconvMachine():
                 self._niter = i
 
                 # x,y,ThisFlux=NpParallel.A_whereMax(self.Dirty,NCPU=self.NCPU,DoAbs=1)
-                x, y, peak = NpParallel.A_whereMax(
-                    self._PeakSearchImage, NCPU=self.NCPU, DoAbs=DoAbs, Mask=CurrentNegMask)
+                x, y, peak = self._PeakIndex.whereMax()
 
                 ThisFlux = self._MeanDirty[0,0,x,y] if self._peakMode is "weighted" else peak
                 if DoAbs:
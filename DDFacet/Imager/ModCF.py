@@ -18,7 +18,11 @@ along with this program; if not, write to the Free Software
 Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 '''
 
+import os
+import fcntl
+import hashlib
 import scipy.fftpack
+import pyfftw
 from DDFacet.ToolsDir import Gaussian
 import numpy as np
 from DDFacet.Other import ClassTimeIt
@@ -26,6 +30,7 @@ from DDFacet.Other import ModColor
 from scipy.interpolate import interp1d as interp
 from DDFacet.ToolsDir import ModToolBox
 from DDFacet.Array import NpShared
+from DDFacet.Array import shared_dict
 from DDFacet.Other import MyLogger
 log = MyLogger.getLogger("WTerm")  # ,disable=True)
 from DDFacet.ToolsDir import ModTaper
@@ -280,11 +285,86 @@ def Give_dn(l0, m0, rad=1., order=4):
     return Cl, Cm, C.flatten()
 
 
+# max size of a stack of w-planes FFTed in one go by ClassWTermModified._makeWplanes()
+WPLANE_BATCH_BYTES = 1<<28
+
+# W-kernel bank. The w-planes of a facet only depend on its size and on the polynomial fit to its lm-shift
+# (see Give_dn()), so facets with the same kernel parameters share one set of planes. The bank is a SharedDict
+# of packed planes (see NpShared.PackListSquareMatrix()), keyed by a hash of the parameters. Workers computing
+# CFs in parallel take a per-key lock, so that each entry is only computed once.
+WBANK_NAME = "WBank"
+
+def attachWBank():
+    """Attaches to the W-kernel bank (creating it if needed). The parent process should call this before
+    workers are started, so that the bank directory already exists when they attach to it."""
+    bank = shared_dict.attach(WBANK_NAME)
+    lockdir = bank.path + ":locks"
+    if not os.path.exists(lockdir):
+        os.mkdir(lockdir)
+    return bank
+
+
+class WBankLock(object):
+    """Exclusive lock on one entry of the W-kernel bank, held across processes"""
+    def __init__(self, bank, key):
+        self._path = os.path.join(bank.path + ":locks", key)
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self._path, "w")
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        # closing the file releases the lock
+        self._file.close()
+        self._file = None
+
+
+def saveWBankEntry(bank, key, cachedir):
+    """Writes bank entry to cachedir/key.npy (if not already there), for loadWBankEntry() to pick up later"""
+    path = os.path.join(cachedir, key + ".npy")
+    if os.path.exists(path):
+        return
+    if not os.path.exists(cachedir):
+        try:
+            os.mkdir(cachedir)
+        except OSError:
+            # another worker may have got there first
+            if not os.path.isdir(cachedir):
+                raise
+    tmppath = "%s.%d.tmp.npy" % (path[:-4], os.getpid())
+    np.save(tmppath, bank[key])
+    os.rename(tmppath, path)
+
+
+def loadWBankEntry(bank, key, cachedir):
+    """Makes sure bank entry is present, loading it from cachedir/key.npy if needed"""
+    with WBankLock(bank, key):
+        if key not in bank:
+            bank[key] = np.load(os.path.join(cachedir, key + ".npy"), mmap_mode="r")
+
+
+def QuantizeCoefPoly(CoefPoly, wl, lrad, tol):
+    """
+    Rounds the coefficients of the lm-shift polynomial (see Give_dn()), so that the phase of the w-term at
+    the edge of the facet (|l|,|m|<=lrad) and at the max w (wl wavelengths) changes by at most tol radians.
+    Facets whose coefficients round to the same values then share their w-kernels.
+    """
+    order = int(np.sqrt(CoefPoly.size)) - 1
+    if wl <= 0:
+        return np.zeros_like(CoefPoly)
+    i, j = np.mgrid[0:order+1, 0:order+1]
+    # the error of each term is at most half a step, so the sum over all terms stays within tol
+    step = tol/(np.pi*wl*lrad**(i+j).ravel()*CoefPoly.size)
+    return np.round(CoefPoly/step)*step
+
+
 class ClassWTermModified():
     def __init__(self, Cell=10, Sup=15, Nw=11, wmax=30000, Npix=101, Freqs=np.array([100.e6]), OverS=11, lmShift=None,
                  mode="compute",
                  cf_dict=None, compute_cf=True,
-                 IDFacet=None):
+                 IDFacet=None, wbank_tol=None, nthreads=1):
         """
         Class for computing/loading/saving w-kernels and spheroidals.
 
@@ -301,6 +381,10 @@ class ClassWTermModified():
                         "load" to load CFs from store_file, and save them to store_dict
                         "dict" to load CFs from store_dict
             IDFacet:
+            wbank_tol:  if not None, the w-planes are taken from (or computed into) the W-kernel bank, and
+                        cf_dict only refers to them by key. If >0, the lm-shift polynomial is quantized to
+                        this phase tolerance (radians) beforehand, so that similar facets share their kernels.
+            nthreads:   number of FFTW threads used to compute the w-planes
         """
 
         self.Nw = int(Nw)
@@ -312,6 +396,9 @@ class ClassWTermModified():
         self.OverS = OverS
         self.lmShift = lmShift
         self.IDFacet = IDFacet
+        self.wbank_tol = wbank_tol
+        self.nthreads = nthreads
+        self.WKey = None
         Freqs = self.Freqs
         C = 299792458.
         waveMin = C/Freqs[-1]
@@ -326,12 +413,19 @@ class ClassWTermModified():
             cf_dict["Sphe"] = dS(self.ifzfCF.real)
             cf_dict["InvSphe"] = dS(1./np.float64(self.ifzfCF.real))
             cf_dict["CuCv"] = np.array([self.Cu, self.Cv])
-            NpShared.PackListSquareMatrix(cf_dict, "W", self.Wplanes + self.WplanesConj)
+            if self.WKey is not None:
+                cf_dict["WKey"] = self.WKey
+            else:
+                NpShared.PackListSquareMatrix(cf_dict, "W", self.Wplanes + self.WplanesConj)
         else:
             self.wmax = cf_dict["wmax"]
             self.ifzfCF = cf_dict["Sphe"]
             self.Cu, self.Cv = cf_dict["CuCv"]
-            ww = NpShared.UnPackListSquareMatrix(cf_dict["W"])
+            if "WKey" in cf_dict:
+                self.WKey = str(cf_dict["WKey"])
+                ww = NpShared.UnPackListSquareMatrix(shared_dict.attach(WBANK_NAME, readwrite=False)[self.WKey])
+            else:
+                ww = NpShared.UnPackListSquareMatrix(cf_dict["W"])
             if len(ww) != self.Nw*2:
                 raise RuntimeError("mismatch in number of cached w-planes")
             self.Wplanes = ww[:self.Nw]
@@ -432,122 +526,23 @@ class ClassWTermModified():
 
         # print "done FIT"
 
-        for i in xrange(Nw):
-            #print>>log, "%i/%i"%(i,Nw)
-            if not(Sups[i] % 2):
-                Sups[i] += 1
-            dummy, dymmy, ThisSphe = self.SpheM.MakeSphe(Sups[i])
-            wl = w[i]/waveMin
-
-            # ##############
-            # l,m=np.mgrid[-lrad:lrad:Npix*1j,-lrad:lrad:Npix*1j]
-            # n_1=np.sqrt(1.-l**2-m**2)-1
-            # WTrue=np.exp(-2.*1j*np.pi*wl*(n_1))*self.ifzfCF
-            # ##############
-
-            DX = 2*lrad/Sups[i]
-            l, m = np.mgrid[-lrad+DX/2:lrad-DX/2:Sups[i]
-                            * 1j, -lrad+DX/2:lrad-DX/2:Sups[i]*1j]
-            # l,m=np.mgrid[-lrad:lrad:Sups[i]*1j,-lrad:lrad:Sups[i]*1j]
-            # n_1=np.sqrt(1.-l**2-m**2)-1
-            n_1 = ModFitPoly2D.polyval2d(l, m, CoefPoly)
-            # n_1=n_1.T[::-1,:]
-            T.timeit("3a")
-
-            # stop
-            # n_1=np.sqrt(1.-(l-l0)**2-(m-m0)**2)-1
-            # n_1=(1./np.sqrt(1.-l0**2-m0**2))*(l0*l+m0*m)
-            W = np.exp(-2.*1j*np.pi*wl*(n_1))
-            #import pylab
-
-            # pylab.clf()
-            # pylab.imshow(np.angle(W),interpolation="nearest",extent=(l.min(),l.max(),m.min(),m.max()),vmin=-np.pi,vmax=np.pi)
-            # pylab.draw()
-            # pylab.show(False)
-            # pylab.pause(0.1)
-            # T.timeit("3b")
-
-            # ####
-            # W.fill(1.)
-            # ####
-            W *= np.abs(ThisSphe)
-
-            # # ####################
-            # # fW=fft2(W)
-            # # zfW=ZeroPad(fW,outshape=Npix)
-            # # WFull=ifft2(zfW)
-
-            # # # #fW=ifft2(W)
-            # # # print W.shape
-            # fWTrue=fft2(WTrue)
-            # cfWTrue=fft2(np.conj(WTrue))
-            # nc,_=fWTrue.shape
-            # xc=(nc-1)/2
-            # dx=(Sups[i]-1)/2
-            # x0,x1=xc-dx,xc+dx+1
-            # #ZfWTrue=np.zeros_like(fWTrue)
-            # #ZfWTrue[x0:x1,x0:x1]=fWTrue[x0:x1,x0:x1]
-            # fzW=fWTrue[x0:x1,x0:x1]
-            # fzWconj=cfWTrue[x0:x1,x0:x1]
-
-            # if_fzW=ifft2(fzW)
-            # cif_fzW=ifft2(fzWconj)
-            # z_if_fzW=ZeroPad(if_fzW,outshape=if_fzW.shape[0]*self.OverS)
-            # z_cif_fzW=ZeroPad(cif_fzW,outshape=if_fzW.shape[0]*self.OverS)
-            # f_z_if_fzW=fft2(z_if_fzW)
-            # f_z_cif_fzW=fft2(z_cif_fzW)
-            # # ifZfWTrue=ifft2(ZfWTrue)
-
-            # # iffWTrue=ifft2(fWTrue[x0:x1,x0:x1])
-            # # iffW=ifft2(fW)
-
-            # # pylab.clf()
-            # # pylab.subplot(1,2,1)
-            # # pylab.imshow(np.real(fzW),interpolation="nearest")#,extent=(l.min(),l.max(),m.min(),m.max()),vmin=-np.pi,vmax=np.pi)
-            # # pylab.subplot(1,2,2)
-            # # pylab.imshow(np.real(f_z_if_fzW),interpolation="nearest")#,extent=(l.min(),l.max(),m.min(),m.max()),vmin=-np.pi,vmax=np.pi)
-            # # pylab.draw()
-            # # pylab.show(False)
-            # # pylab.pause(0.1)
-            # # fzW=f_z_if_fzW
-            # # fzWconj=f_z_cif_fzW
-            # # # ####################
-
-            # T.timeit("3c")
-
-            # # W=ThisSphe
-
-            zW = ZeroPad(W, outshape=W.shape[0]*self.OverS)
-
-            # T.timeit("3d")
-
-            # ####
-            # # W=np.abs(W)
-            # ####
-
-            zWconj = np.conj(zW)
-
-            # #FFTWMachine=ModFFTW.FFTW_2Donly(W.shape,W.dtype, ncores = 1)
-            # #W=FFTWMachine.fft(W)
-            # #Wconj=FFTWMachine.fft(Wconj)
-            fzW = fft2(zW)
-            fzWconj = fft2(zWconj)
-
-            # T.timeit("3e")
-            fzW = np.complex64(fzW).copy()
-            fzWconj = np.complex64(fzWconj).copy()
-
-            # fzW.fill(2+3*1j)
-            # fzWconj.fill(2+3*1j)
-
-            fzW = self.GiveReorgCF(fzW)
-            fzWconj = self.GiveReorgCF(fzWconj)
-
-            fzW = np.require(fzW.copy(), requirements=["A", "C"])
-            fzWconj = np.require(fzWconj.copy(), requirements=["A", "C"])
-            Wplanes.append(fzW)
-            WplanesConj.append(fzWconj)
-            # T.timeit("3f")
+        # supports must be odd
+        Sups[Sups % 2 == 0] += 1
+
+        if self.wbank_tol is None:
+            Wplanes, WplanesConj = self._makeWplanes(Sups, w, waveMin, lrad, CoefPoly)
+        else:
+            if self.wbank_tol > 0:
+                CoefPoly = QuantizeCoefPoly(CoefPoly, wmax/waveMin, lrad, self.wbank_tol)
+            params = (Npix, Cell, Sup, Nw, wmax, OverS, waveMin) + tuple(CoefPoly)
+            self.WKey = hashlib.md5(repr(tuple(float(x) for x in params))).hexdigest()
+            bank = shared_dict.attach(WBANK_NAME)
+            with WBankLock(bank, self.WKey):
+                if self.WKey not in bank:
+                    Wplanes, WplanesConj = self._makeWplanes(Sups, w, waveMin, lrad, CoefPoly)
+                    NpShared.PackListSquareMatrix(bank, self.WKey, Wplanes + WplanesConj)
+            ww = NpShared.UnPackListSquareMatrix(bank[self.WKey])
+            Wplanes, WplanesConj = ww[:Nw], ww[Nw:]
 
         self.Wplanes = Wplanes
         self.WplanesConj = WplanesConj
@@ -555,3 +550,48 @@ class ClassWTermModified():
         self.wmap = w
         self.wmax = wmax
         self.Nw = Nw
+
+    def _reorgCFs(self, A):
+        """Batched version of GiveReorgCF(), for a stack of kernels of shape [n,N,N]"""
+        n, N = A.shape[0], A.shape[-1]
+        Sup = N/self.OverS
+        B = A.reshape((n, Sup, self.OverS, Sup, self.OverS)).transpose((0, 2, 4, 1, 3))
+        return np.ascontiguousarray(B).reshape((n, N, N))
+
+    def _makeWplanes(self, Sups, w, waveMin, lrad, CoefPoly):
+        """
+        Computes the w-planes and their conjugates, as two lists of reorganized oversampled kernels.
+        Planes of equal support share the spheroidal and the lm-polynomial, and are zero-padded and FFTed
+        as one stack. The FFT of conj(W) at k is the conjugate of the FFT of W at -k, so the conjugate
+        planes are obtained by flipping the frequency axes, rather than by FFTing conj(W).
+        """
+        OverS = self.OverS
+        Wplanes = [None]*self.Nw
+        WplanesConj = [None]*self.Nw
+        for sup in np.unique(Sups):
+            iplanes = np.where(Sups == sup)[0]
+            dummy, dummy, ThisSphe = self.SpheM.MakeSphe(sup)
+            DX = 2*lrad/sup
+            l, m = np.mgrid[-lrad+DX/2:lrad-DX/2:sup*1j, -lrad+DX/2:lrad-DX/2:sup*1j]
+            n_1 = ModFitPoly2D.polyval2d(l, m, CoefPoly)
+            # zero-padded size, and offset of kernel within it (as in ZeroPad())
+            N = sup*OverS
+            off = (N-sup)/2 + (1 if N % 2 == 0 else 0)
+            # with the zero frequency at N/2 (fftshift convention), -k sits at index (2*(N/2)-k)%N
+            ineg = (2*(N/2) - np.arange(N)) % N
+            nbatch = max(1, WPLANE_BATCH_BYTES//(N*N*16))
+            for i0 in xrange(0, iplanes.size, nbatch):
+                iw = iplanes[i0:i0+nbatch]
+                wl = (w[iw]/waveMin).reshape((-1, 1, 1))
+                zW = np.zeros((iw.size, N, N), np.complex128)
+                zW[:, off:off+sup, off:off+sup] = np.exp(-2.*1j*np.pi*wl*n_1)*np.abs(ThisSphe)
+                fzW = pyfftw.interfaces.numpy_fft.fft2(iFs(zW, axes=(-2, -1)), axes=(-2, -1),
+                                                        overwrite_input=True, threads=self.nthreads)
+                fzW = np.complex64(Fs(fzW, axes=(-2, -1))/np.float64(N*N))
+                fzWconj = np.conj(fzW[:, ineg[:, np.newaxis], ineg[np.newaxis, :]])
+                fzW = self._reorgCFs(fzW)
+                fzWconj = self._reorgCFs(fzWconj)
+                for j, i in enumerate(iw):
+                    Wplanes[i] = np.require(fzW[j], requirements=["A", "C"])
+                    WplanesConj[i] = np.require(fzWconj[j], requirements=["A", "C"])
+        return Wplanes, WplanesConj
@@ -31,6 +31,10 @@ from collections import OrderedDict
 import glob
 import re
 import numexpr
+import time
+import json
+import shutil
+import cPickle
 
 from DDFacet.Other import MyLogger
 from DDFacet.Other import ClassTimeIt
@@ -75,10 +79,10 @@ class JobCounterPool(object):
             self._pool = pool
             pool._register(self)
 
-        def increment(self):
-            """Increments the counter"""
+        def increment(self, n=1):
+            """Increments the counter (by n)"""
             with self._cond:  # acquire lock
-                self._pool._counters_array[self.index_in_pool] += 1
+                self._pool._counters_array[self.index_in_pool] += n
 
         def decrement(self):
             """Decrements the named counter. When it gets to zero, notifies any waiting processes."""
@@ -151,6 +155,10 @@ class AsyncProcessPool (object):
         self._events = {}
         self._results_map = {}
         self._job_counters = JobCounterPool()
+        # job trace settings, see enableTrace()
+        self._trace_file = self._trace_dir = self._trace_format = None
+        self._trace_offsets = {}
+        self._trace_handles = {}
 
     def __del__(self):
         self.shutdown()
@@ -164,7 +172,7 @@ class AsyncProcessPool (object):
             ncpu:
             affinity:
             parent_affinity:
-            num_io_processes:
+            num_io_processes: number of I/O worker processes (each with its own queue, see runJob(io=N))
             verbose:
 
         Returns:
@@ -295,7 +303,8 @@ class AsyncProcessPool (object):
         self._compute_workers = []
         self._io_workers = []
         self._compute_queue   = multiprocessing.Queue()
-        self._io_queues       = [ multiprocessing.Queue() for x in xrange(num_io_processes) ]
+        self.num_io_processes = max(num_io_processes, 1)
+        self._io_queues       = [ multiprocessing.Queue() for x in xrange(self.num_io_processes) ]
         self._result_queue    = multiprocessing.Queue()
         self._termination_event = multiprocessing.Event()
         # this event is set when all workers have been started, an cleared when a restart is requested
@@ -499,22 +508,7 @@ class AsyncProcessPool (object):
             raise RuntimeError("Job '%s' has an uncollected result, or is a singleton. This is a bug."%job_id)
         # make sure workers are started
         self.awaitWorkerStart()
-        # figure out the handler, and how to pass it to the queue
-        # If this is a function, then describe it by function id, None
-        if inspect.isfunction(handler):
-            handler_id, method = id(handler), None
-            handler_desc  = "%s()" % handler.__name__
-        # If this is a bound method, describe it by instance id, method_name
-        elif inspect.ismethod(handler):
-            instance = handler.im_self
-            if instance is None:
-                raise RuntimeError("Job '%s': handler %s is not a bound method. This is a bug." % (job_id, handler))
-            handler_id, method = id(instance), handler.__name__
-            handler_desc = "%s.%s()" % (handler.im_class.__name__, method)
-        else:
-            raise TypeError("'handler' argument must be a function or a bound method")
-        if handler_id not in self._job_handlers:
-            raise RuntimeError("Job '%s': unregistered handler %s. This is a bug." % (job_id, handler))
+        handler_id, method, handler_desc = self._describeHandler(job_id, handler)
         # resolve event object
         if event:
             if id(event) not in self._events:
@@ -523,19 +517,14 @@ class AsyncProcessPool (object):
         # increment counter object
         if counter:
             counter.increment()
-        # check for SharedDict arguments and print errors
-        for iarg, arg in enumerate(args):
-            if type(arg) is shared_dict.SharedDict:
-                raise TypeError("positional argument %d is a SharedDict. This is a bug! Use readonly()/readwrite()/writeonly()"%iarg)
-        for key, arg in kwargs.iteritems():
-            if type(arg) is shared_dict.SharedDict:
-                raise TypeError("keyword %s is a SharedDict. This is a bug! Use readonly()/readwrite()/writeonly()"%key)
+        self._checkJobArgs(args, kwargs)
         # create the job item
         jobitem = dict(job_id=job_id, handler=(handler_id, method, handler_desc),
                        event=event and id(event),
                        counter=counter and id(counter),
                        collect_result=collect_result,
                        args=args, kwargs=kwargs)
+        self._traceEnqueue(jobitem)
         # insert entry into dict of pending jobs
         if collect_result:
             job = self._results_map[job_id] = Job(job_id, jobitem, singleton=singleton)
@@ -543,16 +532,229 @@ class AsyncProcessPool (object):
         if self.ncpu > 1 and not serial:
             if self.verbose > 2:
                 print>>log, "enqueueing job %s: %s"%(job_id, handler_desc)
-            # place it on appropriate queue
-            if io is None:
-                self._compute_queue.put(jobitem)
-            else:
-                io = max(len(self._io_queues)-1, io)
-                self._io_queues[io].put(jobitem)
+            self._enqueue(jobitem, io)
         # serial mode: process job in this process, and raise any exceptions up
         else:
             self._dispatch_job(jobitem, reraise=True)
 
+    def runJobs (self, jobs, handler=None, io=None, kwargs={}, counter=None, costs=None,
+                 collect_result=True, serial=False):
+        """
+        Puts a batch of jobs using the same handler on a processing queue. This is cheaper than calling runJob()
+        for each job, since jobs are packed into a smaller number of queue items.
+
+        Args:
+            jobs:    list of (job_id, args) tuples. Results can be collected via awaitJobResults() as usual.
+            handler: as for runJob()
+            io:      as for runJob()
+            kwargs:  keyword arguments, common to all jobs
+            counter: if set, the counter is incremented by the number of jobs, and decremented as each job is complete
+            costs:   if set, list of relative costs (e.g. facet sizes) of each job. Jobs are then queued in
+                     order of decreasing cost (longest processing time first), so that the largest jobs are not left
+                     for the tail end of a pass. Small jobs are packed together into queue items, while the large
+                     ones are queued individually, which keeps load balancing fine-grained where it matters.
+            collect_result: as for runJob()
+            serial:  as for runJob()
+        """
+        if collect_result and os.getpid() != parent_pid:
+            raise RuntimeError("runJobs() with collect_result can only be called in the parent process. This is a bug.")
+        if not jobs:
+            return
+        self.awaitWorkerStart()
+        handler_id, method, handler_desc = self._describeHandler(jobs[0][0], handler)
+        if costs is None or not sum(costs):
+            costs = [1]*len(jobs)
+        elif len(costs) != len(jobs):
+            raise ValueError("runJobs(): list of costs does not match list of jobs. This is a bug.")
+        # sort jobs by decreasing cost (stable, so equal-cost jobs keep their order)
+        order = sorted(range(len(jobs)), key=lambda i: -costs[i])
+        jobitems = []
+        for i in order:
+            job_id, args = jobs[i]
+            if collect_result and job_id in self._results_map:
+                raise RuntimeError("Job '%s' has an uncollected result, or is a singleton. This is a bug." % job_id)
+            self._checkJobArgs(args, kwargs)
+            jobitem = dict(job_id=job_id, handler=(handler_id, method, handler_desc),
+                           event=None, counter=counter and id(counter),
+                           collect_result=collect_result,
+                           args=args, kwargs=kwargs)
+            self._traceEnqueue(jobitem)
+            if collect_result:
+                self._results_map[job_id] = Job(job_id, jobitem)
+            jobitems.append((costs[i], jobitem))
+        if counter:
+            counter.increment(len(jobitems))
+        if self.ncpu > 1 and not serial:
+            # pack jobs into queue items of roughly equal cost, such that each worker gets several items per pass
+            nworkers = self.ncpu if io is None else 1
+            max_cost = sum([cost for cost, _ in jobitems]) / float(nworkers*self.JOB_BATCH_GRANULARITY)
+            batch, batch_cost = [], 0
+            for cost, jobitem in jobitems:
+                if batch and batch_cost + cost > max_cost:
+                    self._enqueue(self._makeBatchItem(batch), io)
+                    batch, batch_cost = [], 0
+                batch.append(jobitem)
+                batch_cost += cost
+            self._enqueue(self._makeBatchItem(batch), io)
+            if self.verbose > 2:
+                print>>log, "enqueued %d jobs: %s" % (len(jobitems), handler_desc)
+        else:
+            for _, jobitem in jobitems:
+                self._dispatch_job(jobitem, reraise=True)
+
+    # number of queue items per worker that runJobs() aims for
+    JOB_BATCH_GRANULARITY = 4
+
+    @staticmethod
+    def _makeBatchItem(jobitems):
+        """Returns queue item for list of job items. A single job is queued as is"""
+        if len(jobitems) == 1:
+            return jobitems[0]
+        return dict(batch=jobitems)
+
+    def _enqueue(self, jobitem, io=None):
+        """Places job item on the compute queue, or on an I/O queue of the given level"""
+        if io is None:
+            self._compute_queue.put(jobitem)
+        else:
+            io = min(len(self._io_queues)-1, io)
+            self._io_queues[io].put(jobitem)
+
+    def _checkJobArgs(self, args, kwargs):
+        """Checks for SharedDict arguments and raises errors"""
+        for iarg, arg in enumerate(args):
+            if type(arg) is shared_dict.SharedDict:
+                raise TypeError("positional argument %d is a SharedDict. This is a bug! Use readonly()/readwrite()/writeonly()"%iarg)
+        for key, arg in kwargs.iteritems():
+            if type(arg) is shared_dict.SharedDict:
+                raise TypeError("keyword %s is a SharedDict. This is a bug! Use readonly()/readwrite()/writeonly()"%key)
+
+    def enableTrace(self, filename, format="json"):
+        """
+        Enables job tracing. For every job, the time it was queued, started and finished, the worker it ran on,
+        and the size of its (pickled) arguments are recorded. Each process appends records to its own file in
+        a temporary directory, and saveTrace() merges them into filename.
+
+        Args:
+            filename: trace file written by saveTrace()
+            format:   "json" for a list of job records, or "chrome" for the Chrome trace event format
+                      (viewable in chrome://tracing or Perfetto)
+        """
+        if os.getpid() != parent_pid:
+            raise RuntimeError("This method can only be called in the parent process. This is a bug.")
+        self._trace_file = filename
+        self._trace_format = format
+        self._trace_dir = filename + ".tmp"
+        if os.path.exists(self._trace_dir):
+            shutil.rmtree(self._trace_dir)
+        os.mkdir(self._trace_dir)
+        self._trace_offsets = {}
+        print>>log, "job trace will be written to %s (%s format)" % (filename, format)
+
+    def _traceEnqueue(self, jobitem):
+        """If tracing, tags job item with the trace directory, enqueue time and payload size"""
+        if self._trace_dir:
+            payload = len(cPickle.dumps((jobitem["args"], jobitem["kwargs"]), cPickle.HIGHEST_PROTOCOL))
+            jobitem["trace"] = self._trace_dir, time.time(), payload
+
+    def _traceRecord(self, jobitem, handler_desc, start, success):
+        """Appends record of a completed job to this process's trace file"""
+        trace_dir, queued, payload = jobitem["trace"]
+        key = trace_dir, os.getpid()
+        traceout = self._trace_handles.get(key)
+        if traceout is None:
+            traceout = self._trace_handles[key] = open(os.path.join(trace_dir, "%d.jsonl" % os.getpid()), "a")
+        record = dict(job=jobitem["job_id"], handler=handler_desc,
+                      proc="parent" if self.proc_id is None else str(self.proc_id), pid=os.getpid(),
+                      queued=queued, start=start, end=time.time(), payload=payload, success=success)
+        traceout.write(json.dumps(record)+"\n")
+        traceout.flush()
+
+    def _readTraceRecords(self, since_checkpoint=False):
+        """Reads job records from the trace directory. If since_checkpoint is True, only reads records added since
+        the previous call with since_checkpoint=True"""
+        records = []
+        for path in glob.glob(os.path.join(self._trace_dir, "*.jsonl")):
+            with open(path) as tracein:
+                if since_checkpoint:
+                    tracein.seek(self._trace_offsets.get(path, 0))
+                # a record may be half-written by a running worker, so only take complete lines
+                while True:
+                    line = tracein.readline()
+                    if not line.endswith("\n"):
+                        break
+                    records.append(json.loads(line))
+                    if since_checkpoint:
+                        self._trace_offsets[path] = tracein.tell()
+        return records
+
+    def traceCheckpoint(self, title):
+        """If tracing, prints a per-handler summary of jobs completed since the previous checkpoint"""
+        if not self._trace_dir:
+            return
+        records = self._readTraceRecords(since_checkpoint=True)
+        if not records:
+            return
+        summary = OrderedDict()
+        for rec in sorted(records, key=lambda rec: rec["start"]):
+            summary.setdefault(rec["handler"], []).append(rec)
+        print>>log, ModColor.Str("Job summary for %s:" % title, col="green")
+        print>>log, "  %-48s %7s %10s %9s %9s %10s %9s %7s" % ("handler", "jobs", "run [s]", "mean [s]", "max [s]",
+                                                              "wait [s]", "args [MB]", "workers")
+        for handler, recs in sorted(summary.iteritems(), key=lambda item: -sum([rec["end"]-rec["start"] for rec in item[1]])):
+            run = np.array([ rec["end"]-rec["start"] for rec in recs ])
+            wait = np.array([ rec["start"]-rec["queued"] for rec in recs ])
+            print>>log, "  %-48s %7d %10.2f %9.3f %9.3f %10.3f %9.2f %7d" % (handler[:48], len(recs), run.sum(), run.mean(),
+                            run.max(), wait.mean(), sum([rec["payload"] for rec in recs])/2.**20,
+                            len(set([rec["proc"] for rec in recs])))
+        t0 = min([rec["queued"] for rec in records])
+        t1 = max([rec["end"] for rec in records])
+        print>>log, "  %d jobs over %.2fs of wall time" % (len(records), t1 - t0)
+
+    def saveTrace(self):
+        """If tracing, merges the per-process records into the trace file. Tracing is disabled afterwards."""
+        if not self._trace_dir or os.getpid() != parent_pid:
+            return
+        records = sorted(self._readTraceRecords(), key=lambda rec: rec["start"])
+        if self._trace_format == "chrome":
+            t0 = min([rec["queued"] for rec in records]) if records else 0
+            events = []
+            for rec in records:
+                events.append(dict(name=rec["job"], cat=rec["handler"], ph="X", pid=0, tid=rec["proc"],
+                                   ts=(rec["start"]-t0)*1e6, dur=(rec["end"]-rec["start"])*1e6,
+                                   args=dict(queue_wait=rec["start"]-rec["queued"], payload=rec["payload"],
+                                             pid=rec["pid"], success=rec["success"])))
+            trace = dict(traceEvents=events, displayTimeUnit="ms")
+        else:
+            trace = records
+        with open(self._trace_file, "w") as traceout:
+            json.dump(trace, traceout)
+        print>>log, "wrote trace of %d jobs to %s" % (len(records), self._trace_file)
+        for handle in self._trace_handles.values():
+            handle.close()
+        self._trace_handles = {}
+        shutil.rmtree(self._trace_dir)
+        self._trace_dir = None
+
+    def _describeHandler(self, job_id, handler):
+        """Figures out the handler, and how to pass it to the queue. Returns handler_id, method, description tuple"""
+        # If this is a function, then describe it by function id, None
+        if inspect.isfunction(handler):
+            handler_id, method = id(handler), None
+            handler_desc  = "%s()" % handler.__name__
+        # If this is a bound method, describe it by instance id, method_name
+        elif inspect.ismethod(handler):
+            instance = handler.im_self
+            if instance is None:
+                raise RuntimeError("Job '%s': handler %s is not a bound method. This is a bug." % (job_id, handler))
+            handler_id, method = id(instance), handler.__name__
+            handler_desc = "%s.%s()" % (handler.im_class.__name__, method)
+        else:
+            raise TypeError("'handler' argument must be a function or a bound method")
+        if handler_id not in self._job_handlers:
+            raise RuntimeError("Job '%s': unregistered handler %s. This is a bug." % (job_id, handler))
+        return handler_id, method, handler_desc
+
     def awaitJobCounter (self, counter, progress=None, total=None, timeout=10):
         if self.verbose > 2:
             print>> log, "  %s is complete" % counter.name
@@ -657,22 +859,23 @@ class AsyncProcessPool (object):
                 # shoot the zombie process, if any
                 multiprocessing.active_children()
                 continue
-            # ok, dispatch the result
-            job_id = result["job_id"]
-            job = self._results_map.get(job_id)
-            if job is None:
-                raise KeyError("Job '%s' was not enqueued. This is a logic error." % job_id)
-            job.setResult(result)
-            # if being awaited, dispatch appropriately
-            if job_id in awaiting_jobs:
-                for jobspec in awaiting_jobs[job_id]:
-                    job_results[jobspec][1].append(result)
-                    complete_jobs += 1
-                if not job.singleton:
-                    del self._results_map[job_id]
-                del awaiting_jobs[job_id]
-                if progress:
-                    pBAR.render(complete_jobs,(total_jobs or 1))
+            # ok, dispatch the result(s). Batches of jobs send back a list of results
+            for result in result.get("batch", [result]):
+                job_id = result["job_id"]
+                job = self._results_map.get(job_id)
+                if job is None:
+                    raise KeyError("Job '%s' was not enqueued. This is a logic error." % job_id)
+                job.setResult(result)
+                # if being awaited, dispatch appropriately
+                if job_id in awaiting_jobs:
+                    for jobspec in awaiting_jobs[job_id]:
+                        job_results[jobspec][1].append(result)
+                        complete_jobs += 1
+                    if not job.singleton:
+                        del self._results_map[job_id]
+                    del awaiting_jobs[job_id]
+                    if progress:
+                        pBAR.render(complete_jobs,(total_jobs or 1))
             # print status update
             if self.verbose > 1:
                 print>>log,"received job results %s" % " ".join(["%s:%d"%(jobspec, len(results)) for jobspec, (_, results)
@@ -717,6 +920,7 @@ class AsyncProcessPool (object):
         """Terminate worker threads"""
         if not self._started:
             return
+        self.saveTrace()
         if self.verbose > 1:
             print>>log,"shutdown: asking TB to stop workers"
         self._started = False
@@ -763,11 +967,29 @@ class AsyncProcessPool (object):
         object._run_worker(worker_queue)
 
     def _dispatch_job(self, jobitem, reraise=False):
-        """Handles job described by jobitem dict.
+        """Handles job described by jobitem dict, or a batch of jobs (see runJobs()).
 
         If reraise is True, any eceptions are re-raised. This is useful for debugging."""
+        if "batch" not in jobitem:
+            result = self._dispatch_single_job(jobitem, reraise)
+            if result is not None:
+                self._result_queue.put(result)
+            return
+        # for batches, send results back in one go
+        results = [ self._dispatch_single_job(item, reraise) for item in jobitem["batch"] ]
+        results = [ result for result in results if result is not None ]
+        if results:
+            self._result_queue.put(dict(batch=results))
+
+    def _dispatch_single_job(self, jobitem, reraise=False):
+        """Handles job described by jobitem dict. Returns result dict to be sent back to the parent, or None if
+        the result is not being collected."""
         timer = ClassTimeIt.ClassTimeIt()
+        start = time.time()
+        result_item = None
         event = counter = None
+        handler_desc = None
+        success = False
         try:
             job_id, event_id, counter_id, args, kwargs = [jobitem.get(attr) for attr in
                                                         "job_id", "event", "counter", "args", "kwargs"]
@@ -781,7 +1003,9 @@ class AsyncProcessPool (object):
                 counter = self._job_counters.get(counter_id)
                 if counter is None:
                     raise RuntimeError("Job %s: unknown counter %s. This is a bug." % (job_id, counter_id))
-            # instantiate SharedDict arguments
+            # instantiate SharedDict arguments. Drop cached handles of deleted arrays first, so that their memory
+            # is not kept around by this process
+            shared_dict.pruneHandleCache()
 #            timer.timeit('init '+job_id)
             args = [ arg.instantiate() if type(arg) is shared_dict.SharedDictRepresentation else arg for arg in args ]
             for key in kwargs.keys():
@@ -801,10 +1025,10 @@ class AsyncProcessPool (object):
                 result = call(*args, **kwargs)
             if self.verbose > 3:
                 print>> log, "job %s: %s returns %s" % (job_id, handler_desc, result)
+            success = True
             # Send result back
             if jobitem['collect_result']:
-                self._result_queue.put(
-                    dict(job_id=job_id, proc_id=self.proc_id, success=True, result=result, time=timer.seconds()))
+                result_item = dict(job_id=job_id, proc_id=self.proc_id, success=True, result=result, time=timer.seconds())
         except KeyboardInterrupt:
             raise
         except Exception, exc:
@@ -816,14 +1040,17 @@ class AsyncProcessPool (object):
             print>> log, ModColor.Str("process %s: exception raised processing job %s: %s" % (
                 AsyncProcessPool.proc_id, job_id, traceback.format_exc()))
             if jobitem['collect_result']:
-                self._result_queue.put(
-                    dict(job_id=job_id, proc_id=self.proc_id, success=False, error=exc, time=timer.seconds()))
+                result_item = dict(job_id=job_id, proc_id=self.proc_id, success=False, error=exc, time=timer.seconds())
         finally:
+            # record trace before signalling completion, so that the record is there for whoever is waiting
+            if "trace" in jobitem:
+                self._traceRecord(jobitem, handler_desc, start, success)
             # Raise event
             if event is not None:
                 event.set()
             if counter is not None:
                 counter.decrement()
+        return result_item
 
     def _run_worker (self, queue):
         """
@@ -842,6 +1069,8 @@ class AsyncProcessPool (object):
                     jobitem = queue.get(True, 10)
                     # print>>log,"%s: queue.get() returns %s"%(AsyncProcessPool.proc_id, jobitem)
                 except Queue.Empty:
+                    # release handles of deleted arrays while idle
+                    shared_dict.pruneHandleCache(force=True)
                     continue
                 if jobitem == "POISON-E":
                     break
@@ -18,11 +18,14 @@ along with this program; if not, write to the Free Software
 Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 '''
 
-import os, os.path, subprocess
+import os, os.path, subprocess, time
 import cPickle
 import collections
+import fcntl
+import shutil
 
 from DDFacet.Other import MyLogger, ModColor
+from DDFacet.Array import NpFile
 log = MyLogger.getLogger("CacheManager")
 
 
@@ -85,13 +88,58 @@ class CacheManager (object):
     VS.cache points to the cache of the current chunk of the current MS being iterated over.
     This is used to cache the various mappings.
 
-    To form up hashvalues, the global dict (GD) object is very convenient. Sections of GD
-    that influence a particular cache item are used as the hashvalue in each case.
+    Hashvalues are content-addressed: each cache item declares exactly the parameters it depends on
+    (use selectKeys() to pick the relevant options out of a GD section, rather than using whole
+    sections, so that unrelated option changes don't invalidate the cache), plus fingerprints of the
+    input files it was computed from (see getFileFingerprint() and ClassMS.getCacheKey()). Since
+    neither depends on the process, caches remain valid across separate runs for as long as their
+    inputs are unchanged.
 
     Running with DeleteDDFProducts=1 causes all caches to be reset.
+
+    # Cache size quota
+
+    If a quota is set via CacheManager.setMaxSize() (--Cache-MaxSize), caches are evicted on a
+    least-recently-used basis whenever a cache element is saved. The unit of eviction is a cache
+    directory: a per-chunk cache, a directory element such as the facet CF cache, or a whole
+    mspath.ddfcache tree. Each such directory contains an access marker file (.access), the mtime of
+    which is updated whenever the cache is used. The markers serve as the index of the cache:
+    sizes and access times are determined by scanning the cache root (--Cache-Dir, if set, else the
+    top-level .ddfcache directory). When a quota is set, the markers also serve as leases: a process
+    using a cache holds a shared flock() on its marker until it calls release() (forked workers
+    inherit the leases held at the time), and eviction needs an exclusive lock on the markers of all
+    the caches it removes. Thus caches in use by any process, including other runs sharing the
+    --Cache-Dir, are never evicted. Per-chunk caches are released by the ClassVisServer once it
+    is done with the chunk, so only the caches of chunks in flight are held.
+
+    # Array cache elements
+
+    Large arrays (e.g. visibilities and flags) can be stored via saveArray() and loadArrayInto().
+    Depending on the codec the cache manager was created with, these are written either as raw
+    dumps, or compressed in blocks using multiple threads (see NpFile). Use getArrayElementName()
+    to form up the element name, since this differs per format:
+
+        path, valid = cache.checkCache(cache.getArrayElementName("Data"), hashvalue)
+        if not valid or not cache.loadArrayInto(path, data):
+            data[...] = expensiveComputation()
+            cache.saveArray(path, data)
+            cache.saveCache(cache.getArrayElementName("Data"))
     """
 
-    def __init__(self, dirname, reset=False, cachedir=None, nfswarn=False):
+    # name of access marker file kept in each cache directory
+    ACCESS_MARKER = ".access"
+    # max total size of caches under the cache root, in bytes. 0 means no quota.
+    _max_size = 0
+    # leases held by this process: dict of cache directory -> open (shared-locked) access marker.
+    # Only taken out if a quota is set.
+    _leases = {}
+
+    @staticmethod
+    def setMaxSize(maxsize_gb):
+        """Sets quota on total cache size, in GB. 0 for no quota."""
+        CacheManager._max_size = int(maxsize_gb*2**30)
+
+    def __init__(self, dirname, reset=False, cachedir=None, nfswarn=False, codec=None, nthreads=1, root=None):
         """
         Initializes cache manager.
 
@@ -100,13 +148,23 @@ class CacheManager (object):
             reset: if True, cache is reset upon first access
             cachedir: if set, caches things under cachedir/dirname. Useful for fast local storage.
             nfswarn: if True and directory is NFS mounted, prints a warning
+            codec: if set, array elements are stored compressed with this codec (see NpFile.CODECS)
+            nthreads: number of threads used to (de)compress array elements
+            root: root directory over which the cache quota is enforced. Default is cachedir if set,
+                else dirname.
         """
+        if codec and codec not in NpFile.CODECS:
+            print>> log, ModColor.Str("WARNING: cache codec '%s' is not available, falling back to zlib" % codec)
+            codec = "zlib"
+        self.codec = codec
+        self.nthreads = nthreads
         # strip trailing slashes
         while dirname[-1] == "/":
             dirname = dirname[:-1]
         if cachedir:
             dirname = os.path.join(cachedir, os.path.basename(dirname))
         self.dirname = dirname
+        self.root = root or cachedir or dirname
         self.hashes = {}
         self.pid = os.getpid()
         if not os.path.exists(dirname):
@@ -115,7 +173,7 @@ class CacheManager (object):
         else:
             if reset:
                 print>> log, ("clearing cache %s, since we were asked to reset the cache" % dirname)
-                os.system("rm -fr "+dirname)
+                shutil.rmtree(dirname, ignore_errors=True)
                 os.mkdir(dirname)
         # check for NFS system and print warning
         if nfswarn:
@@ -132,6 +190,150 @@ class CacheManager (object):
                                           col="red",
                                           Bold=True)
 
+        self._touch(dirname)
+
+    @staticmethod
+    def _touch(dirname):
+        """Updates access marker of cache directory, and takes out a lease on it if a quota is set (see _lease())"""
+        marker = os.path.join(dirname, CacheManager.ACCESS_MARKER)
+        try:
+            if CacheManager._max_size:
+                CacheManager._lease(dirname)
+            elif not os.path.exists(marker):
+                open(marker, "a").close()
+            os.utime(marker, None)
+        except (IOError, OSError):
+            print>>log, ModColor.Str("WARNING: unable to update cache access marker %s" % marker)
+
+    @staticmethod
+    def _lease(dirname):
+        """
+        Marks cache directory as in use by this process, by holding a shared lock on its access marker.
+        If the directory is being evicted by another process, waits for that to finish and recreates it.
+        """
+        dirname = os.path.realpath(dirname)
+        marker = os.path.join(dirname, CacheManager.ACCESS_MARKER)
+        lease = CacheManager._leases.get(dirname)
+        while True:
+            # lease still valid, i.e. on the current marker file (the directory may have been reset since)?
+            if lease is not None:
+                try:
+                    if os.stat(marker).st_ino == os.fstat(lease.fileno()).st_ino:
+                        CacheManager._leases[dirname] = lease
+                        return
+                except OSError:
+                    pass
+                lease.close()
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            lease = open(marker, "a")
+            fcntl.flock(lease, fcntl.LOCK_SH)
+
+    def release(self):
+        """
+        Releases the leases held by this process on this cache and on any caches nested in it. The leases
+        are taken out again on the next use of the cache.
+        """
+        dirname = os.path.realpath(self.dirname)
+        for path in CacheManager._leases.keys():
+            if path == dirname or path.startswith(dirname + "/"):
+                CacheManager._leases.pop(path).close()
+
+    @staticmethod
+    def _lockForEviction(paths):
+        """
+        Tries to take exclusive locks on the access markers of the given cache directories, without waiting.
+        Returns list of locked files (close them to release), or None if any of the caches is in use.
+        """
+        locks = []
+        for path in paths:
+            try:
+                lock = open(os.path.join(path, CacheManager.ACCESS_MARKER), "a")
+            except IOError:
+                continue   # gone already
+            locks.append(lock)
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                for lock in locks:
+                    lock.close()
+                return None
+        return locks
+
+    def _scanCaches(self):
+        """
+        Scans cache root for cache directories (i.e. directories with an access marker).
+        Returns dict of {path: (access_time, size)}, where size excludes nested cache directories.
+        """
+        caches = {}
+        owner = {}  # maps each directory to the cache directory it belongs to
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirpath = os.path.realpath(dirpath)
+            if self.ACCESS_MARKER in filenames:
+                owner[dirpath] = dirpath
+                caches[dirpath] = [os.path.getmtime(os.path.join(dirpath, self.ACCESS_MARKER)), 0]
+            else:
+                owner[dirpath] = owner.get(os.path.dirname(dirpath))
+            if owner[dirpath] is not None:
+                for name in filenames:
+                    try:
+                        caches[owner[dirpath]][1] += os.lstat(os.path.join(dirpath, name)).st_size
+                    except OSError:
+                        pass
+        return caches
+
+    def enforceQuota(self):
+        """Evicts least recently used caches under the cache root until the total size is within quota"""
+        if not self._max_size:
+            return
+        caches = self._scanCaches()
+        total = sum([size for _, size in caches.itervalues()])
+        if total <= self._max_size:
+            return
+        print>>log, "cache size %.2f GB exceeds quota of %.2f GB, evicting least recently used caches" % (
+            total/2.**30, self._max_size/2.**30)
+        for path, (atime, size) in sorted(caches.iteritems(), key=lambda item: item[1][0]):
+            if total <= self._max_size:
+                break
+            # skip caches that have already gone with their parent
+            if not os.path.exists(path):
+                continue
+            # nested caches are deleted along with this one. Skip if any of them is in use by any process
+            evicted = [ p for p in caches if p == path or p.startswith(path + "/") ]
+            locks = self._lockForEviction(evicted)
+            if locks is None:
+                continue
+            try:
+                freed = sum([caches[p][1] for p in evicted if os.path.exists(p)])
+                print>>log, "  evicting cache %s (%.2f GB, last used %s)" % (path, freed/2.**30, time.ctime(atime))
+                shutil.rmtree(path, ignore_errors=True)
+            finally:
+                for lock in locks:
+                    lock.close()
+            total -= freed
+        if total > self._max_size:
+            print>>log, ModColor.Str("WARNING: caches in use take up %.2f GB, which exceeds the quota" % (total/2.**30))
+
+    @staticmethod
+    def getFileFingerprint(*paths):
+        """
+        Returns fingerprint of the given files for use in cache keys: a tuple of (name, size, mtime) per file.
+        Missing files are skipped.
+        """
+        fingerprint = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            fingerprint.append((os.path.basename(path), st.st_size, st.st_mtime))
+        return tuple(fingerprint)
+
+    @staticmethod
+    def selectKeys(dictionary, *keys):
+        """Helper function. Returns subset of dictionary (e.g. of a GD section) with the given keys, for use in cache keys"""
+        return dict([ (key, dictionary.get(key)) for key in keys ])
+
     @staticmethod
     def getElementName (name, **kw):
         """Helper function. Forms up a cache element filename as "NAME:KEY1_VALUE1:KEY2_VALUE2..."
@@ -160,6 +362,40 @@ class CacheManager (object):
         """
         return "file://" + self.getElementPath(name, **kw)
 
+    def getArrayElementName(self, name, packbool=False):
+        """
+        Forms up element name for an array stored via saveArray(), by adding a suffix describing the
+        format. Thus changing the codec simply invalidates the cache, rather than confusing formats.
+        """
+        suffix = "packed" if packbool else "raw"
+        if self.codec:
+            suffix += "." + self.codec
+        return "%s.%s" % (name, suffix)
+
+    def saveArray(self, path, arr, packbool=False):
+        """
+        Writes array to cache element path (as returned by checkCache()), using the cache's codec, if any.
+        If packbool is True, arr must be boolean, and is stored bit-packed.
+        """
+        if self.codec:
+            NpFile.SaveCompressed(path, arr, codec=self.codec, packbool=packbool, nthreads=self.nthreads)
+        elif packbool:
+            NpFile.SavePackedBool(path, arr)
+        else:
+            NpFile.SaveRaw(path, arr)
+
+    def loadArrayInto(self, path, arr, packbool=False):
+        """
+        Reads array element written by saveArray() into existing array arr.
+        Returns False if the element does not match the array (e.g. is of the wrong size).
+        """
+        if self.codec:
+            return NpFile.LoadCompressedInto(path, arr, packbool=packbool, nthreads=self.nthreads)
+        elif packbool:
+            return NpFile.LoadPackedBoolInto(path, arr)
+        else:
+            return NpFile.LoadRawInto(path, arr)
+
     def checkCache(self, name, hashkeys, directory=False, reset=False, ignore_key=False):
         """
         Checks if cached element named "name" is valid.
@@ -205,6 +441,7 @@ class CacheManager (object):
                 for MainField, D1 in storedhash.iteritems():
                     if MainField not in hash:
                         ListDiffer.append("(%s: missing in hash)" % (str(MainField)))
+                        continue
                     D0 = hash[MainField]
                     if type(D0) != type(D1):
                         ListDiffer.append("(%s: %s vs %s)" % (str(MainField), type(D0), type(D1)))
@@ -236,12 +473,19 @@ class CacheManager (object):
                 os.unlink(hashpath)
             if os.path.exists(cachepath):
                 if directory:
-                    if os.system("rm -fr %s" % cachepath):
+                    try:
+                        shutil.rmtree(cachepath)
+                    except OSError:
                         raise OSError,"Failed to remove cache directory %s. Check permissions/ownership." % cachepath
                     os.mkdir(cachepath)
                 else:
                     os.unlink(cachepath)
 
+        # directory elements are evicted as a unit, so they get their own access marker
+        if directory:
+            self._touch(cachepath)
+        self._touch(self.dirname)
+
         # store hash
         self.hashes[name] = hashpath, hash, reset
         return cachepath, not reset
@@ -263,3 +507,4 @@ class CacheManager (object):
                 cPickle.dump(hash, file(hashpath, "w"))
                 print>>log, "writing cache hash %s" % hashpath
                 del self.hashes[name]
+        self.enforceQuota()
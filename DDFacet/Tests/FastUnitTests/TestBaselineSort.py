@@ -0,0 +1,67 @@
+'''
+DDFacet, a facet-based radio imaging package
+Copyright (C) 2013-2016  Cyril Tasse, l'Observatoire de Paris,
+SKA South Africa, Rhodes University
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+import numpy as np
+from DDFacet.Array import ModBaselineSort
+
+def _makeRows(na=5, ntimes=7):
+    A0, A1 = np.triu_indices(na, 1)
+    times = np.repeat(np.arange(ntimes, dtype=np.float64), A0.size)
+    A0 = np.tile(A0, ntimes)
+    A1 = np.tile(A1, ntimes)
+    perm = np.random.RandomState(0).permutation(A0.size)
+    return A0[perm], A1[perm], times[perm]
+
+def testSortIndexMatchesTupleSort():
+    A0, A1, times = _makeRows()
+    sort_index, bl_offsets = ModBaselineSort.GiveSortIndex(A0, A1, times)
+    sortby = sorted(zip(A0, A1, times, range(A0.size)))
+    assert (sort_index == np.array([s[3] for s in sortby])).all()
+    assert bl_offsets.size == 5*4/2 + 1
+    assert bl_offsets[0] == 0 and bl_offsets[-1] == A0.size
+
+def testBaselineSlice():
+    A0, A1, times = _makeRows()
+    sort_index, bl_offsets = ModBaselineSort.GiveSortIndex(A0, A1, times)
+    A0s, A1s = A0[sort_index], A1[sort_index]
+    slc = ModBaselineSort.GiveBaselineSlice(A0s, A1s, bl_offsets, 1, 3)
+    assert (np.arange(slc.start, slc.stop) == np.where((A0s == 1) & (A1s == 3))[0]).all()
+    assert ModBaselineSort.GiveBaselineSlice(A0s, A1s, bl_offsets, 3, 1) is None
+
+def testBaselineGroups():
+    A0, A1, times = _makeRows()
+    row_index, bl_offsets = ModBaselineSort.GiveBaselineGroups(A0, A1)
+    assert bl_offsets.size == 5*4/2 + 1
+    for i in xrange(bl_offsets.size-1):
+        rows = row_index[bl_offsets[i]:bl_offsets[i+1]]
+        a0, a1 = A0[rows[0]], A1[rows[0]]
+        assert (rows == np.where((A0 == a0) & (A1 == a1))[0]).all()
+
+def testDotUVW():
+    A0, A1, times = _makeRows()
+    uvw = np.random.RandomState(1).randn(A0.size, 3)
+    sort_index, bl_offsets = ModBaselineSort.GiveSortIndex(A0, A1, times)
+    uvw, times = uvw[sort_index], times[sort_index]
+    dot_uvw = ModBaselineSort.GiveDotUVW(uvw, times, bl_offsets)
+    for i in xrange(bl_offsets.size-1):
+        r0, r1 = bl_offsets[i], bl_offsets[i+1]
+        expected = (uvw[r0+1:r1] - uvw[r0:r1-1]) / (times[r0+1:r1] - times[r0:r1-1])[:, np.newaxis]
+        assert np.allclose(dot_uvw[r0:r1-1], expected)
+        assert np.allclose(dot_uvw[r1-1], expected[-1])
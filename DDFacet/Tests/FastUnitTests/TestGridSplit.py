@@ -0,0 +1,94 @@
+'''
+DDFacet, a facet-based radio imaging package
+Copyright (C) 2013-2016  Cyril Tasse, l'Observatoire de Paris,
+SKA South Africa, Rhodes University
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+
+import os
+import copy
+import numpy as np
+import DDFacet.Parset
+from DDFacet.Parset.ReadCFG import Parset
+from DDFacet.Array import shared_dict
+from DDFacet.Data import ClassSmearMapping
+from DDFacet.Imager import ClassDDEGridMachine
+
+def _makeGD():
+    GD = copy.deepcopy(Parset("%s/DefaultParset.cfg" % os.path.dirname(DDFacet.Parset.__file__)).value_dict)
+    GD["Image"]["Cell"] = 10.
+    GD["CF"]["Nw"] = 5
+    GD["CF"]["OverS"] = 5
+    # no shared w-kernel bank, the CFs go straight into the facet's dict
+    GD["CF"]["WKernelTol"] = None
+    return GD
+
+def _makeMapping(nrows, nchan, rs):
+    """Makes a BDA mapping with a mix of row-list and row-range blocks, some of them split in frequency"""
+    sizes, words = [], []
+    row0 = 0
+    while row0 < nrows:
+        n = min(rs.randint(1, 5), nrows-row0)
+        chans = [(0, nchan)] if rs.rand() < .5 else [(0, nchan//2), (nchan//2, nchan)]
+        for ch0, ch1 in chans:
+            if rs.rand() < .5:
+                sizes.append(-n)
+                words += [ch0, ch1, row0]
+            else:
+                sizes.append(n+2)
+                words += [ch0, ch1] + range(row0, row0+n)
+        row0 += n
+    return np.array([len(sizes), 0] + sizes + words, np.int32)
+
+def testSplitGridsSumToFullGrid():
+    rs = np.random.RandomState(0)
+    nrows, nchan = 200, 4
+    freqs = 1e8 + 1e6*np.arange(nchan)
+    uvw = np.ascontiguousarray(np.concatenate((rs.uniform(-5000, 5000, (nrows, 2)),
+                                               rs.uniform(-100, 100, (nrows, 1))), axis=1))
+    vis = (rs.randn(nrows, nchan, 4) + 1j*rs.randn(nrows, nchan, 4)).astype(np.complex64)
+    flags = np.zeros(vis.shape, np.bool)
+    W = np.ones((nrows, nchan), np.float32)
+    A0, A1 = np.zeros(nrows, np.int32), np.ones(nrows, np.int32)
+    times = np.zeros(nrows, np.float64)
+    mapping = _makeMapping(nrows, nchan, rs)
+
+    cf_dict = shared_dict.create("TestGridSplit.CF")
+    try:
+        GM = ClassDDEGridMachine.ClassDDEGridMachine(_makeGD(), freqs, 64, cf_dict=cf_dict, compute_cf=True,
+                                                     wmax=100., bda_grid=mapping)
+        def put(sparsification=None):
+            grid = np.zeros(GM.GridShape, np.complex64)
+            GM.put(times, uvw, vis, flags, (A0, A1), W, DoNormWeights=False, freqs=freqs,
+                   ChanMapping=np.zeros(nchan, np.int64), ResidueGrid=grid, sparsification=sparsification)
+            return grid, GM.SumWeigths.copy()
+        full_grid, full_weights = put()
+        ranges = ClassSmearMapping.GiveBlockRanges(mapping, 3)
+        assert len(ranges) == 3
+        split_grid = np.zeros_like(full_grid)
+        split_weights = np.zeros_like(full_weights)
+        for block0, block1 in ranges:
+            selection = np.zeros(mapping[0], np.bool)
+            selection[block0:block1] = True
+            grid, weights = put(selection)
+            split_grid += grid
+            split_weights += weights
+        assert abs(full_grid).max() > 0
+        assert np.allclose(split_grid, full_grid, atol=1e-4*abs(full_grid).max())
+        assert np.allclose(split_weights, full_weights)
+    finally:
+        cf_dict.delete()
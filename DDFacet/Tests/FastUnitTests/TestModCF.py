@@ -0,0 +1,32 @@
+'''
+DDFacet, a facet-based radio imaging package
+Copyright (C) 2013-2016  Cyril Tasse, l'Observatoire de Paris,
+SKA South Africa, Rhodes University
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+import numpy as np
+from DDFacet.Imager import ModCF
+from DDFacet.ToolsDir import ModFitPoly2D
+
+def testQuantizeCoefPolyPhaseError():
+    lrad, wl, tol = 0.01, 1e5, 0.01
+    l, m = np.mgrid[-lrad:lrad:51j, -lrad:lrad:51j]
+    for l0, m0 in (0.05, -0.02), (-0.1, 0.07), (0.2, 0.2):
+        _, _, CoefPoly = ModCF.Give_dn(l0, m0, rad=3*lrad, order=5)
+        QCoefPoly = ModCF.QuantizeCoefPoly(CoefPoly, wl, lrad, tol)
+        dn = ModFitPoly2D.polyval2d(l, m, CoefPoly) - ModFitPoly2D.polyval2d(l, m, QCoefPoly)
+        assert np.abs(2*np.pi*wl*dn).max() <= tol
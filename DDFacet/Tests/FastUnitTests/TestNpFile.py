@@ -0,0 +1,92 @@
+'''
+DDFacet, a facet-based radio imaging package
+Copyright (C) 2013-2016  Cyril Tasse, l'Observatoire de Paris,
+SKA South Africa, Rhodes University
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+import os
+import tempfile
+import numpy as np
+from DDFacet.Array import NpFile
+
+def testRawRoundTrip():
+    rs = np.random.RandomState(0)
+    vis = (rs.randn(100, 7, 4) + 1j*rs.randn(100, 7, 4)).astype(np.complex64)
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        NpFile.SaveRaw(path, vis)
+        out = np.zeros_like(vis)
+        assert NpFile.LoadRawInto(path, out)
+        assert (out == vis).all()
+        assert not NpFile.LoadRawInto(path, np.zeros((99, 7, 4), np.complex64))
+    finally:
+        os.unlink(path)
+
+def testPackedBoolRoundTrip():
+    flags = np.random.RandomState(0).rand(101, 7, 3) > 0.5
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        NpFile.SavePackedBool(path, flags)
+        assert os.path.getsize(path) == (flags.size+7)//8
+        out = np.zeros_like(flags)
+        assert NpFile.LoadPackedBoolInto(path, out)
+        assert (out == flags).all()
+    finally:
+        os.unlink(path)
+
+def testCompressedRoundTrip():
+    rs = np.random.RandomState(0)
+    vis = (rs.randn(300, 64, 4) + 1j*rs.randn(300, 64, 4)).astype(np.complex64)
+    flags = rs.rand(300, 64, 4) > 0.9
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        for nthreads in 1, 4:
+            NpFile.SaveCompressed(path, vis, codec="zlib", nthreads=nthreads)
+            out = np.zeros_like(vis)
+            assert NpFile.LoadCompressedInto(path, out, nthreads=nthreads)
+            assert (out == vis).all()
+            NpFile.SaveCompressed(path, flags, codec="zlib", packbool=True, nthreads=nthreads)
+            out = np.zeros_like(flags)
+            assert NpFile.LoadCompressedInto(path, out, packbool=True, nthreads=nthreads)
+            assert (out == flags).all()
+            assert not NpFile.LoadCompressedInto(path, np.zeros((299, 64, 4), bool), packbool=True)
+    finally:
+        os.unlink(path)
+
+def testCompressedCorrupt():
+    rs = np.random.RandomState(0)
+    vis = (rs.randn(300, 64, 4) + 1j*rs.randn(300, 64, 4)).astype(np.complex64)
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        NpFile.SaveCompressed(path, vis, codec="zlib")
+        good = open(path, "rb").read()
+        out = np.zeros_like(vis)
+        # truncated within the data, and within the block size table
+        for size in len(good)-100, len(NpFile.COMPRESSED_MAGIC)+8+3*8+4:
+            open(path, "wb").write(good[:size])
+            assert not NpFile.LoadCompressedInto(path, out)
+        # garbage in the compressed data
+        i = len(good)//2
+        open(path, "wb").write(good[:i] + "\xff"*64 + good[i+64:])
+        for nthreads in 1, 4:
+            assert not NpFile.LoadCompressedInto(path, out, nthreads=nthreads)
+    finally:
+        os.unlink(path)
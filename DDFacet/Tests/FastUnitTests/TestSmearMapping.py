@@ -0,0 +1,131 @@
+'''
+DDFacet, a facet-based radio imaging package
+Copyright (C) 2013-2016  Cyril Tasse, l'Observatoire de Paris,
+SKA South Africa, Rhodes University
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+
+import math
+import numpy as np
+from DDFacet.Data import ClassSmearMapping
+
+def _makeMapping(sizes):
+    sizes = np.array(sizes, np.int32)
+    return np.concatenate(([sizes.size, 0], sizes)).astype(np.int32)
+
+def testBlockRanges():
+    # positive sizes are row lists (rows+2 words), negative sizes are row ranges of -size rows
+    sizes = [5, -5, 3, 3, 6, -2, 8, 4]
+    nrows = np.array([3, 5, 1, 1, 4, 2, 6, 2])
+    ranges = ClassSmearMapping.GiveBlockRanges(_makeMapping(sizes), 3)
+    assert ranges[0][0] == 0 and ranges[-1][1] == len(sizes)
+    assert all([ b1 == b0 for (_, b1), (b0, _) in zip(ranges[:-1], ranges[1:]) ])
+    assert len(ranges) == 3 and [ nrows[b0:b1].sum() for b0, b1 in ranges ] == [8, 8, 8]
+
+def testBlockRangesFewBlocks():
+    assert ClassSmearMapping.GiveBlockRanges(_makeMapping([]), 4) == []
+    assert ClassSmearMapping.GiveBlockRanges(_makeMapping([9, 3]), 4) == [(0, 1), (1, 2)]
+    assert ClassSmearMapping.GiveBlockRanges(_makeMapping([4, -2]), 1) == [(0, 2)]
+
+def _giveBlocksRowsListBL_ref(row_index, uvw, dFreq, freqs, dPhi, l, GridChanMapping):
+    """
+    Reference: the list-based per-baseline algorithm that GiveBlocksRowsBL() replaced, trimmed down to its
+    "fast-style" path. (GiveBlocksRowsListBL_old() is an earlier, different algorithm, so it can't be used
+    as a reference.) Returns (BlocksSizesBL, BlocksRowsListBL) lists.
+    """
+    nrows = row_index.size
+    C = 3e8
+    NChan = freqs.size
+    nu0 = np.max(freqs)
+    lmn = np.array([l, l, math.sqrt(1-2*l*l)-1])
+    uvwlmn = uvw * lmn[np.newaxis,:]
+    # a single row has no delta (the original raised an IndexError here)
+    duvw = np.zeros_like(uvwlmn)
+    if nrows > 1:
+        duvw[:-1,:] = uvwlmn[1:,:] - uvwlmn[:-1,:]
+        duvw[-1,:] = duvw[-2,:]
+    delta_phase = np.sqrt((duvw**2).sum(1))*(np.pi*nu0/C)
+    uv = np.sqrt((uvwlmn**2).sum(1))
+    dnu = (C / np.pi) * dPhi / uv
+    fracsizeChanBlock = dnu / dFreq
+    rowblock = np.zeros(nrows+1)
+    rowblock[:nrows] = np.int32(delta_phase.cumsum() / dPhi)
+    rowblock[nrows] = -1
+    blockcut = np.where(np.roll(rowblock,1) != rowblock)[0]
+    block_slices = [ slice(blockcut[i],blockcut[i+1]) for i in xrange(len(blockcut)-1) ]
+    fracsizeChanBlockMin = np.array([ max(fracsizeChanBlock[slc].min(), 1) for slc in block_slices ])
+    numChanBlocks = np.ceil(NChan/fracsizeChanBlockMin)
+    sizeChanBlock = np.int32(np.ceil(NChan/numChanBlocks))
+    channel_cuts = {}
+    for sz in set(sizeChanBlock):
+        chanpairs = np.zeros((NChan+1, 2), np.int32)
+        chanpairs[:-1,0] = np.arange(NChan, dtype=np.int32) // sz
+        chanpairs[:-1,1] = GridChanMapping
+        chanpairs[-1,:] = -1
+        chwh = np.where((chanpairs != np.roll(chanpairs,1,axis=0)).any(axis=1))[0]
+        channel_cuts[sz] = [ (chwh[i], chwh[i+1]) for i in xrange(len(chwh)-1) ]
+    blocklists = [ [ch0, ch1] + list(row_index[block_slices[iblock]]) for iblock, sz in enumerate(sizeChanBlock)
+                                                                      for ch0, ch1 in channel_cuts[sz] ]
+    return [ len(bl) for bl in blocklists ], sum(blocklists, [])
+
+def _decodeRowRanges(sizes, rows):
+    """Expands the [ch0,ch1,row0] blocks of a row_ranges=True mapping back into [ch0,ch1,rows...] blocks"""
+    out_sizes, out_rows = [], []
+    offset = 0
+    for size in sizes:
+        if size < 0:
+            ch0, ch1, row0 = rows[offset:offset+3]
+            block = [ch0, ch1] + range(row0, row0-size)
+            offset += 3
+        else:
+            block = list(rows[offset:offset+size])
+            offset += size
+        out_sizes.append(len(block))
+        out_rows += block
+    assert offset == len(rows)
+    return out_sizes, out_rows
+
+def testBlocksRowsBL():
+    np.random.seed(42)
+    NChan = 16
+    dFreq = 0.2e6
+    freqs = 100e6 + dFreq*np.arange(NChan)
+    dPhi, l = 0.2, 0.05
+    # two bands: a single grid channel, and one grid channel per band
+    for GridChanMapping in np.zeros(NChan, np.int32), np.repeat(np.arange(4, dtype=np.int32), NChan//4):
+        chan_cuts = {}
+        for nrows in 1, 1, 2, 7, 50, 200:
+            # earth-rotation track of a random baseline, at 10s steps
+            radius = np.random.uniform(100, 3000)
+            ha = np.random.uniform(0, 2*np.pi) + 2*np.pi/86400*10*np.arange(nrows)
+            uvw = np.zeros((nrows, 3))
+            uvw[:,0] = radius*np.cos(ha)
+            uvw[:,1] = radius*np.sin(ha)*0.7
+            uvw[:,2] = radius*np.sin(ha)*0.3
+            # rows of a baseline-sorted chunk (contiguous), and of a time-sorted chunk (strided), with a gap
+            for row_index in 10 + np.arange(nrows), 3 + 37*np.arange(nrows) + (np.arange(nrows) >= nrows//2):
+                sizes_ref, rows_ref = _giveBlocksRowsListBL_ref(row_index, uvw, dFreq, freqs, dPhi, l, GridChanMapping)
+                sizes, rows = ClassSmearMapping.GiveBlocksRowsBL(row_index, uvw, dFreq, freqs, dPhi, l,
+                                                                 GridChanMapping, chan_cuts=chan_cuts)
+                assert sizes.dtype == np.int32 and rows.dtype == np.int32
+                assert sizes.tolist() == sizes_ref and rows.tolist() == rows_ref
+                sizes, rows = ClassSmearMapping.GiveBlocksRowsBL(row_index, uvw, dFreq, freqs, dPhi, l,
+                                                                 GridChanMapping, chan_cuts=chan_cuts, row_ranges=True)
+                assert _decodeRowRanges(sizes.tolist(), rows.tolist()) == (sizes_ref, rows_ref)
+                # contiguous rows should have been stored as ranges
+                if row_index[-1] - row_index[0] == nrows - 1:
+                    assert (sizes < 0).all()
@@ -0,0 +1,50 @@
+'''
+DDFacet, a facet-based radio imaging package
+Copyright (C) 2013-2016  Cyril Tasse, l'Observatoire de Paris,
+SKA South Africa, Rhodes University
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+import numpy as np
+from DDFacet.Array.ClassTiledPeakIndex import ClassTiledPeakIndex
+
+def _whereMax(A, DoAbs, Mask=None):
+    """Reference brute-force search, with the same conventions as NpParallel.A_whereMax"""
+    values = np.abs(A) if DoAbs else A.copy()
+    if Mask is not None:
+        values[Mask] = 0
+    x, y = np.unravel_index(np.argmax(values), values.shape)
+    return (x, y, values[x, y]) if values[x, y] > 0 else (0, 0, 0)
+
+def testPeakIndexTracksUpdates():
+    rs = np.random.RandomState(0)
+    A = np.float32(rs.randn(100, 77))
+    Mask = rs.rand(100, 77) > .8
+    for DoAbs in 0, 1:
+        B = A.copy()
+        index = ClassTiledPeakIndex(B, DoAbs=DoAbs, Mask=Mask, TileSize=16)
+        for i in range(50):
+            x, y, peak = index.whereMax()
+            assert (x, y, peak) == _whereMax(B, DoAbs, Mask)
+            # subtract a patch around the peak, as a minor cycle would
+            x0, x1, y0, y1 = max(x-10, 0), x+11, max(y-10, 0), y+11
+            B[x0:x1, y0:y1] -= .5*B[x, y] + np.float32(rs.randn(*B[x0:x1, y0:y1].shape))
+            index.update(x0, x1, y0, y1)
+
+def testPeakIndexAllMasked():
+    A = np.ones((1, 1, 20, 20), np.float32)
+    index = ClassTiledPeakIndex(A, Mask=np.ones((20, 20), np.bool8))
+    assert index.whereMax() == (0, 0, 0)